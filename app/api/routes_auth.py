@@ -6,11 +6,12 @@ from typing import Any
 
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, EmailStr, Field
-from pymongo import MongoClient
 
 from passlib.context import CryptContext
 from jose import jwt
 
+from app.core.mongo import get_mongo_client
+
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 # ---- Config ----
@@ -24,10 +25,6 @@ USERS_COLLECTION = "users"
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-# Reuse one Mongo client
-_mongo_client: MongoClient | None = None
-
-
 # ---- Schemas ----
 class SignupRequest(BaseModel):
     name: str = Field(..., min_length=1)
@@ -52,14 +49,11 @@ class LoginResponse(BaseModel):
 
 
 def _get_users_collection():
-    global _mongo_client
     if not MONGO_URI:
         raise HTTPException(status_code=500, detail="MONGO_URI not configured in .env")
 
-    if _mongo_client is None:
-        _mongo_client = MongoClient(MONGO_URI)
-
-    return _mongo_client[DB_NAME][USERS_COLLECTION]
+    # Shared with the chat history store
+    return get_mongo_client(MONGO_URI)[DB_NAME][USERS_COLLECTION]
 
 
 def _user_to_public(doc: dict[str, Any]) -> PublicUser:
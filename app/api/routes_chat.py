@@ -1,14 +1,26 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import os
-from typing import Iterator
+import time
+from typing import AsyncIterator
 
 from fastapi import APIRouter, HTTPException, Query, Request
 from fastapi.responses import StreamingResponse
 from jose import JWTError, jwt
 
-from app.schemas.chat import ChatRequest, ChatResponse, Source
+from app.core.metrics import REGISTRY, traced
+from app.rag.hybrid_retriever import RETRIEVAL_MODES, retrieve_many
+from app.schemas.chat import (
+    BatchChatRequest,
+    BatchOptions,
+    BatchRetrieveRequest,
+    ChatRequest,
+    ChatResponse,
+    RetrievalMode,
+    Source,
+)
 
 router = APIRouter()
 
@@ -40,44 +52,83 @@ def _scoped_session_id(user_id: str, conversation_id: str) -> str:
     return f"{user_id}:{conversation_id}"
 
 
-def _get_chain_from_state(request: Request):
-    chain = getattr(request.app.state, "rag_chain", None)
-    if chain is None:
-        raise HTTPException(status_code=500, detail="Server not ready: chain not configured")
-    return chain
+def _resolve_retrieval_mode(request: Request, mode: str | None, hybrid: bool) -> str:
+    """
+    Settings.retrieval_mode (if set) wins, then the explicit `mode`, then the
+    UI's hybrid toggle (off = vector-only).
+    """
+    settings = getattr(request.app.state, "settings", None)
+    forced = getattr(settings, "retrieval_mode", None)
+    if forced:
+        if forced not in RETRIEVAL_MODES:
+            raise HTTPException(status_code=500, detail=f"Invalid retrieval_mode setting: {forced}")
+        return forced
+    if mode:
+        return mode
+    return "hybrid" if hybrid else "vector"
+
+
+def _search_overrides(nprobe: int | None, ef_search: int | None) -> dict:
+    overrides = {"nprobe": nprobe, "ef_search": ef_search}
+    return {k: v for k, v in overrides.items() if v is not None}
+
+
+async def _get_tenant(request: Request, user_id: str):
+    """
+    The caller's own index, loaded on first use.
+    """
+    catalog = getattr(request.app.state, "index_catalog", None)
+    if catalog is None:
+        raise HTTPException(status_code=500, detail="Server not ready: index catalog not configured")
+    tenant = await asyncio.to_thread(catalog.get, user_id)
+    if tenant is None:
+        raise HTTPException(status_code=404, detail="No documents indexed yet; upload a PDF first")
+    return tenant
+
 
+async def _get_chain(request: Request, user_id: str):
+    return (await _get_tenant(request, user_id)).chain
 
-def _get_retriever_from_state(request: Request):
-    retriever = getattr(request.app.state, "rag_retriever", None)
-    if retriever is None:
-        raise HTTPException(status_code=500, detail="Server not ready: retriever not configured")
-    return retriever
+
+def _build_sources(docs) -> list[Source]:
+    sources: list[Source] = []
+    for d in docs:
+        page = d.metadata.get("source_page", None)
+        preview = d.page_content[:160].replace("\n", " ")
+        sources.append(
+            Source(
+                page=page if isinstance(page, int) else None,
+                preview=preview,
+                chunk_id=d.metadata.get("chunk_id"),
+                score=d.metadata.get("rrf_score"),
+                ranks=d.metadata.get("retrieval_ranks") or {},
+            )
+        )
+    return sources
 
 
 @router.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest, request: Request):
+async def chat(req: ChatRequest, request: Request):
     """
     Non-streaming chat endpoint used by the UI.
     Requires Authorization: Bearer <token>
     """
     user_id = get_current_user_id(request)
-    chain = _get_chain_from_state(request)
-    retriever = _get_retriever_from_state(request)
+    chain = await _get_chain(request, user_id)
 
     try:
         session_id = _scoped_session_id(user_id, req.conversation_id)
-        config = {"configurable": {"session_id": session_id}}
-
-        answer = chain.invoke({"input": req.message}, config=config)
+        config = {
+            "configurable": {
+                "session_id": session_id,
+                "retrieval_mode": _resolve_retrieval_mode(request, req.mode, req.hybrid),
+                **_search_overrides(req.nprobe, req.ef_search),
+            }
+        }
 
-        docs = retriever.invoke(req.message)
-        sources: list[Source] = []
-        for d in docs:
-            page = d.metadata.get("source_page", None)
-            preview = d.page_content[:160].replace("\n", " ")
-            sources.append(Source(page=page if isinstance(page, int) else None, preview=preview))
+        result = await chain.ainvoke({"input": req.message}, config=config)
 
-        return ChatResponse(answer=answer, sources=sources)
+        return ChatResponse(answer=result["answer"], sources=_build_sources(result.get("docs", [])))
 
     except HTTPException:
         raise
@@ -86,48 +137,318 @@ def chat(req: ChatRequest, request: Request):
 
 
 @router.get("/chat/stream")
-def chat_stream(
+async def chat_stream(
     request: Request,
     conversation_id: str = Query(...),
     message: str = Query(..., min_length=1),
-    hybrid: int = Query(1),  # accepted for UI compatibility; not used yet
+    hybrid: int = Query(1),
+    mode: RetrievalMode | None = Query(None),
+    nprobe: int | None = Query(None, ge=1, le=4096),
+    ef_search: int | None = Query(None, ge=1, le=4096),
+    timings: int = Query(0),
 ):
     """
     Streaming endpoint. Uses fetch streaming in the UI.
+    With timings=1, a `timings` event with this request's per-stage
+    breakdown is sent before `done`.
     Requires Authorization: Bearer <token>
     """
     user_id = get_current_user_id(request)
-    chain = _get_chain_from_state(request)
-    retriever = _get_retriever_from_state(request)
+    chain = await _get_chain(request, user_id)
+    retrieval_mode = _resolve_retrieval_mode(request, mode, bool(hybrid))
+
+    settings = getattr(request.app.state, "settings", None)
+    frame_chars = getattr(settings, "stream_frame_chars", 64)
+    frame_delay = getattr(settings, "stream_frame_ms", 50) / 1000
+
+    async def event_generator() -> AsyncIterator[str]:
+        session_id = _scoped_session_id(user_id, conversation_id)
+        config = {
+            "configurable": {
+                "session_id": session_id,
+                "retrieval_mode": retrieval_mode,
+                **_search_overrides(nprobe, ef_search),
+            }
+        }
+        state = {"sources_sent": False, "answered": False, "started": time.perf_counter(), "timings": {}}
 
-    def event_generator() -> Iterator[str]:
         try:
-            session_id = _scoped_session_id(user_id, conversation_id)
-            config = {"configurable": {"session_id": session_id}}
+            async for event in _stream_answer(request, chain, message, config, state, frame_chars, frame_delay):
+                yield event
+            if state["disconnected"]:
+                return
+            if state["error"] is not None:
+                if state["answered"]:
+                    # Part of the answer is already on screen; regenerating it
+                    # would repeat it, so report where it stopped instead
+                    yield _sse("error", {"detail": str(state["error"]), "partial": True})
+                    return
+                # Nothing was shown yet: answer once without streaming
+                with traced(state["timings"]):
+                    result = await chain.ainvoke({"input": message}, config=config)
+                if not state["sources_sent"]:
+                    yield _sse("sources", {"sources": _sources_payload(result.get("docs", []))})
+                yield _sse("token", {"t": str(result["answer"])})
+            if timings:
+                yield _sse("timings", _timings_payload(state))
+            yield "event: done\ndata: {}\n\n"
+
+        except Exception as e:
+            yield _sse("error", {"detail": str(e)})
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
 
-            streamed_any = False
+# ---- Streaming ----
+_END = object()
+_DISCONNECT_POLL_S = 0.5
+
+STREAM_FIRST_TOKEN = REGISTRY.histogram(
+    "rag_stream_first_token_seconds", "Time from a streaming request to its first answer frame."
+)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _sources_payload(docs) -> list[dict]:
+    return [s.model_dump() for s in _build_sources(docs)]
+
+
+def _timings_payload(state: dict) -> dict:
+    """
+    Milliseconds per stage for one request. Stages of one request can
+    overlap (BM25 and FAISS run concurrently), so they need not add up to
+    `total_ms`.
+    """
+    stages = {name: round(s * 1000, 2) for name, s in sorted(state["timings"].items())}
+    first = state.get("first_token")
+    return {
+        "stages_ms": stages,
+        "first_token_ms": round(first * 1000, 2) if first is not None else None,
+        "total_ms": round((time.perf_counter() - state["started"]) * 1000, 2),
+    }
+
+
+async def _stream_answer(
+    request: Request,
+    chain,
+    message: str,
+    config: dict,
+    state: dict,
+    frame_chars: int,
+    frame_delay: float,
+) -> AsyncIterator[str]:
+    """
+    Runs chain.astream in a task and relays it as SSE: `sources` as soon as
+    retrieval is done, then `token` frames. The first token is sent as soon
+    as it arrives; later ones are batched until `frame_chars` characters are
+    buffered or `frame_delay` has passed.
+
+    Stops, cancelling the chain (and so the LLM request), once the client
+    disconnects. Sets state["error"] to a failure from the chain and
+    state["disconnected"] on a disconnect. Stage timings of the chain go
+    into state["timings"], and the time to the first frame into
+    state["first_token"].
+    """
+    state["error"] = None
+    state["disconnected"] = False
+    state.setdefault("timings", {})
+    state.setdefault("started", time.perf_counter())
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        # Runs in its own task, so the trace covers this request only
+        with traced(state["timings"]):
             try:
-                for chunk in chain.stream({"input": message}, config=config):
-                    streamed_any = True
-                    yield f"event: token\ndata: {json.dumps({'t': str(chunk)})}\n\n"
-            except Exception:
-                streamed_any = False
-
-            if not streamed_any:
-                answer = chain.invoke({"input": message}, config=config)
-                yield f"event: token\ndata: {json.dumps({'t': str(answer)})}\n\n"
-
-            docs = retriever.invoke(message)
-            sources = []
-            for d in docs:
-                page = d.metadata.get("source_page", None)
-                preview = d.page_content[:160].replace("\n", " ")
-                sources.append({"page": page if isinstance(page, int) else None, "preview": preview})
-
-            yield f"event: sources\ndata: {json.dumps({'sources': sources})}\n\n"
-            yield "event: done\ndata: {}\n\n"
+                async for chunk in chain.astream({"input": message}, config=config):
+                    queue.put_nowait(chunk)
+                queue.put_nowait(_END)
+            except Exception as e:
+                queue.put_nowait(e)
+
+    producer = asyncio.create_task(produce())
+    buffered: list[str] = []
+    size = 0
+    deadline = 0.0
 
+    def frame() -> str:
+        nonlocal size
+        text = "".join(buffered)
+        buffered.clear()
+        size = 0
+        if not state["answered"]:
+            state["answered"] = True
+            state["first_token"] = time.perf_counter() - state["started"]
+            STREAM_FIRST_TOKEN.observe(state["first_token"])
+        return _sse("token", {"t": text})
+
+    try:
+        while True:
+            timeout = max(0.0, deadline - loop.time()) if buffered else _DISCONNECT_POLL_S
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    state["disconnected"] = True
+                    return
+                if buffered:
+                    yield frame()
+                continue
+
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                state["error"] = item
+                break
+            if "docs" in item and not state["sources_sent"]:
+                state["sources_sent"] = True
+                yield _sse("sources", {"sources": _sources_payload(item["docs"])})
+            if "answer" in item:
+                text = str(item["answer"])
+                if not buffered:
+                    deadline = loop.time() + frame_delay
+                buffered.append(text)
+                size += len(text)
+                # Coalescing must not delay the first token
+                if size >= frame_chars or (size and not state["answered"]):
+                    if await request.is_disconnected():
+                        state["disconnected"] = True
+                        return
+                    yield frame()
+
+        if buffered:
+            yield frame()
+    finally:
+        producer.cancel()
+
+
+# ---- Batch ----
+def _ndjson(data: dict) -> str:
+    return json.dumps(data) + "\n"
+
+
+def _check_batch_size(request: Request, items: list[str]):
+    limit = getattr(getattr(request.app.state, "settings", None), "batch_max_items", 500)
+    if len(items) > limit:
+        raise HTTPException(status_code=413, detail=f"At most {limit} items per batch")
+
+
+def _batch_search(request: Request, options: BatchOptions) -> dict:
+    return {
+        "mode": _resolve_retrieval_mode(request, options.mode, options.hybrid),
+        **_search_overrides(options.nprobe, options.ef_search),
+    }
+
+
+async def _retrieve_blocks(
+    request: Request, tenant, queries: list[str], search: dict
+) -> AsyncIterator[tuple[int, list[str], list | None, Exception | None]]:
+    """
+    (offset, queries, docs per query, error) for consecutive blocks of
+    `batch_search_block` queries, each retrieved with one batched search.
+    `search` holds the retrieval mode and ANN overrides. Stops early
+    once the client disconnects.
+    """
+    settings = getattr(request.app.state, "settings", None)
+    size = max(1, getattr(settings, "batch_search_block", 64))
+    for start in range(0, len(queries), size):
+        if await request.is_disconnected():
+            return
+        block = queries[start : start + size]
+        try:
+            docs = await asyncio.to_thread(retrieve_many, tenant.retriever, block, **search)
         except Exception as e:
-            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+            yield start, block, None, e
+            continue
+        yield start, block, docs, None
+
+
+@router.post("/retrieve/batch")
+async def retrieve_batch(req: BatchRetrieveRequest, request: Request):
+    """
+    Retrieval for many queries: one embedding call and one FAISS and BM25
+    pass per block of queries. Streams NDJSON, one {"index", "query",
+    "sources"} (or "error") line per query, in order.
+    Requires Authorization: Bearer <token>
+    """
+    user_id = get_current_user_id(request)
+    _check_batch_size(request, req.queries)
+    tenant = await _get_tenant(request, user_id)
+    search = _batch_search(request, req)
+
+    async def lines() -> AsyncIterator[str]:
+        async for start, block, docs, error in _retrieve_blocks(request, tenant, req.queries, search):
+            for j, query in enumerate(block):
+                item = {"index": start + j, "query": query}
+                if error is not None:
+                    item["error"] = str(error)
+                else:
+                    item["sources"] = _sources_payload(docs[j])
+                yield _ndjson(item)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.post("/chat/batch")
+async def chat_batch(req: BatchChatRequest, request: Request):
+    """
+    Answers many independent questions (no chat history or rewriting).
+    Retrieval runs in batched blocks, and at most `batch_llm_concurrency`
+    LLM calls run at once across all batch requests. Streams NDJSON, one {"index", "question",
+    "answer", "sources"} (or "error") line per question as soon as it is
+    answered, so lines arrive out of order.
+    Requires Authorization: Bearer <token>
+    """
+    user_id = get_current_user_id(request)
+    _check_batch_size(request, req.questions)
+    tenant = await _get_tenant(request, user_id)
+    search = _batch_search(request, req)
+    answer_chain = getattr(request.app.state, "batch_answer_chain", None)
+    # Shared by every batch request, so the cap holds for the whole process
+    limit: asyncio.Semaphore | None = getattr(request.app.state, "batch_llm_limit", None)
+    if answer_chain is None or limit is None:
+        raise HTTPException(status_code=500, detail="Server not ready: batch answering not configured")
+
+    async def lines() -> AsyncIterator[str]:
+        finished: asyncio.Queue = asyncio.Queue()
+        tasks: list[asyncio.Task] = []
+
+        async def answer(i: int, question: str, docs):
+            item = {"index": i, "question": question}
+            async with limit:
+                try:
+                    item["answer"] = await answer_chain.ainvoke({"input": question, "docs": docs})
+                    item["sources"] = _sources_payload(docs)
+                except Exception as e:
+                    item["error"] = str(e)
+            finished.put_nowait(item)
+
+        async def produce():
+            # Answers to earlier blocks start while later blocks are retrieved
+            async for start, block, docs, error in _retrieve_blocks(request, tenant, req.questions, search):
+                for j, question in enumerate(block):
+                    if error is not None:
+                        finished.put_nowait({"index": start + j, "question": question, "error": str(error)})
+                    else:
+                        tasks.append(asyncio.create_task(answer(start + j, question, docs[j])))
+
+        producer = asyncio.create_task(produce())
+        try:
+            for _ in range(len(req.questions)):
+                while True:
+                    try:
+                        item = await asyncio.wait_for(finished.get(), _DISCONNECT_POLL_S)
+                        break
+                    except asyncio.TimeoutError:
+                        if await request.is_disconnected() or (producer.done() and all(t.done() for t in tasks)):
+                            return
+                yield _ndjson(item)
+        finally:
+            producer.cancel()
+            for t in tasks:
+                t.cancel()
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
\ No newline at end of file
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
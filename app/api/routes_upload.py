@@ -2,12 +2,16 @@ from __future__ import annotations
 
 import os
 import shutil
+import uuid
 from typing import Callable
 
 from fastapi import APIRouter, File, HTTPException, UploadFile, Request
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
 
+from app.rag.catalog import IndexCatalog
+from app.rag.ingestion import IngestionJobManager, IngestionQueueFull
+
 router = APIRouter(tags=["upload"])
 
 # ---- Auth dependency ----
@@ -15,6 +19,10 @@ _bearer = HTTPBearer(auto_error=False)
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
 JWT_ALG = "HS256"
 
+UPLOAD_DIR = "uploaded_pdfs"
+# Uploads wait here under unique names until their ingestion job finishes
+STAGING_DIR = os.path.join(UPLOAD_DIR, ".incoming")
+
 def get_current_user_id(request: Request) -> str:
     creds: HTTPAuthorizationCredentials | None = request.state._auth_creds if hasattr(request.state, "_auth_creds") else None
     # The above line won't be set automatically; so we decode from header here:
@@ -40,10 +48,25 @@ def _safe_filename(name: str) -> str:
     return name
 
 
-@router.post("/upload_pdf")
+def _discard(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _get_jobs_from_state(request: Request) -> IngestionJobManager:
+    jobs: IngestionJobManager | None = getattr(request.app.state, "ingestion_jobs", None)
+    if jobs is None:
+        raise HTTPException(status_code=500, detail="Server not ready: ingestion jobs not configured")
+    return jobs
+
+
+@router.post("/upload_pdf", status_code=202)
 def upload_pdf(request: Request, file: UploadFile = File(...)):
     """
-    Upload a PDF and rebuild the RAG index.
+    Upload a PDF and queue a background job that adds it to the user's index.
+    Returns immediately with a job id; poll /upload_jobs/{job_id} for progress.
     Requires Authorization: Bearer <token>
     """
     user_id = get_current_user_id(request)
@@ -51,19 +74,20 @@ def upload_pdf(request: Request, file: UploadFile = File(...)):
     if file.content_type not in ("application/pdf", "application/x-pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
 
-    # Get rebuild callback from app.state (set in main.py)
-    rebuild: Callable[[str], dict] | None = getattr(request.app.state, "rebuild_from_pdf", None)
-    if rebuild is None:
-        raise HTTPException(status_code=500, detail="Server not ready: rebuild callback not configured")
+    jobs = _get_jobs_from_state(request)
 
-    os.makedirs("uploaded_pdfs", exist_ok=True)
+    os.makedirs(STAGING_DIR, exist_ok=True)
     filename = f"{user_id}_{_safe_filename(file.filename or 'uploaded.pdf')}"
-    save_path = os.path.join("uploaded_pdfs", filename)
+    save_path = os.path.join(UPLOAD_DIR, filename)
+    # A job may still be reading an earlier upload of the same name, so this
+    # one is written elsewhere and only moved to `save_path` by its own job
+    staged_path = os.path.join(STAGING_DIR, f"{uuid.uuid4().hex}_{filename}")
 
     try:
-        with open(save_path, "wb") as f:
+        with open(staged_path, "wb") as f:
             shutil.copyfileobj(file.file, f)
     except Exception as e:
+        _discard(staged_path)
         raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
     finally:
         try:
@@ -72,7 +96,69 @@ def upload_pdf(request: Request, file: UploadFile = File(...)):
             pass
 
     try:
-        info = rebuild(save_path)
-        return {"filename": filename, **info}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        job = jobs.submit(staged_path, filename=filename, user_id=user_id, source=save_path)
+    except IngestionQueueFull as e:
+        _discard(staged_path)
+        raise HTTPException(status_code=429, detail=str(e))
+
+    return {
+        "filename": filename,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/api/upload_jobs/{job.id}",
+    }
+
+
+@router.get("/upload_jobs/{job_id}")
+def upload_job_status(job_id: str, request: Request):
+    """
+    Per-stage progress and timings for an ingestion job.
+    Requires Authorization: Bearer <token>
+    """
+    user_id = get_current_user_id(request)
+    job = _get_jobs_from_state(request).get(job_id)
+    if job is None or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+def _get_catalog(request: Request) -> IndexCatalog:
+    catalog: IndexCatalog | None = getattr(request.app.state, "index_catalog", None)
+    if catalog is None:
+        raise HTTPException(status_code=500, detail="Server not ready: index catalog not configured")
+    return catalog
+
+
+@router.get("/documents")
+def list_documents(request: Request):
+    """
+    Documents this user has indexed.
+    Requires Authorization: Bearer <token>
+    """
+    user_id = get_current_user_id(request)
+    tenant = _get_catalog(request).get(user_id)
+    if tenant is None:
+        return {"documents": []}
+    docs = [
+        {"doc_id": doc_id, "source": d["source"], "pages": d["pages"], "chunks": len(d["chunk_ids"])}
+        for doc_id, d in list(tenant.corpus.documents.items())
+    ]
+    return {"documents": docs}
+
+
+@router.delete("/documents/{doc_id}")
+def delete_document(doc_id: str, request: Request):
+    """
+    Remove one document from the user's index without a rebuild.
+    Requires Authorization: Bearer <token>
+    """
+    user_id = get_current_user_id(request)
+    tenant = _get_catalog(request).get(user_id)
+    remove: Callable[[str, str], dict] | None = getattr(request.app.state, "remove_document", None)
+    if tenant is None or remove is None or doc_id not in tenant.corpus.documents:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    try:
+        return remove(user_id, doc_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Document not found")
@@ -10,13 +10,92 @@ class Settings:
     mongo_uri: str | None
 
     pdf_path: str = "data/data.pdf"
+    # Single shared index of earlier versions; split into per-user indexes at startup
     vector_store_path: str = "vector_store_faiss"
+    # One index per user under this directory, memory-mapped on first use;
+    # at most tenant_max_resident stay loaded, within tenant_memory_budget_mb
+    # counted as the on-disk size of their saved files (not resident memory)
+    tenant_index_root: str = "vector_store_tenants"
+    tenant_max_resident: int = 32
+    tenant_memory_budget_mb: int = 2048
     embedding_model_name: str = "sentence-transformers/all-MiniLM-L6-v2"
+    embedding_cache_path: str = "embedding_cache"
+    embedding_cache_max_mb: int = 512
+    # Concurrent embedding calls are merged into batches of up to this many
+    # texts, waiting at most this long for a batch to fill (size <= 1 disables)
+    embed_micro_batch_size: int = 64
+    embed_micro_batch_wait_ms: float = 5.0
 
     bm25_k: int = 4
     vector_k: int = 4
     rrf_k: int = 60
     fused_top_k: int = 6
+    bm25_weight: float = 1.0
+    vector_weight: float = 1.0
+    # "hybrid" | "vector" | "bm25". When set, overrides the mode chosen per request.
+    retrieval_mode: str | None = None
+    # BM25 and vector legs run concurrently; a leg slower than this is dropped
+    retrieval_leg_timeout_ms: int = 2000
+    # In-process caches for repeated questions; 0 entries disables a cache
+    query_embedding_cache_size: int = 2048
+    query_embedding_cache_ttl_s: float = 3600.0
+    retrieval_cache_size: int = 1024
+    retrieval_cache_ttl_s: float = 600.0
+    # Prompt context: overlapping chunks merged, near-duplicates (share of word
+    # 3-grams already included >= threshold) dropped, filled in relevance order
+    context_max_tokens: int = 3000
+    context_dedup_threshold: float = 0.85
+    # Opt-in: answer near-duplicate questions from earlier answers (cosine >= threshold)
+    semantic_cache_enabled: bool = False
+    semantic_cache_threshold: float = 0.92
+    semantic_cache_size: int = 1000
+    semantic_cache_ttl_s: float = 3600.0
+
+    # Follow-up rewriting: "always" | "auto" (skip self-contained questions,
+    # cache rewrites) | "parallel" (auto + race raw-question retrieval)
+    rewrite_policy: str = "auto"
+    rewrite_budget_ms: int = 800  # "parallel": wait this long for the rewrite, then cancel it
+    rewrite_cache_size: int = 2048
+    rewrite_cache_ttl_s: float = 1800.0
+
+    # Streaming: answer tokens are sent in frames of up to this many
+    # characters, or whatever has arrived after this long
+    stream_frame_chars: int = 64
+    stream_frame_ms: int = 50
+
+    # Batch endpoints: items per request, queries retrieved per batched
+    # search (results stream back block by block), concurrent LLM calls
+    # across all batch requests
+    batch_max_items: int = 500
+    batch_search_block: int = 64
+    batch_llm_concurrency: int = 8
+
+    # FAISS index: "auto" | "flat" | "ivf" | "hnsw" | "ivfpq". "auto" picks by corpus size.
+    faiss_index_type: str = "auto"
+    faiss_nprobe: int = 8  # IVF lists probed per query (per-request override allowed)
+    faiss_ef_search: int = 64  # HNSW candidate list size (per-request override allowed)
+    faiss_hnsw_m: int = 32
+
+    # Ingestion jobs run off the request path on a bounded pool
+    ingest_workers: int = 1
+    ingest_max_pending: int = 8
+    embed_batch_size: int = 64
+    pdf_parse_workers: int = 0  # 0 = one per CPU
+    pdf_pages_per_task: int = 16
+
+    # Chat history sent to the LLM: a rolling summary + a bounded recent window
+    history_max_messages: int = 12
+    history_max_tokens: int = 2000
+    history_fold_batch: int = 6
+    history_summaries: bool = True
+    # MongoDB: one pooled client per process; history appends are write-behind
+    mongo_max_pool_size: int = 50
+    history_flush_interval_ms: int = 200
+    history_flush_batch: int = 500
+    # In-memory fallback when Mongo is not configured
+    history_memory_max_sessions: int = 1000
+    history_memory_max_messages: int = 200
+    history_memory_ttl_s: int = 24 * 3600
 
     groq_model_name: str = "llama-3.3-70b-versatile"
     temperature: float = 0.0
@@ -29,4 +108,8 @@ def get_settings() -> Settings:
     return Settings(
         groq_api_key=groq,
         mongo_uri=os.getenv("MONGO_URI"),
+        retrieval_mode=os.getenv("RETRIEVAL_MODE") or None,
+        faiss_index_type=os.getenv("FAISS_INDEX_TYPE") or "auto",
+        rewrite_policy=os.getenv("REWRITE_POLICY") or "auto",
+        semantic_cache_enabled=os.getenv("SEMANTIC_CACHE", "").lower() in ("1", "true", "yes"),
     )
\ No newline at end of file
@@ -0,0 +1,276 @@
+"""
+Process-wide metrics in the Prometheus text format, plus per-request stage
+timings.
+
+Code wraps each step in `stage(name)`: the duration goes into the
+`rag_stage_seconds` histogram and, when the request runs under `traced()`,
+into that request's breakdown. Values that already live elsewhere (cache
+counters, index sizes) are read at scrape time by collectors.
+"""
+from __future__ import annotations
+
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Sequence
+
+# Seconds; covers sub-millisecond cache hits up to slow LLM answers
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Sample = tuple[str, dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_sample(name: str, labels: dict[str, str], value: float) -> str:
+    if labels:
+        body = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        return f"{name}{{{body}}} {_format_value(value)}"
+    return f"{name} {_format_value(value)}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, label_values: Sequence[str]) -> tuple[str, ...]:
+        if len(label_values) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(label_values)}")
+        return tuple(str(v) for v in label_values)
+
+    def samples(self) -> list[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[Sample]:
+        with self._lock:
+            return [(self.name, dict(zip(self.labels, k)), v) for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *label_values: str, value: float):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, *label_values: str, amount: float = 1.0):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (per-bucket counts with a final +Inf slot, sum)
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        key = self._key(label_values)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[slot] += 1
+            total[0] += value
+
+    def samples(self) -> list[Sample]:
+        out: list[Sample] = []
+        with self._lock:
+            items = [(k, list(c), t[0]) for k, (c, t) in self._values.items()]
+        for key, counts, total in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, n in zip((*self.buckets, math.inf), counts):
+                cumulative += n
+                out.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            out.append((f"{self.name}_sum", labels, total))
+            out.append((f"{self.name}_count", labels, cumulative))
+        return out
+
+
+# A collector returns (name, kind, help, samples) families computed at scrape time
+Collector = Callable[[], Iterable[tuple[str, str, str, Iterable[tuple[dict[str, str], float]]]]]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[Collector] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(f"Metric {metric.name} already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))  # type: ignore[return-value]
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labels))  # type: ignore[return-value]
+
+    def histogram(
+        self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))  # type: ignore[return-value]
+
+    def add_collector(self, collector: Collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines: list[str] = []
+        for m in metrics:
+            lines += [f"# HELP {m.name} {m.help}", f"# TYPE {m.name} {m.kind}"]
+            lines += [_format_sample(*s) for s in m.samples()]
+        for collect in collectors:
+            try:
+                families = list(collect())
+            except Exception:
+                # One broken source must not take the whole scrape down
+                continue
+            for name, kind, help, samples in families:
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                lines += [_format_sample(name, labels, value) for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_seconds", "Time spent in each step of answering a chat request.", ("stage",)
+)
+
+
+# ---- Per-request traces ----
+_trace: contextvars.ContextVar[dict[str, float] | None] = contextvars.ContextVar("rag_trace", default=None)
+
+
+@contextmanager
+def traced(timings: dict[str, float] | None = None) -> Iterator[dict[str, float]]:
+    """
+    Collect the seconds spent per stage by the code run inside the block
+    (including threads started with `bind`) into `timings`.
+    """
+    timings = {} if timings is None else timings
+    token = _trace.set(timings)
+    try:
+        yield timings
+    finally:
+        _trace.reset(token)
+
+
+def record(name: str, seconds: float, histogram: Histogram = STAGE_SECONDS):
+    histogram.observe(seconds, name)
+    timings = _trace.get()
+    if timings is not None:
+        # Plain dict updates are atomic enough here: a lost race costs one sample
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str, histogram: Histogram = STAGE_SECONDS) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0, histogram)
+
+
+def bind(fn: Callable) -> Callable:
+    """
+    `fn` bound to the caller's context, for handing to an executor: pool
+    threads do not inherit contextvars, so their stages would miss the trace.
+    """
+    ctx = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return ctx.run(fn, *args, **kwargs)
+
+    return run
+
+
+# ---- HTTP ----
+HTTP_IN_FLIGHT = REGISTRY.gauge("rag_http_requests_in_flight", "Requests being handled, streams included.")
+HTTP_SECONDS = REGISTRY.histogram(
+    "rag_http_request_seconds",
+    "Time from request to the last byte of the response, by route name and status.",
+    ("route", "method", "status"),
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting in-flight requests and timing whole responses
+    (streams included). Requests are labelled with the name of the route
+    that handled them, so ids in the URL add no series.
+    """
+
+    def __init__(self, app, *, skip: Sequence[str] = ("/metrics", "/static")):
+        self.app = app
+        self.skip = tuple(skip)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.skip):
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # Routing stores the matched route in the scope
+            route = getattr(scope.get("route"), "name", None) or "unmatched"
+            HTTP_SECONDS.observe(time.perf_counter() - t0, route, scope["method"], status)
@@ -0,0 +1,22 @@
+import threading
+
+from pymongo import MongoClient
+
+_clients: dict[str, MongoClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_mongo_client(uri: str, *, max_pool_size: int = 50) -> MongoClient:
+    """
+    One pooled client per URI for the whole process (auth, chat history).
+    MongoClient is thread-safe and bounds its own connection pool.
+    """
+    with _clients_lock:
+        client = _clients.get(uri)
+        if client is None:
+            client = _clients[uri] = MongoClient(
+                uri,
+                maxPoolSize=max_pool_size,
+                serverSelectionTimeoutMS=5000,
+            )
+        return client
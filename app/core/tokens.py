@@ -0,0 +1,8 @@
+"""
+Token estimates for budgeting prompt context and chat history.
+"""
+
+
+def approx_tokens(text: str) -> int:
+    # ~4 characters per token for English; no tokenizer needed for budgeting
+    return len(text) // 4 + 1
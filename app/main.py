@@ -1,23 +1,35 @@
+import asyncio
+import logging
 import os
-import shutil
-from typing import Any
 
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from langchain_core.documents import Document
 from fastapi.staticfiles import StaticFiles
 
 from app.core.config import get_settings
-from app.rag.pdf_loader import load_and_chunk_pdf
+from app.core.metrics import REGISTRY, MetricsMiddleware
+from app.rag.pdf_loader import count_pdf_pages, iter_pdf_chunks
 from app.rag.embeddings import get_embedding_model
-from app.rag.vectorstore_faiss import create_or_load_vector_store
+from app.rag.embedding_batcher import BatchingEmbeddings
+from app.rag.embedding_cache import CachedEmbeddings
+from app.rag.catalog import IndexCatalog
+from app.rag.corpus_index import ChunksNotIndexed, CorpusIndex, file_hash
+from app.rag.ingestion import IngestionJob, IngestionJobManager
 from app.rag.hybrid_retriever import build_hybrid_retriever
-from app.memory.history import build_history_getter
-from app.rag.chain import build_conversational_rag_chain
+from app.rag.query_cache import LRUCache
+from app.rag.semantic_cache import SemanticAnswerCache
+from app.rag.rewrite import QuestionRewriter
+from app.memory.history import HistoryWindow, build_history_getter, build_history_store, close_history_stores
+from app.rag.chain import build_batch_answer_chain, build_conversational_rag_chain, build_history_summarizer
 
 from app.api.routes_chat import router as chat_router
 from app.api.routes_auth import router as auth_router
 from app.api.routes_pages import router as pages_router
 from app.api.routes_upload import router as upload_router
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="RAG Chatbot API", version="1.0")
 
 # Serve /static/* files (app.js, css, images)
@@ -29,98 +41,451 @@ app.include_router(pages_router)
 settings = get_settings()
 
 # MongoDB (if available) for persistent history
-get_session_history = build_history_getter(settings.mongo_uri)
+history_store = build_history_store(
+    settings.mongo_uri,
+    max_pool_size=settings.mongo_max_pool_size,
+    flush_interval=settings.history_flush_interval_ms / 1000,
+    max_batch=settings.history_flush_batch,
+    memory_limits={
+        "max_sessions": settings.history_memory_max_sessions,
+        "max_messages": settings.history_memory_max_messages,
+        "ttl": settings.history_memory_ttl_s or None,
+    },
+)
+get_session_history = build_history_getter(
+    store=history_store,
+    window=HistoryWindow(
+        max_messages=settings.history_max_messages,
+        max_tokens=settings.history_max_tokens,
+        fold_batch=settings.history_fold_batch,
+    ),
+    summarizer=build_history_summarizer(groq_api_key=settings.groq_api_key, model_name=settings.groq_model_name)
+    if settings.history_summaries
+    else None,
+)
 
-# Lazy init: do NOT load/chunk default PDF or build FAISS at startup.
+# Lazy init: nothing is loaded at startup. Each user's index lives in its
+# own directory and is memory-mapped on that user's first request.
 _embedding_model = None
 
+# Both caches key on the corpus (path and version) where it matters, so
+# nothing needs clearing when a document is added or removed
+_query_vectors = LRUCache(settings.query_embedding_cache_size, ttl=settings.query_embedding_cache_ttl_s)
+_retrieval_cache = LRUCache(settings.retrieval_cache_size, ttl=settings.retrieval_cache_ttl_s)
+_question_rewriter = QuestionRewriter(
+    policy=settings.rewrite_policy,
+    cache=LRUCache(settings.rewrite_cache_size, ttl=settings.rewrite_cache_ttl_s),
+    budget_ms=settings.rewrite_budget_ms,
+)
+
 
 def _ensure_embedding_model():
     global _embedding_model
     if _embedding_model is None:
-        _embedding_model = get_embedding_model(settings.embedding_model_name)
+        _embedding_model = get_embedding_model(
+            settings.embedding_model_name,
+            cache_dir=settings.embedding_cache_path,
+            cache_max_mb=settings.embedding_cache_max_mb,
+            batch_max_size=settings.embed_micro_batch_size,
+            batch_max_wait_ms=settings.embed_micro_batch_wait_ms,
+        )
     return _embedding_model
 
 
-def _rebuild_from_pdf(pdf_path: str) -> dict:
+def _embedding_batcher() -> BatchingEmbeddings | None:
+    model = _embedding_model.base if isinstance(_embedding_model, CachedEmbeddings) else _embedding_model
+    return model if isinstance(model, BatchingEmbeddings) else None
+
+
+def _corpus_kwargs() -> dict:
+    return {
+        "model_name": settings.embedding_model_name,
+        "index_type": settings.faiss_index_type,
+        "nprobe": settings.faiss_nprobe,
+        "ef_search": settings.faiss_ef_search,
+        "hnsw_m": settings.faiss_hnsw_m,
+        "query_vectors": _query_vectors,
+    }
+
+
+def _open_corpus(path: str) -> CorpusIndex:
     """
-    Build chunks, vector store, retriever, and chain using the uploaded PDF.
-    Updates app.state so routes immediately use the new index.
+    The corpus saved at `path` (memory-mapped), or an empty one to fill.
     """
     emb = _ensure_embedding_model()
+    corpus = CorpusIndex.load(emb, path, **_corpus_kwargs())
+    return corpus if corpus is not None else CorpusIndex(emb, path, **_corpus_kwargs())
 
-    chunks, raw_docs = load_and_chunk_pdf(pdf_path)
-
-    # Fresh rebuild vector store (avoid reloading old index)
-    if os.path.exists(settings.vector_store_path):
-        shutil.rmtree(settings.vector_store_path, ignore_errors=True)
-
-    vector_store = create_or_load_vector_store(chunks, emb, settings.vector_store_path)
 
+def _serve_corpus(corpus: CorpusIndex) -> dict:
+    """
+    Retriever and chain for one corpus; built once per load and reading the
+    live corpus from then on. Semantic caches are per corpus, so answers
+    never cross users.
+    """
+    semantic_cache = None
+    if settings.semantic_cache_enabled:
+        semantic_cache = SemanticAnswerCache(
+            corpus.embed_query,
+            lambda: corpus.version,
+            max_entries=settings.semantic_cache_size,
+            threshold=settings.semantic_cache_threshold,
+            ttl=settings.semantic_cache_ttl_s,
+        )
     hybrid_retriever = build_hybrid_retriever(
-        chunks,
-        vector_store,
+        corpus,
         bm25_k=settings.bm25_k,
         vector_k=settings.vector_k,
         rrf_k=settings.rrf_k,
         fused_top_k=settings.fused_top_k,
+        weights={"bm25": settings.bm25_weight, "vector": settings.vector_weight},
+        leg_timeout_ms=settings.retrieval_leg_timeout_ms,
+        cache=_retrieval_cache,
     )
-
-    conversational_rag_chain = build_conversational_rag_chain(
+    chain = build_conversational_rag_chain(
         groq_api_key=settings.groq_api_key,
         model_name=settings.groq_model_name,
         temperature=settings.temperature,
         hybrid_retriever=hybrid_retriever,
         get_session_history=get_session_history,
+        semantic_cache=semantic_cache,
+        question_rewriter=_question_rewriter,
+        context_max_tokens=settings.context_max_tokens or None,
+        context_dedup_threshold=settings.context_dedup_threshold,
     )
+    return {"chain": chain, "retriever": hybrid_retriever, "semantic_cache": semantic_cache}
 
-    # Update shared state used by routes
-    app.state.rag_chain = conversational_rag_chain
-    app.state.rag_retriever = hybrid_retriever
-    app.state.rag_stats = {
-        "pdf_pages": len(raw_docs),
-        "chunks": len(chunks),
-        "faiss_vectors": int(vector_store.index.ntotal),
-        "last_pdf_path": pdf_path,
-    }
+
+# Shared by every user's /api/chat/batch; retrieval there goes through the
+# caller's own index
+_batch_answer_chain = build_batch_answer_chain(
+    groq_api_key=settings.groq_api_key,
+    model_name=settings.groq_model_name,
+    temperature=settings.temperature,
+    context_max_tokens=settings.context_max_tokens or None,
+    context_dedup_threshold=settings.context_dedup_threshold,
+)
+
+_catalog = IndexCatalog(
+    settings.tenant_index_root,
+    open_corpus=_open_corpus,
+    serve=_serve_corpus,
+    max_resident=settings.tenant_max_resident,
+    memory_budget=settings.tenant_memory_budget_mb * 1024 * 1024 if settings.tenant_memory_budget_mb else None,
+)
+
+
+def _migrate_shared_index():
+    """
+    Split an index saved by a single-index version of the app into per-user
+    indexes, then move it aside. Documents with no owner are left in it.
+    """
+    path = settings.vector_store_path
+    if not os.path.exists(os.path.join(path, "manifest.json")):
+        return
+    try:
+        shared = CorpusIndex.load(_ensure_embedding_model(), path, **_corpus_kwargs())
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Not migrating the shared index at %s: %s", path, e)
+        return
+    if shared is None:
+        return
+
+    moved = 0
+    for doc_id, doc in list(shared.documents.items()):
+        user_id = doc.get("user_id")
+        if not user_id:
+            continue
+        chunk_ids, chunks, vectors = shared.export_document(doc_id)
+        with _catalog.pinned(user_id) as tenant:
+            if doc_id not in tenant.corpus.documents:
+                tenant.corpus.add_document(
+                    doc_id,
+                    chunk_ids,
+                    chunks,
+                    vectors,
+                    pages=doc["pages"],
+                    source=doc["source"],
+                    user_id=user_id,
+                    chunk_pages=doc["chunk_pages"],
+                )
+                tenant.corpus.save()
+        moved += 1
+    if moved == len(shared.documents):
+        os.replace(path, f"{path}.migrated")
+    logger.info("Moved %d of %d documents from %s into per-user indexes", moved, len(shared.documents), path)
+
+
+def _rebuild_from_pdf(pdf_path: str, job: IngestionJob | None = None) -> dict:
+    """
+    Ingest the uploaded PDF into its user's corpus index.
+    Runs in stages (parse, chunk, embed, index) and reports progress into `job`.
+    Only chunks not already indexed are embedded, and the document is applied
+    to FAISS + BM25 in one atomic step, so chat keeps serving the previous
+    corpus until then. Re-uploading the same path replaces the old version.
+    Other users' indexes are not touched.
+
+    A staged upload (`job.source` set) is indexed under `job.source` and
+    moved there once indexed, or deleted if the job fails.
+    """
+    job = job or IngestionJob(pdf_path=pdf_path)
+    source = job.source or pdf_path
+    try:
+        result = _ingest_pdf(pdf_path, source, job)
+    except BaseException:
+        if source != pdf_path:
+            try:
+                os.remove(pdf_path)
+            except OSError:
+                pass
+        raise
+    if source != pdf_path:
+        os.replace(pdf_path, source)
+    return result
+
+
+def _ingest_pdf(pdf_path: str, source: str, job: IngestionJob) -> dict:
+    emb = _ensure_embedding_model()
+    doc_id = file_hash(pdf_path)
+
+    with _catalog.pinned(job.user_id or "anonymous") as tenant:
+        corpus = tenant.corpus
+        chunk_ids: list[str] = []
+        chunk_pages: list[int] = []
+        seen: set[str] = set()
+        new_chunks: list[Document] = []
+        vectors: list[list[float]] = []
+        pending: list[Document] = []
+        # Chunks skipped as already indexed, in case a removal drops them
+        # before this document is applied
+        indexed: dict[str, Document] = {}
+
+        def embed(chunks: list[Document]):
+            vectors.extend(emb.embed_documents([c.page_content for c in chunks]))
+            new_chunks.extend(chunks)
+
+        def embed_pending():
+            fresh = corpus.missing(pending)
+            if fresh:
+                embed(fresh)
+            fresh_ids = {c.metadata["chunk_id"] for c in fresh}
+            indexed.update((c.metadata["chunk_id"], c) for c in pending if c.metadata["chunk_id"] not in fresh_ids)
+            job.advance("embed", len(pending))
+            pending.clear()
+
+        # Parsing runs in worker processes and streams chunks back, so embedding
+        # starts on the first page range instead of after the whole PDF
+        n_pages = count_pdf_pages(pdf_path)
+        with job.stage("parse", total=n_pages), job.stage("chunk"), job.stage("embed"):
+            for chunk in iter_pdf_chunks(
+                pdf_path,
+                pages_per_task=settings.pdf_pages_per_task,
+                max_workers=settings.pdf_parse_workers or None,
+                on_pages=lambda n: job.advance("parse", n),
+            ):
+                chunk.metadata["source"] = source
+                cid = CorpusIndex.tag_chunk(chunk, doc_id)
+                if cid in seen:
+                    continue
+                seen.add(cid)
+                chunk_ids.append(cid)
+                chunk_pages.append(chunk.metadata.get("source_page", -1))
+                job.advance("chunk")
+                pending.append(chunk)
+                if len(pending) >= settings.embed_batch_size:
+                    embed_pending()
+            embed_pending()
+
+        with job.stage("index", total=len(chunk_ids)):
+            while True:
+                try:
+                    info = corpus.add_document(
+                        doc_id,
+                        chunk_ids,
+                        new_chunks,
+                        vectors,
+                        pages=n_pages,
+                        source=source,
+                        user_id=job.user_id,
+                        replaces=corpus.find_documents(source=source),
+                        chunk_pages=chunk_pages,
+                    )
+                    break
+                except ChunksNotIndexed as e:
+                    embed([indexed.pop(cid) for cid in e.chunk_ids])
+            corpus.save()
+            stats = corpus.stats()
+            job.advance("index", len(chunk_ids))
 
     return {
-        "pages": len(raw_docs),
-        "chunks": len(chunks),
-        "vectors": int(vector_store.index.ntotal),
+        "pages": n_pages,
+        "vectors": stats["faiss_vectors"],
+        **info,
     }
 
 
+def _remove_document(user_id: str, doc_id: str) -> dict:
+    """
+    Drop one document from the user's corpus; chunks still referenced by
+    their other documents stay indexed.
+    """
+    with _catalog.pinned(user_id) as tenant:
+        info = tenant.corpus.remove_document(doc_id)
+        tenant.corpus.save()
+    return info
+
+
 @app.on_event("startup")
 def _startup():
+    app.state.settings = settings
+
     # Upload route uses this
     app.state.rebuild_from_pdf = _rebuild_from_pdf
+    app.state.remove_document = _remove_document
+    app.state.ingestion_jobs = IngestionJobManager(
+        _rebuild_from_pdf,
+        max_workers=settings.ingest_workers,
+        max_pending=settings.ingest_max_pending,
+    )
+
+    # Chat and document routes resolve the caller's index here
+    app.state.index_catalog = _catalog
+    app.state.batch_answer_chain = _batch_answer_chain
+    app.state.batch_llm_limit = asyncio.Semaphore(max(1, settings.batch_llm_concurrency))
+    _migrate_shared_index()
 
-    # Chat routes use these (start empty until a PDF is uploaded)
-    app.state.rag_chain = None
-    app.state.rag_retriever = None
-    app.state.rag_stats = {
-        "pdf_pages": 0,
-        "chunks": 0,
-        "faiss_vectors": 0,
-        "last_pdf_path": None,
-    }
+
+@app.on_event("shutdown")
+def _shutdown():
+    jobs: IngestionJobManager | None = getattr(app.state, "ingestion_jobs", None)
+    if jobs is not None:
+        jobs.shutdown(wait=False)
+    close_history_stores()
+    batcher = _embedding_batcher()
+    if batcher is not None:
+        batcher.close()
 
 
 # API routers
 app.include_router(auth_router, prefix="/api")
 app.include_router(upload_router, prefix="/api")
 app.include_router(chat_router, prefix="/api")
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get("/health")
 def health():
-    stats: dict[str, Any] = getattr(app.state, "rag_stats", {}) or {}
+    semantic = [t.semantic_cache.stats() for t in _catalog.resident() if t.semantic_cache is not None]
     return {
         "status": "ok",
-        "rag_ready": bool(getattr(app.state, "rag_chain", None)) and bool(getattr(app.state, "rag_retriever", None)),
-        "pdf_pages": int(stats.get("pdf_pages", 0) or 0),
-        "chunks": int(stats.get("chunks", 0) or 0),
-        "faiss_vectors": int(stats.get("faiss_vectors", 0) or 0),
+        "index_catalog": _catalog.stats(),
         "mongo_configured": settings.mongo_uri is not None,
-    }
\ No newline at end of file
+        "history_store": history_store.stats(),
+        "embedding_cache": _embedding_model.stats() if isinstance(_embedding_model, CachedEmbeddings) else None,
+        "embedding_batches": batcher.stats() if (batcher := _embedding_batcher()) is not None else None,
+        "query_embedding_cache": _query_vectors.stats(),
+        "retrieval_cache": _retrieval_cache.stats(),
+        "semantic_cache": {
+            "corpora": len(semantic),
+            "entries": sum(c["entries"] for c in semantic),
+            "hits": sum(c["hits"] for c in semantic),
+            "misses": sum(c["misses"] for c in semantic),
+        }
+        if settings.semantic_cache_enabled
+        else None,
+        "question_rewrite": _question_rewriter.stats(),
+    }
+
+
+# ---- Metrics ----
+# History stats that count events; exported as counters with a _total suffix
+_HISTORY_COUNTERS = frozenset(
+    {"flushed", "flush_errors", "dropped", "fold_errors", "evicted_idle", "evicted_lru", "trimmed_messages"}
+)
+
+
+def _collect_metrics():
+    """
+    Scrape-time view of the counters the caches, index catalog, history
+    store, embedding batcher and ingestion jobs already keep.
+    """
+    caches = {"query_embedding": _query_vectors.stats(), "retrieval": _retrieval_cache.stats()}
+    rewrite = _question_rewriter.stats()
+    if "cache" in rewrite:
+        caches["rewrite"] = rewrite["cache"]
+    if isinstance(_embedding_model, CachedEmbeddings):
+        caches["embedding_disk"] = _embedding_model.stats()
+    semantic = [t.semantic_cache.stats() for t in _catalog.resident() if t.semantic_cache is not None]
+    if semantic:
+        caches["semantic_answer"] = {k: sum(c[k] for c in semantic) for k in ("entries", "hits", "misses")}
+    for name, kind, help, key in (
+        ("rag_cache_hits_total", "counter", "Cache lookups answered from the cache.", "hits"),
+        ("rag_cache_misses_total", "counter", "Cache lookups that missed.", "misses"),
+        ("rag_cache_entries", "gauge", "Entries held per cache.", "entries"),
+    ):
+        yield name, kind, help, [({"cache": c}, s[key]) for c, s in caches.items()]
+    yield "rag_cache_hit_ratio", "gauge", "Share of lookups that hit, since startup.", [
+        ({"cache": c}, s["hits"] / (s["hits"] + s["misses"]) if s["hits"] + s["misses"] else 0.0)
+        for c, s in caches.items()
+    ]
+    yield "rag_rewrite_total", "counter", "Follow-up questions by how the standalone question was produced.", [
+        ({"outcome": k}, v) for k, v in rewrite.items() if isinstance(v, int)
+    ]
+
+    catalog = _catalog.stats()
+    yield "rag_index_tenants", "gauge", "Per-user indexes on disk.", [({}, catalog["tenants"])]
+    yield "rag_index_resident", "gauge", "Per-user indexes loaded.", [({}, catalog["resident"])]
+    yield "rag_index_resident_bytes", "gauge", "Approximate size of the loaded indexes.", [({}, catalog["resident_bytes"])]
+    yield "rag_index_loads_total", "counter", "Index loads from disk.", [({}, catalog["loads"])]
+    yield "rag_index_evictions_total", "counter", "Indexes unloaded to stay within limits.", [({}, catalog["evictions"])]
+    # Per loaded index; bounded by tenant_max_resident
+    resident = [(os.path.basename(t.corpus.path), t) for t in _catalog.resident()]
+    corpus_stats = [(name, t.corpus.stats()) for name, t in resident]
+    yield "rag_index_version", "gauge", "Changes applied to a loaded index.", [
+        ({"index": name}, t.corpus.version) for name, t in resident
+    ]
+    yield "rag_index_vectors", "gauge", "Chunks in a loaded index.", [
+        ({"index": name}, s["faiss_vectors"]) for name, s in corpus_stats
+    ]
+    yield "rag_index_documents", "gauge", "Documents in a loaded index.", [
+        ({"index": name}, s["documents"]) for name, s in corpus_stats
+    ]
+    yield "rag_index_bytes", "gauge", "Approximate on-disk size of a loaded index.", [
+        ({"index": name}, t.nbytes) for name, t in resident
+    ]
+
+    history = history_store.stats()
+    for key, value in history.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            # Event counts only grow; sizes and queue depths go both ways
+            if key in _HISTORY_COUNTERS:
+                name, kind = f"rag_history_{key}_total", "counter"
+            else:
+                name, kind = f"rag_history_{key}", "gauge"
+            yield name, kind, f"History store {key.replace('_', ' ')}.", [({"backend": history["backend"]}, value)]
+
+    batcher = _embedding_batcher()
+    if batcher is not None:
+        batches = batcher.stats()
+        yield "rag_embed_batches_total", "counter", "Embedding model calls made by the batcher.", [({}, batches["batches"])]
+        yield "rag_embed_texts_total", "counter", "Texts embedded through the batcher.", [({}, batches["texts"])]
+        yield "rag_embed_waiting", "gauge", "Embedding requests waiting for a batch.", [({}, batches["waiting"])]
+
+    jobs: IngestionJobManager | None = getattr(app.state, "ingestion_jobs", None)
+    if jobs is not None:
+        counts = jobs.stats()
+        yield "rag_ingest_jobs_in_flight", "gauge", "Ingestion jobs queued or running.", [
+            ({"status": s}, counts[s]) for s in ("queued", "running")
+        ]
+
+
+REGISTRY.add_collector(_collect_metrics)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Prometheus text format: stage latency histograms, HTTP in-flight and
+    latency per route, cache hit rates, index sizes and versions.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,52 +1,585 @@
 from __future__ import annotations
-from typing import Any
-from pymongo import MongoClient
-from langchain_mongodb.chat_message_histories import MongoDBChatMessageHistory
 
-_in_memory_history: dict[str, list[Any]] = {}
+import asyncio
+import atexit
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Sequence
 
-class SimpleMemoryHistory:
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import BulkWriteError, PyMongoError
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, message_to_dict, messages_from_dict
+
+from app.core.metrics import stage
+from app.core.mongo import get_mongo_client
+from app.core.tokens import approx_tokens
+
+logger = logging.getLogger(__name__)
+
+# (previous summary, messages to fold in) -> new summary
+Summarizer = Callable[[str, Sequence[BaseMessage]], str]
+
+
+@dataclass(frozen=True)
+class HistoryWindow:
     """
-    Minimal in-memory fallback that supports what RunnableWithMessageHistory expects.
-    Data is lost on restart.
+    How much history a turn sees: the summary plus at most `max_messages`
+    recent messages within roughly `max_tokens`. When `max_messages` are
+    unsummarized, the oldest `fold_batch` are folded into the summary.
     """
-    def __init__(self, session_id: str):
+    max_messages: int = 12
+    max_tokens: int = 2000
+    fold_batch: int = 6
+
+
+# ---- Stores ----
+# Messages are addressed by a per-session key that increases with insertion
+# order; a summary records the key of the last message it covers.
+
+class _MemorySession:
+    __slots__ = ("messages", "base", "summary", "nbytes", "used")
+
+    def __init__(self, now: float):
+        self.messages: deque = deque()
+        self.base = 0  # key of messages[0]; grows as old messages are trimmed
+        self.summary: tuple[str, int] | None = None
+        self.nbytes = 0
+        self.used = now
+
+
+_COMPACT_TYPES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+
+
+def _pack(m: BaseMessage) -> tuple[str, str]:
+    # Plain messages keep just (type, content); anything richer keeps its JSON
+    if m.type in _COMPACT_TYPES and isinstance(m.content, str) and not (
+        m.additional_kwargs or m.response_metadata or m.name or m.id or getattr(m, "tool_calls", None)
+    ):
+        return m.type, sys.intern(m.content) if len(m.content) < 64 else m.content
+    return "json", json.dumps(message_to_dict(m))
+
+
+def _unpack(packed: tuple[str, str]) -> BaseMessage:
+    kind, data = packed
+    if kind == "json":
+        return messages_from_dict([json.loads(data)])[0]
+    return _COMPACT_TYPES[kind](content=data)
+
+
+def _packed_size(packed: tuple[str, str]) -> int:
+    return sys.getsizeof(packed) + sys.getsizeof(packed[1])
+
+
+class MemoryChatStore:
+    """
+    In-process store used when MongoDB is not available. Data is lost on restart.
+
+    Bounded: at most `max_sessions` sessions (least recently used evicted
+    first), `max_messages` per session (oldest trimmed), and sessions idle
+    for `ttl` seconds are dropped. Messages are kept as (type, content)
+    pairs rather than message objects.
+    """
+
+    def __init__(self, *, max_sessions: int = 1000, max_messages: int = 200, ttl: float | None = 24 * 3600):
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self._sessions: OrderedDict[str, _MemorySession] = OrderedDict()
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self._nmessages = 0
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+        self.trimmed_messages = 0
+        self.fold_errors = 0  # failed summary folds, counted by WindowedChatHistory
+
+    # ---- Eviction (call with the lock held) ----
+    def _drop(self, session_id: str) -> _MemorySession | None:
+        sess = self._sessions.pop(session_id, None)
+        if sess is not None:
+            self._nbytes -= sess.nbytes
+            self._nmessages -= len(sess.messages)
+        return sess
+
+    def _expire(self, now: float):
+        # Sessions are kept in LRU order, so idle ones are at the front
+        if self.ttl is not None:
+            while self._sessions:
+                session_id, sess = next(iter(self._sessions.items()))
+                if now - sess.used < self.ttl:
+                    break
+                self._drop(session_id)
+                self.evicted_idle += 1
+
+    def _touch(self, session_id: str, *, create: bool = False) -> _MemorySession | None:
+        now = time.monotonic()
+        self._expire(now)
+        sess = self._sessions.get(session_id)
+        if sess is None:
+            if not create:
+                return None
+            sess = self._sessions[session_id] = _MemorySession(now)
+            while len(self._sessions) > self.max_sessions:
+                self._drop(next(iter(self._sessions)))
+                self.evicted_lru += 1
+        sess.used = now
+        self._sessions.move_to_end(session_id)
+        return sess
+
+    # ---- Store interface ----
+    def append(self, session_id: str, messages: Sequence[BaseMessage]):
+        with self._lock:
+            sess = self._touch(session_id, create=True)
+            for m in messages:
+                packed = _pack(m)
+                size = _packed_size(packed)
+                sess.messages.append(packed)
+                sess.nbytes += size
+                self._nbytes += size
+                self._nmessages += 1
+            while len(sess.messages) > self.max_messages:
+                size = _packed_size(sess.messages.popleft())
+                sess.base += 1
+                sess.nbytes -= size
+                self._nbytes -= size
+                self._nmessages -= 1
+                self.trimmed_messages += 1
+
+    def _rows(self, sess: _MemorySession | None, start: int, stop: int) -> list[tuple[int, BaseMessage]]:
+        if sess is None:
+            return []
+        start = max(start, sess.base)
+        stop = min(stop, sess.base + len(sess.messages))
+        return [(k, _unpack(sess.messages[k - sess.base])) for k in range(start, stop)]
+
+    def recent(self, session_id: str, *, after: int | None, limit: int) -> list[tuple[int, BaseMessage]]:
+        with self._lock:
+            sess = self._touch(session_id)
+            end = sess.base + len(sess.messages) if sess else 0
+            start = max(after + 1 if after is not None else 0, end - limit)
+            return self._rows(sess, start, end)
+
+    def oldest(self, session_id: str, *, after: int | None, limit: int) -> list[tuple[int, BaseMessage]]:
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            start = max(after + 1 if after is not None else 0, sess.base if sess else 0)
+            return self._rows(sess, start, start + limit)
+
+    def count(self, session_id: str, *, after: int | None) -> int:
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            if sess is None:
+                return 0
+            start = max(after + 1 if after is not None else 0, sess.base)
+            return max(0, sess.base + len(sess.messages) - start)
+
+    def get_summary(self, session_id: str) -> tuple[str, int] | None:
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            return sess.summary if sess else None
+
+    def set_summary(self, session_id: str, summary: str, covered: int):
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            if sess is not None:  # evicted while the summary was being written
+                sess.summary = (summary, covered)
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._drop(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "messages": self._nmessages,
+                "approx_bytes": self._nbytes,
+                "evicted_idle": self.evicted_idle,
+                "evicted_lru": self.evicted_lru,
+                "trimmed_messages": self.trimmed_messages,
+                "fold_errors": self.fold_errors,
+            }
+
+
+class MongoChatStore:
+    """
+    Messages in the same documents MongoDBChatMessageHistory writes
+    ({SessionId, History: json}), so existing conversations stay readable.
+    Reads are bounded: a turn fetches at most the window, newest first, by
+    (SessionId, _id). Summaries live in a separate collection.
+
+    Appends are write-behind: messages get their ObjectId when appended and
+    are buffered, and a background thread inserts them in batches every
+    `flush_interval` seconds (sooner once `max_batch` are waiting). Reads
+    merge in the buffered messages, so a session sees its own writes
+    immediately. `close()` flushes what is left.
+
+    Failed flushes are retried with exponential backoff. A message Mongo
+    rejects (validation, oversized document), or one that has failed
+    `max_attempts` flushes, is logged and dropped so it cannot block the
+    messages queued behind it.
+    """
+
+    def __init__(
+        self,
+        client: MongoClient,
+        db_name: str,
+        collection: str,
+        *,
+        flush_interval: float = 0.2,
+        max_batch: int = 500,
+        max_buffer: int = 20_000,
+        max_attempts: int = 10,
+    ):
+        db = client[db_name]
+        self.messages = db[collection]
+        self.summaries = db[f"{collection}_summaries"]
+        self.messages.create_index([("SessionId", ASCENDING), ("_id", DESCENDING)])
+        self.summaries.create_index("SessionId", unique=True)
+
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self.max_attempts = max_attempts
+        self._pending: list[dict] = []
+        self._inflight: list[dict] = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self.flushed = 0
+        self.flush_errors = 0
+        self.dropped = 0
+        self.fold_errors = 0  # failed summary folds, counted by WindowedChatHistory
+        self._attempts: dict[ObjectId, int] = {}
+        self._failed_flushes = 0  # consecutive, for backoff
+        self._flusher = threading.Thread(target=self._run, name="history-flush", daemon=True)
+        self._flusher.start()
+
+    @staticmethod
+    def _query(session_id: str, after) -> dict:
+        q: dict[str, Any] = {"SessionId": session_id}
+        if after is not None:
+            q["_id"] = {"$gt": after}
+        return q
+
+    @staticmethod
+    def _rows(docs) -> list[tuple[Any, BaseMessage]]:
+        docs = list(docs)
+        msgs = messages_from_dict([json.loads(d["History"]) for d in docs])
+        return [(d["_id"], m) for d, m in zip(docs, msgs)]
+
+    # ---- Write-behind ----
+    def append(self, session_id: str, messages: Sequence[BaseMessage]):
+        if not messages:
+            return
+        docs = [
+            {"_id": ObjectId(), "SessionId": session_id, "History": json.dumps(message_to_dict(m))}
+            for m in messages
+        ]
+        with self._cond:
+            self._pending.extend(docs)
+            backlog = len(self._pending)
+            if backlog >= self.max_batch:
+                self._cond.notify()
+        if backlog > self.max_buffer:
+            # Mongo is falling behind; make the writer wait instead of growing the buffer
+            self.flush()
+
+    def _unflushed(self, session_id: str, after) -> list[dict]:
+        with self._cond:
+            docs = self._inflight + self._pending
+        return [d for d in docs if d["SessionId"] == session_id and (after is None or d["_id"] > after)]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if not batch:
+                return
+            failed: list[dict] = []
+            rest: list[dict] = []
+            try:
+                self.messages.insert_many(batch, ordered=True)
+                done = batch
+            except BulkWriteError as e:
+                inserted = e.details.get("nInserted", 0)
+                errors = e.details.get("writeErrors")
+                done = batch[:inserted]
+                if not errors:
+                    # Write concern error: nothing wrong with the messages themselves
+                    failed = batch[inserted:]
+                elif errors[0].get("code") == 11000:
+                    # Duplicate _id: an earlier attempt wrote that message
+                    done = batch[: inserted + 1]
+                    rest = batch[inserted + 1 :]
+                else:
+                    # Would fail again on every retry
+                    self._drop(batch[inserted : inserted + 1], errors[0].get("errmsg"))
+                    rest = batch[inserted + 1 :]
+            except PyMongoError:
+                done = []
+                failed = batch
+            finally:
+                with self._cond:
+                    self._inflight = []
+            self.flushed += len(done)
+            for d in done:
+                self._attempts.pop(d["_id"], None)
+            self._requeue(failed, rest)
+
+    def _requeue(self, failed: list[dict], rest: list[dict]):
+        """
+        Put `failed` (counted against `max_attempts`) and `rest` (not yet
+        tried) back at the front of the buffer, in order.
+        """
+        if failed:
+            self.flush_errors += 1
+            self._failed_flushes += 1
+        else:
+            self._failed_flushes = 0
+        retry = []
+        for d in failed:
+            attempts = self._attempts[d["_id"]] = self._attempts.get(d["_id"], 0) + 1
+            if attempts >= self.max_attempts:
+                self._drop([d], f"failed {attempts} flushes")
+            else:
+                retry.append(d)
+        if retry or rest:
+            with self._cond:
+                self._pending[:0] = retry + rest
+
+    def _drop(self, docs: list[dict], reason: str | None):
+        self.flush_errors += 1
+        self.dropped += len(docs)
+        for d in docs:
+            self._attempts.pop(d["_id"], None)
+            logger.error("Dropping history message %s of session %s: %s", d["_id"], d["SessionId"], reason)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and (self._failed_flushes or len(self._pending) < self.max_batch):
+                    # Back off while Mongo keeps failing
+                    self._cond.wait(self.flush_interval * 2 ** min(self._failed_flushes, 6))
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._flusher.join(timeout=10)
+        self.flush()
+
+    # ---- Reads ----
+    def recent(self, session_id: str, *, after, limit: int):
+        unflushed = self._unflushed(session_id, after)
+        cursor = self.messages.find(self._query(session_id, after)).sort("_id", DESCENDING).limit(limit)
+        docs = {d["_id"]: d for d in cursor}
+        docs.update((d["_id"], d) for d in unflushed)
+        return self._rows(sorted(docs.values(), key=lambda d: d["_id"])[-limit:])
+
+    def oldest(self, session_id: str, *, after, limit: int):
+        self.flush()  # only used off the request path, by summary folding
+        cursor = self.messages.find(self._query(session_id, after)).sort("_id", ASCENDING).limit(limit)
+        return self._rows(cursor)
+
+    def count(self, session_id: str, *, after) -> int:
+        self.flush()
+        return self.messages.count_documents(self._query(session_id, after))
+
+    def get_summary(self, session_id: str):
+        doc = self.summaries.find_one({"SessionId": session_id})
+        return (doc["summary"], doc["covered"]) if doc else None
+
+    def set_summary(self, session_id: str, summary: str, covered):
+        self.summaries.update_one(
+            {"SessionId": session_id},
+            {"$set": {"summary": summary, "covered": covered}},
+            upsert=True,
+        )
+
+    def clear(self, session_id: str):
+        with self._cond:
+            self._pending = [d for d in self._pending if d["SessionId"] != session_id]
+        self.messages.delete_many({"SessionId": session_id})
+        self.summaries.delete_one({"SessionId": session_id})
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = len(self._pending) + len(self._inflight)
+        return {
+            "backend": "mongodb",
+            "pending_writes": pending,
+            "flushed": self.flushed,
+            "flush_errors": self.flush_errors,
+            "dropped": self.dropped,
+            "fold_errors": self.fold_errors,
+        }
+
+
+# ---- History ----
+_fold_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-fold")
+_folding: set[str] = set()
+_folding_lock = threading.Lock()
+
+
+class WindowedChatHistory(BaseChatMessageHistory):
+    """
+    Chat history that exposes a rolling summary plus a bounded window of
+    recent messages, so prompt size and store reads per turn stay constant
+    however long the conversation gets.
+
+    Messages that age out of the window are folded into the summary in the
+    background by `summarizer`; without one they are simply left out.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        store,
+        *,
+        window: HistoryWindow = HistoryWindow(),
+        summarizer: Summarizer | None = None,
+    ):
         self.session_id = session_id
-        _in_memory_history.setdefault(session_id, [])
-        self.messages = _in_memory_history[session_id]
+        self.store = store
+        self.window = window
+        self.summarizer = summarizer
 
-    def add_message(self, message: Any):
-        self.messages.append(message)
+    @property
+    def messages(self) -> list[BaseMessage]:  # type: ignore[override]
+        with stage("history_load"):
+            return self._window()
 
-    def get_messages(self):
-        return self.messages
+    def _window(self) -> list[BaseMessage]:
+        summary = self.store.get_summary(self.session_id)
+        text, covered = summary if summary else ("", None)
+        rows = self.store.recent(self.session_id, after=covered, limit=self.window.max_messages)
 
-def build_history_getter(
+        window: list[BaseMessage] = []
+        budget = self.window.max_tokens
+        for _, m in reversed(rows):
+            budget -= approx_tokens(str(m.content))
+            if budget < 0 and window:
+                break
+            window.append(m)
+        window.reverse()
+
+        if text:
+            return [SystemMessage(content=f"Summary of the earlier conversation:\n{text}"), *window]
+        return window
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        with stage("history_save"):
+            self.store.append(self.session_id, list(messages))
+        if self.summarizer is not None:
+            with _folding_lock:
+                if self.session_id in _folding:
+                    return
+                _folding.add(self.session_id)
+            _fold_executor.submit(self._fold)
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        return await asyncio.to_thread(lambda: self.messages)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        # Appends only touch the in-process buffer; no I/O to wait on
+        self.add_messages(messages)
+
+    def _fold(self):
+        try:
+            summary = self.store.get_summary(self.session_id)
+            text, covered = summary if summary else ("", None)
+            pending = self.store.count(self.session_id, after=covered)
+            if pending < self.window.max_messages:
+                return
+            keep = max(0, self.window.max_messages - self.window.fold_batch)
+            rows = self.store.oldest(self.session_id, after=covered, limit=pending - keep)
+            if rows:
+                new_text = self.summarizer(text, [m for _, m in rows])
+                self.store.set_summary(self.session_id, new_text, rows[-1][0])
+        except Exception:
+            # Retried after the next turn; until then the summary lags behind
+            self.store.fold_errors += 1
+            logger.exception("Folding history into the summary failed for session %s", self.session_id)
+        finally:
+            with _folding_lock:
+                _folding.discard(self.session_id)
+
+    def clear(self) -> None:
+        self.store.clear(self.session_id)
+
+
+_stores: list = []
+
+
+def close_history_stores():
+    """
+    Flush buffered writes; called on shutdown (and at exit as a fallback).
+    """
+    while _stores:
+        _stores.pop().close()
+
+
+atexit.register(close_history_stores)
+
+
+def build_history_store(
     mongo_uri: str | None,
     db_name: str = "RAG_Chatbot",
     collection: str = "chat_history",
+    *,
+    max_pool_size: int = 50,
+    flush_interval: float = 0.2,
+    max_batch: int = 500,
+    memory_limits: dict[str, Any] | None = None,
 ):
-    mongodb_available = False
-
+    """
+    MongoDB when reachable, else the bounded in-process store configured by
+    `memory_limits` (MemoryChatStore keyword arguments).
+    """
     if mongo_uri:
         try:
-            client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+            client = get_mongo_client(mongo_uri, max_pool_size=max_pool_size)
             client.admin.command("ping")
-            mongodb_available = True
-        except Exception:
-            mongodb_available = False
-
-    if mongodb_available:
-        def get_session_history(session_id: str):
-            return MongoDBChatMessageHistory(
-                connection_string=mongo_uri,
-                session_id=session_id,
-                database_name=db_name,
-                collection_name=collection,
+            store = MongoChatStore(
+                client, db_name, collection, flush_interval=flush_interval, max_batch=max_batch
             )
-        return get_session_history
+            _stores.append(store)
+            return store
+        except Exception:
+            pass
+    return MemoryChatStore(**(memory_limits or {}))
+
+
+def build_history_getter(
+    mongo_uri: str | None = None,
+    db_name: str = "RAG_Chatbot",
+    collection: str = "chat_history",
+    *,
+    store=None,
+    window: HistoryWindow = HistoryWindow(),
+    summarizer: Summarizer | None = None,
+):
+    if store is None:
+        store = build_history_store(mongo_uri, db_name, collection)
 
     def get_session_history(session_id: str):
-        return SimpleMemoryHistory(session_id)
+        return WindowedChatHistory(session_id, store, window=window, summarizer=summarizer)
 
-    return get_session_history
\ No newline at end of file
+    return get_session_history
@@ -0,0 +1,374 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import shutil
+import uuid
+from collections import Counter
+from typing import Iterable, Sequence
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"\w+")
+_ID_DTYPE = "S32"  # chunk ids are 32-char hex content hashes
+_SEGMENT_ARRAYS = ("indptr", "docs", "tfs", "doc_len", "chunk_ids")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class _Segment:
+    """
+    Immutable CSR postings for a batch of chunks: postings of term t are
+    docs[indptr[t]:indptr[t+1]] (local doc numbers) with term counts in tfs.
+    Only the `alive` tombstone mask changes after creation; `dirty` marks a
+    mask that differs from the saved copy.
+    """
+
+    def __init__(self, indptr, docs, tfs, doc_len, chunk_ids, alive=None, name: str | None = None):
+        self.indptr = indptr
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.chunk_ids = chunk_ids
+        self.alive = np.ones(len(doc_len), dtype=bool) if alive is None else np.array(alive, dtype=bool)
+        self.name = name
+        self.dirty = alive is None
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    @classmethod
+    def build(cls, term_ids: np.ndarray, docs: np.ndarray, tfs: np.ndarray, doc_len, chunk_ids, n_terms: int):
+        order = np.argsort(term_ids, kind="stable")
+        counts = np.bincount(term_ids, minlength=n_terms)
+        indptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(
+            indptr,
+            docs[order].astype(np.int32),
+            tfs[order].astype(np.float32),
+            np.asarray(doc_len, dtype=np.int32),
+            np.asarray(chunk_ids, dtype=_ID_DTYPE),
+        )
+
+    def triples(self):
+        """
+        Postings as parallel (term, local doc, tf) arrays, for merging.
+        """
+        terms = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        return terms, np.asarray(self.docs), np.asarray(self.tfs)
+
+    def postings(self, term_id: int):
+        if term_id + 1 >= len(self.indptr):
+            return None
+        start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        if start == end:
+            return None
+        return self.docs[start:end], self.tfs[start:end]
+
+    def save(self, path: str, previous: str | None = None):
+        os.makedirs(path, exist_ok=True)
+        for arr_name in (*_SEGMENT_ARRAYS, "alive"):
+            dst = os.path.join(path, f"{arr_name}.npy")
+            src = os.path.join(previous, f"{arr_name}.npy") if previous else None
+            if src and os.path.exists(src) and (arr_name != "alive" or not self.dirty):
+                # Segments never change once written: link instead of copying
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copyfile(src, dst)
+            else:
+                np.save(dst, getattr(self, arr_name))
+
+    @classmethod
+    def load(cls, path: str, name: str):
+        arrays = {a: np.load(os.path.join(path, f"{a}.npy"), mmap_mode="r") for a in _SEGMENT_ARRAYS}
+        alive = np.load(os.path.join(path, "alive.npy"))
+        return cls(**arrays, alive=alive, name=name)
+
+
+class BM25Index:
+    """
+    Sparse inverted-index BM25 stored as numpy CSR segments.
+
+    Each ingested batch becomes a small segment; segments are merged once
+    there are more than `max_segments`. Removal only flips a tombstone bit
+    and adjusts document frequencies. Persisted segments are loaded with
+    mmap, and scoring gathers each query term's postings and computes
+    contributions as array operations, with argpartition for top-k.
+    """
+
+    def __init__(self, *, k1: float = 1.5, b: float = 0.75, max_segments: int = 8):
+        self.k1 = k1
+        self.b = b
+        self.max_segments = max_segments
+        self.vocab: dict[str, int] = {}
+        self.df = np.zeros(0, dtype=np.int32)
+        self.segments: list[_Segment] = []
+        self.n_live = 0
+        self.total_len = 0
+        self._locations: dict[str, tuple[int, int]] | None = None
+
+    def __len__(self) -> int:
+        return self.n_live
+
+    # ---- Updates ----
+    def _term_id(self, term: str) -> int:
+        tid = self.vocab.get(term)
+        if tid is None:
+            tid = len(self.vocab)
+            self.vocab[term] = tid
+        return tid
+
+    def add_many(self, items: Iterable[tuple[str, str]]):
+        """
+        Index (chunk_id, text) pairs as one new segment.
+        """
+        term_ids: list[int] = []
+        docs: list[int] = []
+        tfs: list[int] = []
+        doc_len: list[int] = []
+        chunk_ids: list[str] = []
+        for chunk_id, text in items:
+            tf = Counter(tokenize(text))
+            local = len(chunk_ids)
+            for term, n in tf.items():
+                term_ids.append(self._term_id(term))
+                docs.append(local)
+                tfs.append(n)
+            chunk_ids.append(chunk_id)
+            doc_len.append(sum(tf.values()))
+        if not chunk_ids:
+            return
+
+        n_terms = len(self.vocab)
+        if len(self.df) < n_terms:
+            self.df = np.concatenate([self.df, np.zeros(n_terms - len(self.df), dtype=np.int32)])
+        tid_arr = np.asarray(term_ids, dtype=np.int64)
+        np.add.at(self.df, tid_arr, 1)
+
+        self.segments.append(
+            _Segment.build(tid_arr, np.asarray(docs), np.asarray(tfs), doc_len, chunk_ids, n_terms)
+        )
+        self.n_live += len(chunk_ids)
+        self.total_len += int(sum(doc_len))
+        self._locations = None
+        if len(self.segments) > self.max_segments:
+            self._merge()
+
+    def add(self, chunk_id: str, text: str):
+        self.add_many([(chunk_id, text)])
+
+    def remove(self, chunk_id: str, text: str):
+        if self._locations is None:
+            self._locations = {
+                cid.decode(): (si, local)
+                for si, seg in enumerate(self.segments)
+                for local, cid in enumerate(seg.chunk_ids)
+                if seg.alive[local]
+            }
+        loc = self._locations.pop(chunk_id, None)
+        if loc is None:
+            return
+        seg = self.segments[loc[0]]
+        seg.alive[loc[1]] = False
+        seg.dirty = True
+        self.n_live -= 1
+        self.total_len -= int(seg.doc_len[loc[1]])
+        tids = [self.vocab[t] for t in set(tokenize(text)) if t in self.vocab]
+        if tids:
+            self.df[tids] -= 1
+
+    def _merge(self):
+        """
+        Merge every segment except a dominant one (over half the live docs)
+        into one, dropping tombstoned docs; keeps merge cost amortized.
+        """
+        sizes = [int(s.alive.sum()) for s in self.segments]
+        largest = int(np.argmax(sizes))
+        keep = [largest] if sizes[largest] * 2 > sum(sizes) else []
+        to_merge = [s for i, s in enumerate(self.segments) if i not in keep]
+
+        all_t, all_d, all_tf, doc_len, chunk_ids = [], [], [], [], []
+        offset = 0
+        for seg in to_merge:
+            t, d, tf = seg.triples()
+            live = seg.alive[d]
+            # Renumber surviving docs contiguously after previous segments
+            new_local = np.cumsum(seg.alive) - 1 + offset
+            all_t.append(t[live])
+            all_d.append(new_local[d[live]])
+            all_tf.append(tf[live])
+            doc_len.append(np.asarray(seg.doc_len)[seg.alive])
+            chunk_ids.append(np.asarray(seg.chunk_ids)[seg.alive])
+            offset += int(seg.alive.sum())
+
+        merged = _Segment.build(
+            np.concatenate(all_t),
+            np.concatenate(all_d),
+            np.concatenate(all_tf),
+            np.concatenate(doc_len),
+            np.concatenate(chunk_ids),
+            len(self.vocab),
+        )
+        self.segments = [self.segments[i] for i in keep] + [merged]
+        self._locations = None
+
+    # ---- Search ----
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        if self.n_live == 0 or k <= 0:
+            return []
+        tids = sorted({self.vocab[t] for t in tokenize(query) if t in self.vocab})
+        if not tids:
+            return []
+
+        n = self.n_live
+        avgdl = self.total_len / n or 1.0
+        df = self.df[tids].astype(np.float64)
+        idf = np.log1p((n - df + 0.5) / (df + 0.5))
+
+        cand_ids: list[np.ndarray] = []
+        cand_scores: list[np.ndarray] = []
+        for seg in self.segments:
+            scores = None
+            for tid, w in zip(tids, idf):
+                hit = seg.postings(tid)
+                if hit is None:
+                    continue
+                docs, tf = hit
+                norm = self.k1 * (1 - self.b + self.b * seg.doc_len[docs] / avgdl)
+                contrib = w * tf * (self.k1 + 1) / (tf + norm)
+                if scores is None:
+                    scores = np.zeros(len(seg), dtype=np.float32)
+                scores[docs] += contrib
+            if scores is None:
+                continue
+            scores[~seg.alive] = 0.0
+            top = _top_k(scores, k)
+            top = top[scores[top] > 0]
+            cand_ids.append(np.asarray(seg.chunk_ids[top]))
+            cand_scores.append(scores[top])
+
+        if not cand_scores:
+            return []
+        ids = np.concatenate(cand_ids)
+        scores = np.concatenate(cand_scores)
+        order = _top_k(scores, k)
+        return [(ids[i].decode(), float(scores[i])) for i in order]
+
+    def search_many(self, queries: Sequence[str], k: int) -> list[list[tuple[str, float]]]:
+        """
+        `search` for many queries at once: per segment, each term's postings
+        are read and BM25-weighted once for every query containing it, and
+        each query's scores are then summed with one bincount.
+        """
+        results: list[list[tuple[str, float]]] = [[] for _ in queries]
+        if self.n_live == 0 or k <= 0:
+            return results
+        query_tids = [sorted({self.vocab[t] for t in tokenize(q) if t in self.vocab}) for q in queries]
+        terms = sorted({tid for tids in query_tids for tid in tids})
+        if not terms:
+            return results
+
+        n = self.n_live
+        avgdl = self.total_len / n or 1.0
+        df = self.df[terms].astype(np.float64)
+        idf = dict(zip(terms, np.log1p((n - df + 0.5) / (df + 0.5))))
+
+        cand_ids: list[list[np.ndarray]] = [[] for _ in queries]
+        cand_scores: list[list[np.ndarray]] = [[] for _ in queries]
+        for seg in self.segments:
+            parts: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+            for tid in terms:
+                hit = seg.postings(tid)
+                if hit is None:
+                    continue
+                docs, tf = hit
+                norm = self.k1 * (1 - self.b + self.b * seg.doc_len[docs] / avgdl)
+                parts[tid] = (docs, idf[tid] * tf * (self.k1 + 1) / (tf + norm))
+            if not parts:
+                continue
+
+            for i, tids in enumerate(query_tids):
+                hits = [parts[tid] for tid in tids if tid in parts]
+                if not hits:
+                    continue
+                docs = np.concatenate([h[0] for h in hits])
+                contrib = np.concatenate([h[1] for h in hits])
+                scores = np.bincount(docs, weights=contrib, minlength=len(seg)).astype(np.float32)
+                scores[~seg.alive] = 0.0
+                top = _top_k(scores, k)
+                top = top[scores[top] > 0]
+                cand_ids[i].append(np.asarray(seg.chunk_ids[top]))
+                cand_scores[i].append(scores[top])
+
+        for i in range(len(queries)):
+            if not cand_scores[i]:
+                continue
+            ids = np.concatenate(cand_ids[i])
+            scores = np.concatenate(cand_scores[i])
+            order = _top_k(scores, k)
+            results[i] = [(ids[o].decode(), float(scores[o])) for o in order]
+        return results
+
+    # ---- Persistence ----
+    def save(self, path: str, previous: str | None = None):
+        """
+        Write to `path`; unchanged segment files are hard-linked from the
+        `previous` save instead of being rewritten.
+        """
+        os.makedirs(path, exist_ok=True)
+        for seg in self.segments:
+            prev_seg = os.path.join(previous, seg.name) if previous and seg.name else None
+            if seg.name is None:
+                seg.name = f"seg_{uuid.uuid4().hex[:12]}"
+            seg.save(os.path.join(path, seg.name), previous=prev_seg)
+
+        np.save(os.path.join(path, "df.npy"), self.df)
+        with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(list(self.vocab), f)
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "k1": self.k1,
+                    "b": self.b,
+                    "n_live": self.n_live,
+                    "total_len": self.total_len,
+                    "segments": [s.name for s in self.segments],
+                },
+                f,
+            )
+
+    def attach(self, path: str):
+        """
+        Swap in-memory segment arrays for mmapped views of a saved copy.
+        """
+        self.segments = [_Segment.load(os.path.join(path, s.name), s.name) for s in self.segments]
+
+    @classmethod
+    def load(cls, path: str, *, max_segments: int = 8) -> "BM25Index":
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            terms = json.load(f)
+
+        index = cls(k1=meta["k1"], b=meta["b"], max_segments=max_segments)
+        index.vocab = {t: i for i, t in enumerate(terms)}
+        index.df = np.array(np.load(os.path.join(path, "df.npy")), dtype=np.int32)
+        index.n_live = int(meta["n_live"])
+        index.total_len = int(meta["total_len"])
+        index.segments = [_Segment.load(os.path.join(path, name), name) for name in meta["segments"]]
+        return index
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k largest scores, best first, without a full sort.
+    """
+    if len(scores) <= k:
+        return np.argsort(-scores, kind="stable")
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part], kind="stable")]
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from app.rag.corpus_index import CorpusIndex
+
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class TenantIndex:
+    """
+    One user's corpus and the retriever/chain serving it. `serving` is what
+    the catalog's `serve` callback built (chain, retriever, semantic cache).
+    """
+
+    def __init__(self, user_id: str, corpus: CorpusIndex, serving: dict[str, Any]):
+        self.user_id = user_id
+        self.corpus = corpus
+        self.chain = serving.get("chain")
+        self.retriever = serving.get("retriever")
+        self.semantic_cache = serving.get("semantic_cache")
+        self.nbytes = 0
+        self.pins = 0
+
+
+class IndexCatalog:
+    """
+    Per-user corpora, each saved under its own directory below `root`.
+
+    Corpora are loaded on first use (memory-mapped, see CorpusIndex.load)
+    and kept in an LRU of resident indexes bounded by `max_resident` and
+    `memory_budget` bytes. An index's size is the size of its saved files,
+    an estimate rather than a measurement of resident memory: mapped pages
+    never read count in full, and changes not yet saved do not count at all.
+    Evicted indexes are just dropped; the next request maps them again.
+    Indexes pinned by an ingestion job or being compacted in the background
+    are not evicted, so one user's writes always go to a single object.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        *,
+        open_corpus: Callable[[str], CorpusIndex],
+        serve: Callable[[CorpusIndex], dict[str, Any]],
+        max_resident: int = 32,
+        memory_budget: int | None = None,
+    ):
+        self.root = root
+        self.open_corpus = open_corpus
+        self.serve = serve
+        self.max_resident = max_resident
+        self.memory_budget = memory_budget
+        self._resident: OrderedDict[str, TenantIndex] = OrderedDict()
+        self._lock = threading.Lock()
+        # user_id -> [lock serializing loads, threads using it]
+        self._loading: dict[str, list] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def path_for(self, user_id: str) -> str:
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", user_id)[:48]
+        digest = hashlib.blake2b(user_id.encode("utf-8"), digest_size=6).hexdigest()
+        return os.path.join(self.root, f"{slug}-{digest}")
+
+    def exists(self, user_id: str) -> bool:
+        return os.path.exists(os.path.join(self.path_for(user_id), "manifest.json"))
+
+    # ---- Residency ----
+    def get(self, user_id: str, *, create: bool = False) -> TenantIndex | None:
+        """
+        The user's index, loading it if needed; None if the user has none
+        and `create` is False.
+        """
+        with self._lock:
+            tenant = self._resident.get(user_id)
+            if tenant is not None:
+                self._resident.move_to_end(user_id)
+                return tenant
+            loading = self._loading.setdefault(user_id, [threading.Lock(), 0])
+            loading[1] += 1
+
+        try:
+            with loading[0]:
+                with self._lock:
+                    tenant = self._resident.get(user_id)
+                    if tenant is not None:
+                        return tenant
+                if not create and not self.exists(user_id):
+                    return None
+                path = self.path_for(user_id)
+                corpus = self.open_corpus(path)
+                tenant = TenantIndex(user_id, corpus, self.serve(corpus))
+                tenant.nbytes = _dir_bytes(path)
+                with self._lock:
+                    self._resident[user_id] = tenant
+                    self.loads += 1
+                    self._evict_locked(keep=user_id)
+                return tenant
+        finally:
+            # The last thread out removes the lock, whether or not the load worked
+            with self._lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    self._loading.pop(user_id, None)
+
+    @contextmanager
+    def pinned(self, user_id: str) -> Iterator[TenantIndex]:
+        """
+        The user's index (created if missing), protected from eviction until
+        the block exits; its size is re-measured afterwards.
+        """
+        with self._lock:
+            tenant = self._resident.get(user_id)
+            if tenant is not None:
+                tenant.pins += 1
+        if tenant is None:
+            while True:
+                tenant = self.get(user_id, create=True)
+                with self._lock:
+                    # Evicted between loading and pinning: load it again
+                    if self._resident.get(user_id) is tenant:
+                        tenant.pins += 1
+                        break
+        try:
+            yield tenant
+        finally:
+            nbytes = _dir_bytes(self.path_for(user_id))
+            with self._lock:
+                tenant.pins -= 1
+                tenant.nbytes = nbytes
+                self._evict_locked(keep=user_id)
+
+    def _evict_locked(self, *, keep: str):
+        def over() -> bool:
+            if len(self._resident) > self.max_resident:
+                return True
+            return self.memory_budget is not None and self.resident_bytes() > self.memory_budget
+
+        for user_id in list(self._resident):
+            if not over():
+                break
+            tenant = self._resident[user_id]
+            if user_id == keep or tenant.pins or tenant.corpus.compacting:
+                continue
+            del self._resident[user_id]
+            self.evictions += 1
+
+    def resident_bytes(self) -> int:
+        return sum(t.nbytes for t in self._resident.values())
+
+    def resident(self) -> list[TenantIndex]:
+        with self._lock:
+            return list(self._resident.values())
+
+    def stats(self) -> dict:
+        try:
+            # Skip the .tmp / .old / .staging directories of a save or compaction in progress
+            on_disk = sum(
+                1 for e in os.scandir(self.root) if e.is_dir() and not e.name.endswith((".tmp", ".old", ".staging"))
+            )
+        except OSError:
+            on_disk = 0
+        with self._lock:
+            return {
+                "tenants": on_disk,
+                "resident": len(self._resident),
+                "max_resident": self.max_resident,
+                "resident_bytes": self.resident_bytes(),
+                "memory_budget_bytes": self.memory_budget,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
@@ -1,15 +1,121 @@
+import asyncio
+import time
+from operator import itemgetter
+from uuid import UUID
+
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableBranch, RunnablePassthrough
+from langchain_core.runnables import RunnableBranch, RunnableGenerator, RunnableLambda, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.callbacks import BaseCallbackHandler
+
+from app.core.metrics import bind, record, stage
+from app.rag.context import pack_context
+from app.rag.hybrid_retriever import get_retrieval_executor
+from app.rag.rewrite import QuestionRewriter
+
+def format_docs(docs, *, max_tokens: int | None = None, dedup_threshold: float = 0.85):
+    with stage("pack_context"):
+        return pack_context(docs, max_tokens=max_tokens, dedup_threshold=dedup_threshold)
+
+class LLMTimer(BaseCallbackHandler):
+    """
+    Records chat-model calls as stage `name`, and the wait for the first
+    streamed token as `name`_first_token.
+    """
+    run_inline = True
+
+    def __init__(self, name: str):
+        self.name = name
+        self._started: dict[UUID, list] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        self._started[run_id] = [time.perf_counter(), False]
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        entry = self._started.get(run_id)
+        if entry is not None and token and not entry[1]:
+            entry[1] = True
+            record(f"{self.name}_first_token", time.perf_counter() - entry[0])
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        entry = self._started.pop(run_id, None)
+        if entry is not None:
+            record(self.name, time.perf_counter() - entry[0])
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        self._started.pop(run_id, None)
 
-def format_docs(docs):
-    formatted = []
-    for doc in docs:
-        page = doc.metadata.get("source_page", "Unknown")
-        formatted.append(f"[Page {page}] {doc.page_content}")
-    return "\n\n".join(formatted)
+def build_history_summarizer(*, groq_api_key: str, model_name: str):
+    """
+    Returns summarize(previous_summary, messages) -> str, used to fold old
+    turns into a conversation's rolling summary.
+    """
+    llm = ChatGroq(groq_api_key=groq_api_key, model_name=model_name, temperature=0.0)
+
+    summary_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", """Update the running summary of a conversation between a user and an assistant 
+that answers questions about uploaded documents. Keep the facts, names, numbers and open questions 
+later turns may refer back to. Reply with the updated summary only, in at most 200 words."""),
+            ("human", "Current summary:\n{summary}\n\nNew messages:\n{transcript}"),
+        ]
+    )
+    chain = summary_prompt | llm | StrOutputParser()
+
+    def summarize(summary: str, messages) -> str:
+        transcript = "\n".join(f"{m.type}: {m.content}" for m in messages)
+        return chain.invoke({"summary": summary or "(none)", "transcript": transcript})
+
+    return summarize
+
+def _answer_chain(llm, *, context_max_tokens: int | None, context_dedup_threshold: float):
+    """
+    {"input", "docs", "chat_history"?} -> answer text, with the context
+    packed from `docs`.
+    """
+    qa_system_prompt = """You are an assistant for question-answering tasks. 
+Use the following pieces of retrieved context to answer the question. 
+If you don't know the answer, just say that you don't know. 
+Use three sentences maximum and keep the answer concise.
+
+{context}"""
+
+    qa_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", qa_system_prompt),
+            ("placeholder", "{chat_history}"),
+            ("human", "{input}"),
+        ]
+    )
+
+    return (
+        RunnablePassthrough.assign(
+            context=lambda x: format_docs(
+                x["docs"], max_tokens=context_max_tokens, dedup_threshold=context_dedup_threshold
+            )
+        )
+        | qa_prompt
+        | llm.with_config(callbacks=[LLMTimer("llm_answer")])
+        | StrOutputParser()
+    )
+
+def build_batch_answer_chain(
+    *,
+    groq_api_key: str,
+    model_name: str,
+    temperature: float,
+    context_max_tokens: int | None = 3000,
+    context_dedup_threshold: float = 0.85,
+):
+    """
+    Stateless {"input", "docs"} -> answer text for batch question answering:
+    the chat chain's prompt and context packing, without history, rewriting
+    or retrieval (the caller retrieves for the whole batch at once).
+    """
+    llm = ChatGroq(groq_api_key=groq_api_key, model_name=model_name, temperature=temperature)
+    return _answer_chain(llm, context_max_tokens=context_max_tokens, context_dedup_threshold=context_dedup_threshold)
 
 def build_conversational_rag_chain(
     *,
@@ -18,7 +124,27 @@ def build_conversational_rag_chain(
     temperature: float,
     hybrid_retriever,
     get_session_history,
+    semantic_cache=None,
+    question_rewriter: QuestionRewriter | None = None,
+    context_max_tokens: int | None = 3000,
+    context_dedup_threshold: float = 0.85,
 ):
+    """
+    Returns a chain whose output is {"answer": str, "docs": list[Document]}.
+    `docs` are exactly the documents used as context, so callers can cite
+    them without running retrieval a second time.
+
+    `question_rewriter` decides when follow-ups are condensed into a
+    standalone question (by default, every turn with history).
+
+    With a `semantic_cache`, the standalone question is looked up before
+    retrieval and a close enough match returns the cached answer and docs
+    without calling the LLM. Turns where the chat history changed the
+    question bypass it, since their answer depends on that history.
+
+    The context is packed from `docs` by `pack_context`: overlapping chunks
+    merged, near-duplicates dropped, at most `context_max_tokens`.
+    """
     llm = ChatGroq(
         groq_api_key=groq_api_key,
         model_name=model_name,
@@ -38,38 +164,76 @@ just reformulate it if needed and otherwise return it as is."""
         ]
     )
 
-    condense_question_chain = contextualize_q_prompt | llm | StrOutputParser()
+    # Timed separately from the answer so a slow rewrite shows up as such
+    condense_llm = llm.with_config(callbacks=[LLMTimer("llm_condense")])
+    condense_question_chain = contextualize_q_prompt | condense_llm | StrOutputParser()
 
-    history_aware_retriever = RunnableBranch(
-        (lambda x: bool(x.get("chat_history")), condense_question_chain | hybrid_retriever),
-        (lambda x: x["input"]) | hybrid_retriever,
+    question_rewriter = question_rewriter or QuestionRewriter()
+    standalone_question = (
+        RunnablePassthrough.assign(rewrite=question_rewriter.as_runnable(condense_question_chain, hybrid_retriever))
+        .assign(question=lambda x: x["rewrite"]["question"])
     )
 
-    qa_system_prompt = """You are an assistant for question-answering tasks. 
-Use the following pieces of retrieved context to answer the question. 
-If you don't know the answer, just say that you don't know. 
-Use three sentences maximum and keep the answer concise.
-
-{context}"""
-
-    qa_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", qa_system_prompt),
-            ("placeholder", "{chat_history}"),
-            ("human", "{input}"),
-        ]
+    answer_chain = _answer_chain(
+        llm, context_max_tokens=context_max_tokens, context_dedup_threshold=context_dedup_threshold
     )
 
-    rag_chain = (
-        RunnablePassthrough.assign(context=history_aware_retriever | format_docs)
-        | qa_prompt
-        | llm
-        | StrOutputParser()
+    # Retrieve once; the same docs feed the prompt and are returned as sources.
+    # In "parallel" rewrite mode the docs may already be there
+    retrieve = RunnableBranch(
+        (lambda x: x["rewrite"].get("docs") is not None, lambda x: x["rewrite"]["docs"]),
+        itemgetter("question") | hybrid_retriever,
     )
+    retrieve_and_answer = RunnablePassthrough.assign(docs=retrieve).assign(answer=answer_chain)
+
+    if semantic_cache is None:
+        rag_chain = standalone_question | retrieve_and_answer
+    else:
+        def lookup(x, config):
+            if not x["rewrite"]["standalone"]:
+                return None
+            # Different retrieval modes cite different passages; keep them apart
+            with stage("semantic_cache"):
+                return semantic_cache.lookup(x["question"], scope=config.get("configurable", {}).get("retrieval_mode"))
+
+        async def alookup(x, config):
+            # Embedding the question is CPU-bound; keep it off the event loop
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_retrieval_executor(), bind(lookup), x, config)
+
+        def cached_answer(x):
+            hit = x["cache"]["hit"]
+            return {"docs": hit["docs"], "answer": hit["answer"]}
+
+        def remember(chunks):
+            # Pass chunks straight through so answer tokens still stream
+            final = None
+            for chunk in chunks:
+                yield chunk
+                final = chunk if final is None else final + chunk
+            if final and final.get("cache") is not None:
+                semantic_cache.store(final["cache"], final["answer"], final["docs"])
+
+        async def aremember(chunks):
+            final = None
+            async for chunk in chunks:
+                yield chunk
+                final = chunk if final is None else final + chunk
+            if final and final.get("cache") is not None:
+                semantic_cache.store(final["cache"], final["answer"], final["docs"])
+
+        rag_chain = (
+            standalone_question.assign(cache=RunnableLambda(lookup, afunc=alookup))
+            | RunnableBranch(
+                (lambda x: bool(x["cache"] and x["cache"]["hit"]), RunnableLambda(cached_answer)),
+                retrieve_and_answer | RunnableGenerator(remember, aremember),
+            )
+        )
 
     return RunnableWithMessageHistory(
         rag_chain,
         get_session_history,
         input_messages_key="input",
         history_messages_key="chat_history",
-    )
\ No newline at end of file
+        output_messages_key="answer",
+    )
@@ -0,0 +1,500 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import uuid
+from typing import Iterable, List
+
+import numpy as np
+from langchain_core.documents import Document
+
+_ID_DTYPE = "S32"  # chunk / doc ids are 32-char hex content hashes
+_COLUMNS = {
+    "ids": _ID_DTYPE,  # sorted; row lookup is a binary search
+    "fids": np.int64,
+    "refs": np.int32,
+    "doc_ids": _ID_DTYPE,
+    "source_pages": np.int32,  # -1 = none
+    "sources": np.int32,  # index into sources.json, -1 = none
+    "text_start": np.int64,
+    "text_len": np.int64,
+    "fids_sorted": np.int64,
+    "fid_rows": np.int64,
+}
+
+
+def _key(chunk_id: str) -> bytes:
+    return chunk_id.encode("ascii")
+
+
+def _cite(metadata: dict, doc_id: str, source: str | None, page: int) -> dict:
+    """
+    Set the citation keys of chunk metadata; `page` is 1-based, -1 = none.
+    """
+    for key in ("doc_id", "source", "source_page", "page"):
+        metadata.pop(key, None)
+    if doc_id:
+        metadata["doc_id"] = doc_id
+    if source is not None:
+        metadata["source"] = source
+    if page is not None and page >= 0:
+        metadata["source_page"] = int(page)
+        metadata["page"] = int(page) - 1
+    return metadata
+
+
+def link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class _Segment:
+    """
+    Immutable chunk rows: columns sorted by chunk id, one UTF-8 text blob and
+    a source-path table. `path` is where a saved copy lives, if any.
+    """
+
+    def __init__(self, cols: dict[str, np.ndarray], texts: np.ndarray, sources: list[str], name: str, path: str | None = None):
+        self.cols = cols
+        self.texts = texts
+        self.sources = sources
+        self.name = name
+        self.path = path
+
+    def __len__(self) -> int:
+        return len(self.cols["ids"])
+
+    def row(self, chunk_id: str) -> int | None:
+        ids = self.cols["ids"]
+        key = _key(chunk_id)
+        i = int(np.searchsorted(ids, key))
+        return i if i < len(ids) and ids[i] == key else None
+
+    def row_for_fid(self, fid: int) -> int | None:
+        fids = self.cols["fids_sorted"]
+        i = int(np.searchsorted(fids, fid))
+        return int(self.cols["fid_rows"][i]) if i < len(fids) and fids[i] == fid else None
+
+    def fid(self, row: int) -> int:
+        return int(self.cols["fids"][row])
+
+    def origin(self, row: int) -> tuple[str, str | None, int]:
+        c = self.cols
+        source = self.sources[int(c["sources"][row])] if c["sources"][row] >= 0 else None
+        return c["doc_ids"][row].decode(), source, int(c["source_pages"][row])
+
+    def text(self, row: int) -> str:
+        start, length = int(self.cols["text_start"][row]), int(self.cols["text_len"][row])
+        return self.texts[start : start + length].tobytes().decode("utf-8")
+
+    @classmethod
+    def build(cls, name: str, parts: list[dict[str, np.ndarray]], blobs: list[np.ndarray], sources: list[str]) -> "_Segment":
+        """
+        Sort and index rows gathered as column `parts` over the text `blobs`.
+        """
+        cols = {name: np.concatenate([p[name] for p in parts]).astype(_COLUMNS[name]) for name in parts[0]}
+        order = np.argsort(cols["ids"], kind="stable")
+        cols = {name: col[order] for name, col in cols.items()}
+        fid_order = np.argsort(cols["fids"], kind="stable")
+        cols["fids_sorted"] = cols["fids"][fid_order]
+        cols["fid_rows"] = fid_order.astype(np.int64)
+        texts = np.concatenate(blobs) if blobs else np.zeros(0, dtype=np.uint8)
+        return cls(cols, texts, sources, name)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        if self.path is not None and os.path.isdir(self.path):
+            # Segments never change once written: link instead of copying
+            for name in os.listdir(self.path):
+                link_or_copy(os.path.join(self.path, name), os.path.join(path, name))
+            return
+        for name, col in self.cols.items():
+            np.save(os.path.join(path, f"{name}.npy"), col)
+        np.asarray(self.texts).tofile(os.path.join(path, "texts.bin"))
+        with open(os.path.join(path, "sources.json"), "w", encoding="utf-8") as f:
+            json.dump(self.sources, f)
+
+    @classmethod
+    def load(cls, path: str, name: str) -> "_Segment":
+        cols = {col: np.load(os.path.join(path, f"{col}.npy"), mmap_mode="r") for col in _COLUMNS}
+        texts_path = os.path.join(path, "texts.bin")
+        texts = np.memmap(texts_path, dtype=np.uint8, mode="r") if os.path.getsize(texts_path) else np.zeros(0, dtype=np.uint8)
+        with open(os.path.join(path, "sources.json"), "r", encoding="utf-8") as f:
+            sources = json.load(f)
+        return cls(cols, texts, sources, name, path)
+
+
+class ChunkStore:
+    """
+    Chunk text and metadata as memory-mapped columns, read lazily by id.
+
+    A saved store is a list of immutable segments (.npy columns sorted by
+    chunk id, one UTF-8 text blob, a small source-path table) plus the
+    changes made to their rows since: removed rows, reference counts and
+    citations. Loading only maps the files, so boot cost and resident memory
+    do not grow with the corpus. Rows are found by binary search (by chunk
+    id or FAISS id) and turned into Documents on demand.
+
+    Chunks added since the last save live in an in-memory overlay, which the
+    next save writes as a new segment; segments already on disk are
+    hard-linked, so a save costs what changed. Merging (`merge_plan`,
+    `build_merge`, `install_merge`) folds segments and accumulated changes
+    together, and only needs the write lock to swap the result in.
+
+    Each chunk also carries a reference count: the number of documents that
+    contain it, and the one of them it is cited from (doc id, source, page).
+    """
+
+    def __init__(self, *, max_segments: int = 8):
+        self.max_segments = max_segments
+        self.segments: list[_Segment] = []
+        # Changes to segment rows, keyed by FAISS id (unique for all time)
+        self._dropped: set[int] = set()
+        self._refs: dict[int, int] = {}
+        self._origins: dict[int, tuple[str, str | None, int]] = {}
+        # Overlay: chunk_id -> [Document, fid, refs]
+        self._new: dict[str, list] = {}
+        self._new_by_fid: dict[int, str] = {}
+
+    # ---- Lookup ----
+    def _find(self, chunk_id: str) -> tuple[_Segment, int] | None:
+        for seg in self.segments:
+            row = seg.row(chunk_id)
+            if row is not None and seg.fid(row) not in self._dropped:
+                return seg, row
+        return None
+
+    def _find_fid(self, fid: int) -> tuple[_Segment, int] | None:
+        if fid in self._dropped:
+            return None
+        for seg in self.segments:
+            row = seg.row_for_fid(fid)
+            if row is not None:
+                return seg, row
+        return None
+
+    def _origin(self, seg: _Segment, row: int) -> tuple[str, str | None, int]:
+        return self._origins.get(seg.fid(row)) or seg.origin(row)
+
+    def _document(self, seg: _Segment, row: int) -> Document:
+        return Document(
+            page_content=seg.text(row),
+            metadata=_cite({"chunk_id": seg.cols["ids"][row].decode()}, *self._origin(seg, row)),
+        )
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self._new or self._find(chunk_id) is not None
+
+    def __len__(self) -> int:
+        return sum(len(seg) for seg in self.segments) - len(self._dropped) + len(self._new)
+
+    def get(self, chunk_id: str) -> Document | None:
+        entry = self._new.get(chunk_id)
+        if entry is not None:
+            return entry[0]
+        found = self._find(chunk_id)
+        return self._document(*found) if found is not None else None
+
+    def get_by_fid(self, fid: int) -> Document | None:
+        cid = self._new_by_fid.get(fid)
+        if cid is not None:
+            return self._new[cid][0]
+        found = self._find_fid(fid)
+        return self._document(*found) if found is not None else None
+
+    def fid(self, chunk_id: str) -> int | None:
+        entry = self._new.get(chunk_id)
+        if entry is not None:
+            return entry[1]
+        found = self._find(chunk_id)
+        return found[0].fid(found[1]) if found is not None else None
+
+    def origin(self, chunk_id: str) -> str | None:
+        """
+        The doc id the chunk is cited from.
+        """
+        entry = self._new.get(chunk_id)
+        if entry is not None:
+            return entry[0].metadata.get("doc_id")
+        found = self._find(chunk_id)
+        return self._origin(*found)[0] if found is not None else None
+
+    def live_fids(self) -> np.ndarray:
+        parts = [np.asarray(seg.cols["fids"]) for seg in self.segments]
+        fids = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        if self._dropped:
+            fids = fids[~np.isin(fids, np.fromiter(self._dropped, dtype=np.int64, count=len(self._dropped)))]
+        return np.concatenate([fids, np.fromiter(self._new_by_fid, dtype=np.int64, count=len(self._new_by_fid))])
+
+    # ---- Updates ----
+    def add(self, chunks: List[Document], fids: Iterable[int]):
+        for chunk, fid in zip(chunks, fids):
+            cid = chunk.metadata["chunk_id"]
+            self._new[cid] = [chunk, int(fid), 0]
+            self._new_by_fid[int(fid)] = cid
+
+    def remove(self, chunk_ids: Iterable[str]) -> list[int]:
+        """
+        Drops the chunks; returns the FAISS ids they had.
+        """
+        fids = []
+        for cid in chunk_ids:
+            entry = self._new.pop(cid, None)
+            if entry is not None:
+                self._new_by_fid.pop(entry[1], None)
+                fids.append(entry[1])
+                continue
+            found = self._find(cid)
+            if found is not None:
+                fid = found[0].fid(found[1])
+                self._dropped.add(fid)
+                self._refs.pop(fid, None)
+                self._origins.pop(fid, None)
+                fids.append(fid)
+        return fids
+
+    def _adjust_refs(self, chunk_id: str, delta: int) -> int | None:
+        entry = self._new.get(chunk_id)
+        if entry is not None:
+            entry[2] += delta
+            return entry[2]
+        found = self._find(chunk_id)
+        if found is None:
+            return None
+        seg, row = found
+        fid = seg.fid(row)
+        refs = self._refs[fid] = self._refs.get(fid, int(seg.cols["refs"][row])) + delta
+        return refs
+
+    def incref(self, chunk_ids: Iterable[str]):
+        """
+        Raises KeyError for a chunk that is not stored: a reference to it
+        would point at nothing.
+        """
+        for cid in chunk_ids:
+            if self._adjust_refs(cid, 1) is None:
+                raise KeyError(cid)
+
+    def decref(self, chunk_ids: Iterable[str]) -> list[str]:
+        """
+        Returns the chunks no document references any more.
+        """
+        return [cid for cid in chunk_ids if self._adjust_refs(cid, -1) == 0]
+
+    def refcount(self, chunk_id: str) -> int:
+        entry = self._new.get(chunk_id)
+        if entry is not None:
+            return entry[2]
+        found = self._find(chunk_id)
+        if found is None:
+            return 0
+        seg, row = found
+        return self._refs.get(seg.fid(row), int(seg.cols["refs"][row]))
+
+    def set_origin(self, chunk_ids: Iterable[str], doc_id: str, source: str | None, pages: Iterable[int]):
+        """
+        Cite the chunks from `doc_id`, at the given 1-based pages (-1 = none).
+        """
+        for cid, page in zip(chunk_ids, pages):
+            entry = self._new.get(cid)
+            if entry is not None:
+                doc = entry[0]
+                entry[0] = Document(page_content=doc.page_content, metadata=_cite(dict(doc.metadata), doc_id, source, page))
+                continue
+            found = self._find(cid)
+            if found is not None:
+                self._origins[found[0].fid(found[1])] = (doc_id, source, int(page))
+
+    # ---- Merging ----
+    def merge_due(self) -> bool:
+        rows = sum(len(seg) for seg in self.segments)
+        changed = len(self._dropped) + len(self._refs) + len(self._origins)
+        return len(self.segments) > self.max_segments or changed > max(1000, rows // 10)
+
+    def merge_plan(self) -> dict | None:
+        """
+        What `build_merge` needs, captured under the caller's read lock:
+        every segment once changes pile up, else all but a dominant one
+        (over half the rows), which keeps merge cost amortized.
+        """
+        if not self.merge_due():
+            return None
+        sizes = [len(seg) for seg in self.segments]
+        changed = len(self._dropped) + len(self._refs) + len(self._origins)
+        largest = int(np.argmax(sizes))
+        keep = largest if sizes[largest] * 2 > sum(sizes) and changed <= max(1000, sum(sizes) // 10) else None
+        chosen = [seg for i, seg in enumerate(self.segments) if i != keep]
+        if len(chosen) < 2 and not changed:
+            return None
+        return {
+            "segments": chosen,
+            "dropped": set(self._dropped),
+            "refs": dict(self._refs),
+            "origins": dict(self._origins),
+        }
+
+    @staticmethod
+    def build_merge(plan: dict, path: str) -> dict:
+        """
+        One segment holding the live rows of the planned segments, with the
+        planned changes folded in, saved under `path`. Needs no lock: it only
+        reads immutable segments and the plan's copies.
+        """
+        dropped = np.fromiter(plan["dropped"], dtype=np.int64, count=len(plan["dropped"]))
+        sources: list[str] = []
+        source_idx: dict[str, int] = {}
+        parts, blobs, folded = [], [], set()
+        offset = 0
+        for seg in plan["segments"]:
+            c = {name: np.asarray(seg.cols[name]) for name in _COLUMNS}
+            keep = ~np.isin(c["fids"], dropped)
+            folded.update(c["fids"][~keep].tolist())
+
+            # This segment's source table, re-indexed into the merged one;
+            # the extra last entry keeps -1 (no source) at -1
+            remap = np.full(len(seg.sources) + 1, -1, dtype=np.int32)
+            for i, src in enumerate(seg.sources):
+                if src not in source_idx:
+                    source_idx[src] = len(sources)
+                    sources.append(src)
+                remap[i] = source_idx[src]
+            part = {
+                "ids": c["ids"][keep],
+                "fids": c["fids"][keep],
+                "refs": c["refs"][keep].copy(),
+                "doc_ids": c["doc_ids"][keep].copy(),
+                "source_pages": c["source_pages"][keep].copy(),
+                "sources": remap[c["sources"][keep]],
+            }
+            overridden = np.fromiter(set(plan["refs"]) | set(plan["origins"]), dtype=np.int64)
+            for row in np.flatnonzero(np.isin(part["fids"], overridden)).tolist():
+                fid = int(part["fids"][row])
+                folded.add(fid)
+                if fid in plan["refs"]:
+                    part["refs"][row] = plan["refs"][fid]
+                origin = plan["origins"].get(fid)
+                if origin is not None:
+                    doc_id, src, page = origin
+                    if src is not None and src not in source_idx:
+                        source_idx[src] = len(sources)
+                        sources.append(src)
+                    part["doc_ids"][row] = doc_id.encode("ascii")
+                    part["sources"][row] = source_idx[src] if src is not None else -1
+                    part["source_pages"][row] = page
+
+            # Compact the kept rows' text with one gather
+            starts, lens = c["text_start"][keep], c["text_len"][keep]
+            new_starts = np.zeros(len(lens), dtype=np.int64)
+            if len(lens):
+                np.cumsum(lens[:-1], out=new_starts[1:])
+            gather = np.repeat(starts - new_starts, lens) + np.arange(int(lens.sum()), dtype=np.int64)
+            blobs.append(np.asarray(seg.texts)[gather])
+            part["text_start"] = new_starts + offset
+            part["text_len"] = lens
+            offset += int(lens.sum())
+            parts.append(part)
+
+        name = f"seg_{uuid.uuid4().hex[:12]}"
+        merged = _Segment.build(name, parts, blobs, sources)
+        merged.save(os.path.join(path, name))
+        merged.path = os.path.join(path, name)
+        return {"segment": merged, "folded": folded}
+
+    def install_merge(self, plan: dict, built: dict):
+        """
+        Swap the merged segment in (caller holds the write lock). Changes
+        made since the plan was taken stay recorded against the same rows.
+        """
+        replaced = {seg.name for seg in plan["segments"]}
+        self.segments = [seg for seg in self.segments if seg.name not in replaced] + [built["segment"]]
+        for fid in built["folded"]:
+            if fid in plan["dropped"]:
+                self._dropped.discard(fid)
+            if fid in self._refs and self._refs[fid] == plan["refs"].get(fid):
+                del self._refs[fid]
+            if fid in self._origins and self._origins[fid] == plan["origins"].get(fid):
+                del self._origins[fid]
+
+    # ---- Persistence ----
+    def save(self, path: str):
+        """
+        Link the saved segments, write the overlay as a new segment, and
+        record the changes to segment rows.
+        """
+        os.makedirs(path, exist_ok=True)
+        names = []
+        for seg in self.segments:
+            seg.save(os.path.join(path, seg.name))
+            names.append(seg.name)
+
+        if self._new:
+            sources: list[str] = []
+            source_idx: dict[str, int] = {}
+            rows: dict[str, list] = {name: [] for name in _COLUMNS if name not in ("fids_sorted", "fid_rows")}
+            blobs, offset = [], 0
+            for cid, (doc, fid, refs) in self._new.items():
+                text = doc.page_content.encode("utf-8")
+                src = doc.metadata.get("source")
+                if src is not None and src not in source_idx:
+                    source_idx[src] = len(sources)
+                    sources.append(src)
+                page = doc.metadata.get("source_page")
+                rows["ids"].append(_key(cid))
+                rows["fids"].append(fid)
+                rows["refs"].append(refs)
+                rows["doc_ids"].append((doc.metadata.get("doc_id") or "").encode("ascii"))
+                rows["source_pages"].append(page if isinstance(page, int) else -1)
+                rows["sources"].append(source_idx[src] if src is not None else -1)
+                rows["text_start"].append(offset)
+                rows["text_len"].append(len(text))
+                blobs.append(np.frombuffer(text, dtype=np.uint8))
+                offset += len(text)
+            part = {name: np.asarray(values, dtype=_COLUMNS[name]) for name, values in rows.items()}
+            seg = _Segment.build(f"seg_{uuid.uuid4().hex[:12]}", [part], blobs, sources)
+            seg.save(os.path.join(path, seg.name))
+            names.append(seg.name)
+
+        ref_fids = np.fromiter(self._refs, dtype=np.int64, count=len(self._refs))
+        origin_fids = np.fromiter(self._origins, dtype=np.int64, count=len(self._origins))
+        origins = list(self._origins.values())
+        np.savez(
+            os.path.join(path, "changes.npz"),
+            dropped=np.fromiter(self._dropped, dtype=np.int64, count=len(self._dropped)),
+            ref_fids=ref_fids,
+            refs=np.asarray([self._refs[f] for f in ref_fids.tolist()], dtype=np.int32),
+            origin_fids=origin_fids,
+            origin_docs=np.asarray([o[0] for o in origins], dtype=_ID_DTYPE),
+            origin_pages=np.asarray([o[2] for o in origins], dtype=np.int32),
+        )
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"segments": names, "origin_sources": [o[1] for o in origins]}, f)
+
+    def saved(self, path: str):
+        """
+        Note that the segments now have a saved copy under `path`.
+        """
+        for seg in self.segments:
+            seg.path = os.path.join(path, seg.name)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "ChunkStore":
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        store = cls(**kwargs)
+        store.segments = [_Segment.load(os.path.join(path, name), name) for name in meta["segments"]]
+        with np.load(os.path.join(path, "changes.npz")) as changes:
+            store._dropped = set(changes["dropped"].tolist())
+            store._refs = dict(zip(changes["ref_fids"].tolist(), changes["refs"].tolist()))
+            store._origins = {
+                fid: (doc.decode(), src, page)
+                for fid, doc, src, page in zip(
+                    changes["origin_fids"].tolist(),
+                    changes["origin_docs"].tolist(),
+                    meta["origin_sources"],
+                    changes["origin_pages"].tolist(),
+                )
+            }
+        return store
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import re
+from typing import List
+
+from langchain_core.documents import Document
+
+from app.core.tokens import approx_tokens
+
+_WORD_RE = re.compile(r"\w+")
+# Overlap probes: chunks share at most chunk_overlap characters, which is
+# well under a chunk's length
+_MIN_OVERLAP = 24
+_MAX_OVERLAP = 1000
+
+
+def _overlap(a: str, b: str) -> int:
+    """
+    Length of the longest suffix of `a` that is a prefix of `b`, if at least
+    _MIN_OVERLAP characters; else 0.
+    """
+    if len(b) < _MIN_OVERLAP:
+        return 0
+    probe = b[:_MIN_OVERLAP]
+    pos = a.find(probe, max(0, len(a) - _MAX_OVERLAP))
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(probe, pos + 1)
+    return 0
+
+
+def _merge(a: str, b: str) -> str | None:
+    if b in a:
+        return a
+    if a in b:
+        return b
+    k = _overlap(a, b)
+    if k:
+        return a + b[k:]
+    k = _overlap(b, a)
+    if k:
+        return b + a[k:]
+    return None
+
+
+def _shingles(text: str, n: int = 3) -> frozenset:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < n:
+        return frozenset([tuple(words)])
+    return frozenset(zip(*(words[i:] for i in range(n))))
+
+
+def _covered(new: frozenset, seen: frozenset) -> float:
+    # Share of the new passage's 3-grams already in an earlier passage
+    if not new:
+        return 1.0
+    return len(new & seen) / len(new)
+
+
+class _Passage:
+    __slots__ = ("key", "page", "text", "shingles")
+
+    def __init__(self, key, page, text: str):
+        self.key = key
+        self.page = page
+        self.text = text
+        self.shingles = _shingles(text)
+
+
+def pack_context(docs: List[Document], *, max_tokens: int | None = 3000, dedup_threshold: float = 0.85) -> str:
+    """
+    Builds the prompt context from retrieved chunks, most relevant first:
+    chunks from the same page that overlap (neighbours from the splitter) are
+    merged into one passage without the repeated text, passages whose word
+    3-grams are mostly (`dedup_threshold`) in an earlier passage are
+    dropped, and passages are added while they fit in `max_tokens`. Each
+    passage keeps its "[Page N]" prefix.
+    """
+    passages: list[_Passage] = []
+    for doc in docs:
+        text = doc.page_content.strip()
+        if not text:
+            continue
+        page = doc.metadata.get("source_page", "Unknown")
+        key = (doc.metadata.get("doc_id") or doc.metadata.get("source"), page)
+
+        target = None
+        for p in passages:
+            if p.key == key and (combined := _merge(p.text, text)) is not None:
+                target, p.text = p, combined
+                break
+        if target is None:
+            shingles = _shingles(text)
+            if any(_covered(shingles, p.shingles) >= dedup_threshold for p in passages):
+                continue
+            passages.append(_Passage(key, page, text))
+            continue
+
+        # The grown passage may now bridge to a later one from the same page
+        for p in list(passages):
+            if p is not target and p.key == key and (combined := _merge(target.text, p.text)) is not None:
+                target.text = combined
+                passages.remove(p)
+        target.shingles = _shingles(target.text)
+
+    formatted: list[str] = []
+    budget = max_tokens
+    for p in passages:
+        block = f"[Page {p.page}] {p.text}"
+        if budget is None:
+            formatted.append(block)
+            continue
+        cost = approx_tokens(block)
+        if cost <= budget:
+            formatted.append(block)
+            budget -= cost
+        elif not formatted:
+            # Always ground on something: cut the best passage to the budget
+            formatted.append(block[: budget * 4])
+            budget = 0
+    return "\n\n".join(formatted)
@@ -0,0 +1,719 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, List, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from app.core.metrics import stage
+from app.rag.bm25_index import BM25Index
+from app.rag.chunk_store import ChunkStore, link_or_copy
+from app.rag.query_cache import LRUCache, normalize_query
+from app.rag.vectorstore_faiss import ChunkVectorStore, load_vector_store, save_vector_store
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class _RWLock:
+    """
+    Many concurrent searches, one writer. Writers only hold it for the
+    in-memory apply step; embedding happens before the lock is taken.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+MANIFEST_VERSION = 4
+
+# One compaction at a time across all corpora; it is CPU- and disk-heavy
+_compact_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-compact")
+# Document chunk-list segments allowed before they are merged
+MAX_DOC_SEGMENTS = 8
+
+
+class ChunksNotIndexed(KeyError):
+    """
+    A document references chunks that are neither indexed nor supplied,
+    typically because a concurrent removal dropped them after `missing()`
+    was checked. Embed `chunk_ids` and apply the document again.
+    """
+
+    def __init__(self, chunk_ids: List[str]):
+        super().__init__(chunk_ids)
+        self.chunk_ids = chunk_ids
+
+
+def _chunk_id_list(ids) -> List[str]:
+    """
+    Document chunk ids are a list after ingestion and a mapped S32 array
+    after a restore.
+    """
+    return [c.decode() if isinstance(c, bytes) else c for c in ids]
+
+
+class CorpusIndex:
+    """
+    FAISS + BM25 over content-deduplicated chunks, updated in place.
+
+    Chunks are keyed by the hash of their text (`metadata["chunk_id"]`), so
+    re-uploading a PDF or overlapping pages only embeds what is new. Each
+    document records the chunk ids it references and the page of each, and
+    each chunk counts the documents referencing it; a chunk is dropped from
+    both indexes once that count reaches zero. A chunk is cited from one of
+    the documents that reference it: the first to add it, then the newest
+    remaining one once that document is removed or replaced.
+
+    `save()` writes a manifest (format version, embedding model, chunk count,
+    sources) next to the indexes, and `load()` restores from it with every
+    large structure memory-mapped. Saved data is append-only: a save writes
+    what changed since the previous one as new segments and hard-links the
+    rest. `compact()` rebuilds the vector index and merges segments once
+    they pile up; it is scheduled in the background when due.
+
+    `version` increases with every applied change, so caches of search
+    results can key on it. Query embeddings are cached in `query_vectors`.
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        path: str,
+        *,
+        model_name: str | None = None,
+        index_type: str = "auto",
+        nprobe: int = 8,
+        ef_search: int = 64,
+        hnsw_m: int = 32,
+        query_vectors: LRUCache | None = None,
+    ):
+        self.embedding_model = embedding_model
+        self.path = path
+        self.model_name = model_name
+        self.index_type = index_type
+        self.search_defaults = {"nprobe": nprobe, "ef_search": ef_search, "hnsw_m": hnsw_m}
+        self.vector_store: ChunkVectorStore | None = None
+        self.bm25 = BM25Index()
+        self.documents: dict[str, dict[str, Any]] = {}
+        self.query_vectors = query_vectors if query_vectors is not None else LRUCache(maxsize=0)
+        self.version = 0
+        self._lock = _RWLock()
+        self._save_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._compaction: Future | None = None
+        # Saved document chunk-list segments: name -> directory, row count
+        self._doc_files: dict[str, str] = {}
+        self._doc_rows: dict[str, int] = {}
+
+    # ---- Ingestion ----
+    @staticmethod
+    def tag_chunk(chunk: Document, doc_id: str) -> str:
+        """
+        Sets `chunk_id` (content hash) and `doc_id` on the chunk; returns the id.
+        """
+        cid = content_hash(chunk.page_content)
+        chunk.metadata["chunk_id"] = cid
+        chunk.metadata["doc_id"] = doc_id
+        return cid
+
+    def _indexed(self, chunk_id: str) -> bool:
+        return self.vector_store is not None and chunk_id in self.vector_store.chunks
+
+    def missing(self, chunks: List[Document]) -> List[Document]:
+        """
+        Chunks not yet in the index; only these need embedding.
+        """
+        with self._lock.read():
+            return [c for c in chunks if not self._indexed(c.metadata["chunk_id"])]
+
+    def add_document(
+        self,
+        doc_id: str,
+        chunk_ids: List[str],
+        new_chunks: List[Document],
+        vectors: List[List[float]],
+        *,
+        pages: int,
+        source: str | None = None,
+        user_id: str | None = None,
+        replaces: List[str] | None = None,
+        chunk_pages: List[int] | None = None,
+    ) -> dict:
+        """
+        Applies one document atomically: readers see the corpus either before
+        or after the whole document (and any documents it replaces).
+        `chunk_pages` are the 1-based pages of `chunk_ids` (-1 = unknown).
+        Raises ChunksNotIndexed, without changing anything, if `chunk_ids`
+        names chunks that are neither indexed nor in `new_chunks`.
+        """
+        if chunk_pages is None:
+            chunk_pages = [-1] * len(chunk_ids)
+        chunk_pages = np.asarray(chunk_pages, dtype=np.int32)
+        with self._lock.write():
+            # A concurrent job may have added some of these chunks meanwhile
+            fresh = [(c, v) for c, v in zip(new_chunks, vectors) if not self._indexed(c.metadata["chunk_id"])]
+            supplied = {c.metadata["chunk_id"] for c, _ in fresh}
+            absent = [cid for cid in chunk_ids if cid not in supplied and not self._indexed(cid)]
+            if absent:
+                raise ChunksNotIndexed(absent)
+
+            if fresh:
+                fresh_chunks = [c for c, _ in fresh]
+                fresh_vectors = [v for _, v in fresh]
+                if self.vector_store is None:
+                    self.vector_store = ChunkVectorStore.create(
+                        self.embedding_model,
+                        fresh_chunks,
+                        fresh_vectors,
+                        index_type=self.index_type,
+                        **self.search_defaults,
+                    )
+                else:
+                    self.vector_store.add(fresh_chunks, fresh_vectors)
+                self.bm25.add_many((c.metadata["chunk_id"], c.page_content) for c in fresh_chunks)
+                # Cite this document, whichever one the chunk objects came from
+                page_of = dict(zip(chunk_ids, chunk_pages.tolist()))
+                fresh_ids = [c.metadata["chunk_id"] for c in fresh_chunks]
+                self.vector_store.chunks.set_origin(fresh_ids, doc_id, source, [page_of[cid] for cid in fresh_ids])
+
+            # Re-added last, so it counts as the newest document
+            prev = self.documents.pop(doc_id, None)
+            self.documents[doc_id] = {
+                "source": source,
+                "user_id": user_id,
+                "pages": pages,
+                "chunk_ids": list(chunk_ids),
+                "chunk_pages": chunk_pages,
+                "segment": None,
+            }
+            if self.vector_store is not None:
+                chunks = self.vector_store.chunks
+                # Reference the new chunks before releasing anything, so
+                # chunks shared with the replaced versions stay indexed
+                chunks.incref(chunk_ids)
+                if prev:
+                    prev_ids = _chunk_id_list(prev["chunk_ids"])
+                    self._drop_chunks(chunks.decref(prev_ids))
+                    # Source and pages may differ from the previous version
+                    self._repoint(prev_ids, doc_id)
+            for old_id in replaces or []:
+                if old_id != doc_id and old_id in self.documents:
+                    self._remove_locked(old_id)
+
+            self.version += 1
+            self._compact_if_due()
+
+        return {
+            "doc_id": doc_id,
+            "chunks": len(chunk_ids),
+            "added": len(fresh),
+            "duplicates": len(chunk_ids) - len(fresh),
+            "already_indexed": prev is not None,
+        }
+
+    def remove_document(self, doc_id: str) -> dict:
+        with self._lock.write():
+            removed = self._remove_locked(doc_id)
+            self.version += 1
+            self._compact_if_due()
+        return {"doc_id": doc_id, "removed_chunks": removed}
+
+    def _remove_locked(self, doc_id: str) -> int:
+        doc = self.documents.pop(doc_id, None)
+        if doc is None:
+            raise KeyError(doc_id)
+        if self.vector_store is None:
+            return 0
+        chunk_ids = _chunk_id_list(doc["chunk_ids"])
+        orphaned = self.vector_store.chunks.decref(chunk_ids)
+        self._drop_chunks(orphaned)
+        self._repoint(chunk_ids, doc_id)
+        return len(orphaned)
+
+    def _repoint(self, chunk_ids: List[str], doc_id: str):
+        """
+        Cite chunks that `doc_id` no longer vouches for from the newest
+        document still referencing them.
+        """
+        chunks = self.vector_store.chunks
+        stale = {cid for cid in chunk_ids if chunks.origin(cid) == doc_id}
+        for other_id in reversed(self.documents):
+            if not stale:
+                break
+            other = self.documents[other_id]
+            ids = np.asarray(other["chunk_ids"], dtype="S32")
+            rows = np.flatnonzero(np.isin(ids, np.asarray(sorted(stale), dtype="S32")))
+            if not len(rows):
+                continue
+            found = [ids[r].decode() for r in rows]
+            chunks.set_origin(found, other_id, other["source"], np.asarray(other["chunk_pages"])[rows].tolist())
+            stale.difference_update(found)
+
+    def _drop_chunks(self, chunk_ids: List[str]):
+        if not chunk_ids:
+            return
+        for cid in chunk_ids:
+            d = self.vector_store.get(cid)
+            if d is not None:
+                self.bm25.remove(cid, d.page_content)
+        self.vector_store.delete(chunk_ids)
+
+    def find_documents(self, *, source: str) -> List[str]:
+        with self._lock.read():
+            return [doc_id for doc_id, d in self.documents.items() if d["source"] == source]
+
+    # ---- Persistence ----
+    def save(self):
+        """
+        Write the corpus to `path`, then serve it from the saved files.
+
+        Files are written under the read lock, so searches keep running.
+        Switching to the mapped copies happens under the write lock, and only
+        if no change was applied meanwhile; otherwise the next save does it.
+        Only what changed since the previous save is written (new vectors,
+        chunks, postings and chunk lists, plus the small change logs); the
+        rest is hard-linked, so a save costs what changed.
+        """
+        with self._save_lock:
+            with self._lock.read():
+                if self.vector_store is None:
+                    return
+                saved_version = self.version
+                documents = self._write_locked()
+            with self._lock.write():
+                if self.version != saved_version:
+                    return
+                # Serve postings, chunk text and chunk lists from the saved
+                # files instead of process memory
+                self.bm25.attach(os.path.join(self.path, "bm25"))
+                self.vector_store.attach(self.path)
+                self.documents = self._attach_documents(self.path, documents)
+                self._compact_if_due()
+
+    def _write_locked(self) -> dict[str, dict[str, Any]]:
+        """
+        Writes every file under `path` (caller holds the read lock); returns
+        the manifest's document table for `_attach_documents`.
+        """
+        documents: dict[str, dict[str, Any]] = {}
+        # Chunk lists of documents added since the last save form a new segment
+        fresh = f"docs_{uuid.uuid4().hex[:12]}"
+        fresh_ids: list[np.ndarray] = []
+        fresh_pages: list[np.ndarray] = []
+        offset = 0
+        for doc_id, d in self.documents.items():
+            segment, chunk_range = d["segment"], d.get("chunk_range")
+            if segment not in self._doc_files or not os.path.isdir(self._doc_files[segment]):
+                ids = np.asarray(d["chunk_ids"], dtype="S32")
+                fresh_ids.append(ids)
+                fresh_pages.append(np.asarray(d["chunk_pages"], dtype=np.int32))
+                segment, chunk_range = fresh, [offset, offset + len(ids)]
+                offset += len(ids)
+            documents[doc_id] = {
+                "source": d["source"],
+                "user_id": d["user_id"],
+                "pages": d["pages"],
+                "segment": segment,
+                "chunk_range": chunk_range,
+            }
+        doc_segments = {d["segment"]: self._doc_rows.get(d["segment"], offset) for d in documents.values()}
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "index_version": self.version,
+            "embedding_model": self.model_name,
+            "dim": int(self.vector_store.index.d),
+            "index_type": self.vector_store.index_type,
+            "chunks": len(self.vector_store),
+            "sources": sorted({d["source"] for d in documents.values() if d["source"]}),
+            "documents": documents,
+            "doc_segments": doc_segments,
+            "saved_at": time.time(),
+        }
+        bm25_dir = os.path.join(self.path, "bm25")
+
+        def write_extra(tmp: str):
+            for name in doc_segments:
+                seg_dir = os.path.join(tmp, "docs", name)
+                os.makedirs(seg_dir)
+                if name == fresh:
+                    np.save(os.path.join(seg_dir, "chunks.npy"), np.concatenate(fresh_ids))
+                    np.save(os.path.join(seg_dir, "pages.npy"), np.concatenate(fresh_pages))
+                else:
+                    for f in ("chunks.npy", "pages.npy"):
+                        link_or_copy(os.path.join(self._doc_files[name], f), os.path.join(seg_dir, f))
+            self.bm25.save(os.path.join(tmp, "bm25"), previous=bm25_dir if os.path.isdir(bm25_dir) else None)
+
+        save_vector_store(self.vector_store, self.path, manifest=manifest, write_extra=write_extra)
+        # Saved copies now live under `path`; the next save links them
+        self._doc_files = {name: os.path.join(self.path, "docs", name) for name in doc_segments}
+        self._doc_rows = doc_segments
+        return documents
+
+    @staticmethod
+    def _attach_documents(path: str, documents: dict[str, dict[str, Any]]) -> dict[str, dict[str, Any]]:
+        segments: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        attached = {}
+        for doc_id, d in documents.items():
+            name = d["segment"]
+            if name not in segments:
+                seg_dir = os.path.join(path, "docs", name)
+                segments[name] = (
+                    np.load(os.path.join(seg_dir, "chunks.npy"), mmap_mode="r"),
+                    np.load(os.path.join(seg_dir, "pages.npy"), mmap_mode="r"),
+                )
+            start, end = d["chunk_range"]
+            attached[doc_id] = {
+                "source": d["source"],
+                "user_id": d["user_id"],
+                "pages": d["pages"],
+                "chunk_ids": segments[name][0][start:end],
+                "chunk_pages": segments[name][1][start:end],
+                "segment": name,
+                "chunk_range": [start, end],
+            }
+        return attached
+
+    @classmethod
+    def load(cls, embedding_model, path: str, *, model_name: str | None = None, **kwargs) -> "CorpusIndex | None":
+        """
+        Restore a saved corpus, or None if nothing was saved at `path`.
+        Raises ValueError if the saved index can't be served as-is (older
+        format, different embedding model, or inconsistent files).
+        """
+        manifest_path = os.path.join(path, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Index at '{path}' has format version {manifest.get('version')}, expected {MANIFEST_VERSION}")
+        if model_name and manifest.get("embedding_model") not in (None, model_name):
+            raise ValueError(f"Index at '{path}' was built with '{manifest['embedding_model']}', not '{model_name}'")
+
+        corpus = cls(embedding_model, path, model_name=model_name, **kwargs)
+        corpus.vector_store = load_vector_store(embedding_model, path, **corpus.search_defaults)
+        if len(corpus.vector_store) != manifest["chunks"]:
+            raise ValueError(f"Index at '{path}' has {len(corpus.vector_store)} chunks, manifest says {manifest['chunks']}")
+        corpus.bm25 = BM25Index.load(os.path.join(path, "bm25"))
+        corpus.documents = cls._attach_documents(path, manifest["documents"])
+        corpus._doc_rows = manifest["doc_segments"]
+        corpus._doc_files = {name: os.path.join(path, "docs", name) for name in corpus._doc_rows}
+        corpus.version = int(manifest.get("index_version", 0))
+        return corpus
+
+    # ---- Compaction ----
+    def _compaction_due(self) -> bool:
+        vs = self.vector_store
+        if vs is None:
+            return False
+        return vs.needs_rebuild(self.index_type) or vs.chunks.merge_due() or self._docs_merge_plan() is not None
+
+    def _compact_if_due(self):
+        """
+        Schedule `compact()` in the background (caller holds the lock).
+        """
+        if not self._compaction_due():
+            return
+        pending = self._compaction
+        if pending is not None and not pending.running() and not pending.done():
+            return  # already queued; it will see the latest state
+        self._compaction = _compact_executor.submit(self._compact_logged)
+
+    def _compact_logged(self):
+        try:
+            self.compact()
+        except Exception:
+            logger.exception("Compacting the index at %s failed", self.path)
+
+    @property
+    def compacting(self) -> bool:
+        return self._compaction is not None and not self._compaction.done()
+
+    def compact(self) -> bool:
+        """
+        Rebuild the vector index (for the current size, without tombstones)
+        and merge chunk and document segments where due, then save. The
+        heavy work runs on snapshots taken under the read lock; only swapping
+        the results in takes the write lock, so searches and ingestion keep
+        running. Returns whether anything was compacted.
+        """
+        with self._compact_lock:
+            with self._lock.read():
+                if self.vector_store is None:
+                    return False
+                vs = self.vector_store
+                vectors = vs.compaction_plan() if vs.needs_rebuild(self.index_type) else None
+                chunks = vs.chunks.merge_plan()
+                docs = self._docs_merge_plan()
+            if vectors is None and chunks is None and docs is None:
+                return False
+
+            staging = os.path.join(f"{self.path}.staging", uuid.uuid4().hex[:12])
+            os.makedirs(staging)
+            built_vectors = vs.build_compaction(vectors, self.index_type, staging) if vectors else None
+            built_chunks = ChunkStore.build_merge(chunks, staging) if chunks else None
+            built_docs = self._build_docs_merge(docs, staging) if docs else None
+            with self._lock.write():
+                if built_vectors:
+                    vs.install_compaction(vectors, built_vectors)
+                if built_chunks:
+                    vs.chunks.install_merge(chunks, built_chunks)
+                if built_docs:
+                    self._install_docs_merge(docs, built_docs)
+                # Same content, but results (and saved files) may differ
+                self.version += 1
+            self.save()
+            # The save linked the staged files into `path`
+            shutil.rmtree(staging, ignore_errors=True)
+            return True
+
+    def _docs_merge_plan(self) -> dict | None:
+        """
+        Document chunk-list segments to merge once there are more than
+        MAX_DOC_SEGMENTS or most of their rows belong to removed documents:
+        all of them, or all but a dominant one (over half the live rows).
+        """
+        live = Counter()
+        for d in self.documents.values():
+            if d["segment"] in self._doc_rows:
+                live[d["segment"]] += len(d["chunk_ids"])
+        if not live:
+            return None
+        live_rows = sum(live.values())
+        garbage = sum(self._doc_rows[name] for name in live) - live_rows
+        if len(live) <= MAX_DOC_SEGMENTS and garbage <= max(1000, live_rows):
+            return None
+        largest = max(live, key=live.get)
+        keep = largest if live[largest] * 2 > live_rows and garbage <= max(1000, live_rows) else None
+        return {
+            "documents": {
+                doc_id: d for doc_id, d in self.documents.items() if d["segment"] in live and d["segment"] != keep
+            }
+        }
+
+    @staticmethod
+    def _build_docs_merge(plan: dict, path: str) -> dict:
+        name = f"docs_{uuid.uuid4().hex[:12]}"
+        ids, pages, ranges = [], [], {}
+        offset = 0
+        for doc_id, d in plan["documents"].items():
+            ids.append(np.asarray(d["chunk_ids"], dtype="S32"))
+            pages.append(np.asarray(d["chunk_pages"], dtype=np.int32))
+            ranges[doc_id] = [offset, offset + len(ids[-1])]
+            offset += len(ids[-1])
+        seg_dir = os.path.join(path, name)
+        os.makedirs(seg_dir)
+        np.save(os.path.join(seg_dir, "chunks.npy"), np.concatenate(ids) if ids else np.zeros(0, dtype="S32"))
+        np.save(os.path.join(seg_dir, "pages.npy"), np.concatenate(pages) if pages else np.zeros(0, dtype=np.int32))
+        return {"name": name, "dir": seg_dir, "ranges": ranges, "rows": offset}
+
+    def _install_docs_merge(self, plan: dict, built: dict):
+        chunk_ids = np.load(os.path.join(built["dir"], "chunks.npy"), mmap_mode="r")
+        chunk_pages = np.load(os.path.join(built["dir"], "pages.npy"), mmap_mode="r")
+        for doc_id, d in plan["documents"].items():
+            # Documents replaced or re-attached since the plan keep their rows
+            if self.documents.get(doc_id) is not d:
+                continue
+            start, end = built["ranges"][doc_id]
+            self.documents[doc_id] = {
+                **d,
+                "chunk_ids": chunk_ids[start:end],
+                "chunk_pages": chunk_pages[start:end],
+                "segment": built["name"],
+                "chunk_range": [start, end],
+            }
+        self._doc_files[built["name"]] = built["dir"]
+        self._doc_rows[built["name"]] = built["rows"]
+
+    # ---- Search ----
+    def embed_query(self, query: str) -> List[float]:
+        key = normalize_query(query)
+        vector = self.query_vectors.get(key)
+        if vector is None:
+            with stage("embed_query"):
+                vector = self.embedding_model.embed_query(query)
+            self.query_vectors.put(key, vector)
+        return vector
+
+    def embed_queries(self, queries: Sequence[str]) -> List[List[float]]:
+        """
+        `embed_query` for many queries; the uncached ones are embedded in one
+        call when the model offers `embed_queries`.
+        """
+        keys = [normalize_query(q) for q in queries]
+        vectors = [self.query_vectors.get(key) for key in keys]
+        missing = {key: q for key, q, v in zip(keys, queries, vectors) if v is None}
+        if missing:
+            with stage("embed_query"):
+                batch = getattr(self.embedding_model, "embed_queries", None)
+                texts = list(missing.values())
+                fresh = batch(texts) if batch is not None else [self.embedding_model.embed_query(t) for t in texts]
+            found = dict(zip(missing, fresh))
+            for key, vector in found.items():
+                self.query_vectors.put(key, vector)
+            vectors = [v if v is not None else found[key] for key, v in zip(keys, vectors)]
+        return vectors
+
+    def vector_search(self, query: str, k: int, *, nprobe: int | None = None, ef_search: int | None = None) -> List[Document]:
+        """
+        `nprobe` (IVF) / `ef_search` (HNSW) override the index defaults for
+        this query; they are ignored by index types that do not use them.
+        """
+        vector = self.embed_query(query)
+        with stage("faiss"), self._lock.read():
+            if self.vector_store is None:
+                return []
+            hits = self.vector_store.similarity_search_with_score_by_vector(
+                vector, k=k, nprobe=nprobe, ef_search=ef_search
+            )
+        return [
+            d.model_copy(update={"metadata": {**d.metadata, "vector_distance": float(dist)}})
+            for d, dist in hits
+        ]
+
+    def vector_search_many(
+        self, queries: Sequence[str], k: int, *, nprobe: int | None = None, ef_search: int | None = None
+    ) -> List[List[Document]]:
+        """
+        `vector_search` for many queries with one embedding call and one
+        FAISS search.
+        """
+        vectors = self.embed_queries(queries)
+        with stage("faiss"), self._lock.read():
+            if self.vector_store is None:
+                return [[] for _ in queries]
+            rows = self.vector_store.similarity_search_with_score_by_vectors(
+                vectors, k=k, nprobe=nprobe, ef_search=ef_search
+            )
+        return [
+            [d.model_copy(update={"metadata": {**d.metadata, "vector_distance": float(dist)}}) for d, dist in hits]
+            for hits in rows
+        ]
+
+    def bm25_search(self, query: str, k: int) -> List[Document]:
+        with stage("bm25"), self._lock.read():
+            hits = self.bm25.search(query, k)
+            if self.vector_store is None:
+                return []
+            docs = [(self.vector_store.get(cid), score) for cid, score in hits]
+        return [
+            d.model_copy(update={"metadata": {**d.metadata, "bm25_score": score}})
+            for d, score in docs
+            if d is not None
+        ]
+
+    def bm25_search_many(self, queries: Sequence[str], k: int) -> List[List[Document]]:
+        with stage("bm25"), self._lock.read():
+            rows = self.bm25.search_many(queries, k)
+            if self.vector_store is None:
+                return [[] for _ in queries]
+            rows = [[(self.vector_store.get(cid), score) for cid, score in hits] for hits in rows]
+        return [
+            [d.model_copy(update={"metadata": {**d.metadata, "bm25_score": score}}) for d, score in hits if d is not None]
+            for hits in rows
+        ]
+
+    def export_document(self, doc_id: str) -> tuple[List[str], List[Document], np.ndarray]:
+        """
+        A document's chunk ids, chunks and stored vectors, for copying it into
+        another index. Vectors come from reconstruct() (approximate for IVF-PQ).
+        """
+        with self._lock.read():
+            doc = self.documents[doc_id]
+            chunk_ids = _chunk_id_list(doc["chunk_ids"])
+            if self.vector_store is None:
+                return chunk_ids, [], np.zeros((0, 0), dtype=np.float32)
+            vs = self.vector_store
+            chunks = [vs.get(cid) for cid in chunk_ids]
+            vectors = np.zeros((len(chunk_ids), vs.index.d), dtype=np.float32)
+            for row, cid in enumerate(chunk_ids):
+                vectors[row] = vs.vector(vs.chunks.fid(cid))
+        return chunk_ids, chunks, vectors
+
+    def stats(self) -> dict:
+        with self._lock.read():
+            return {
+                "documents": len(self.documents),
+                "pdf_pages": sum(int(d.get("pages") or 0) for d in self.documents.values()),
+                "chunks": len(self.vector_store) if self.vector_store is not None else 0,
+                "faiss_vectors": len(self.vector_store) if self.vector_store is not None else 0,
+                "faiss_index": self.vector_store.index_type if self.vector_store is not None else None,
+            }
+
+
+class BM25CorpusRetriever(BaseRetriever):
+    corpus: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return self.corpus.bm25_search(query, self.k)
+
+    def search_many(self, queries: Sequence[str]) -> List[List[Document]]:
+        return self.corpus.bm25_search_many(queries, self.k)
+
+
+class VectorCorpusRetriever(BaseRetriever):
+    corpus: Any
+    k: int = 4
+    nprobe: int | None = None
+    ef_search: int | None = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return self.corpus.vector_search(query, self.k, nprobe=self.nprobe, ef_search=self.ef_search)
+
+    def search_many(self, queries: Sequence[str]) -> List[List[Document]]:
+        return self.corpus.vector_search_many(queries, self.k, nprobe=self.nprobe, ef_search=self.ef_search)
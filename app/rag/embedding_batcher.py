@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Funnels embedding calls from every thread through one worker that runs
+    them as micro-batches: the worker takes the oldest request, then keeps
+    collecting until `max_batch` texts are waiting or `max_wait_ms` has
+    passed, and embeds them in one forward pass. Callers block on (or, for
+    the async methods, await) their own slice of the result.
+
+    Queries are batched through `embed_documents` only when
+    `batch_queries` says the model embeds queries and documents the same
+    way; otherwise they still go through the worker, one by one. Pending
+    queries go ahead of document batches from ingestion.
+    """
+
+    def __init__(self, base: Embeddings, *, max_batch: int = 64, max_wait_ms: float = 5.0, batch_queries: bool = True):
+        self.base = base
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self.batch_queries = batch_queries
+        self._queries: deque = deque()
+        self._documents: deque = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._last_kind = None
+        self.batches = 0
+        self.texts = 0
+        self.largest_batch = 0
+        self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._worker.start()
+
+    # ---- Callers ----
+    def _submit(self, queue: deque, texts: List[str]) -> Future:
+        fut: Future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Embedding batcher is closed")
+            queue.append((texts, fut))
+            self._cond.notify()
+        return fut
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._submit(self._documents, list(texts)).result()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._submit(self._queries, [text]).result()[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Many queries submitted together, so they share batches (or, when
+        queries cannot be batched, at least one trip through the worker).
+        """
+        if not texts:
+            return []
+        if self.batch_queries:
+            return self._submit(self._queries, list(texts)).result()
+        futures = [self._submit(self._queries, [t]) for t in texts]
+        return [f.result()[0] for f in futures]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return await asyncio.wrap_future(self._submit(self._documents, list(texts)))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await asyncio.wrap_future(self._submit(self._queries, [text])))[0]
+
+    # ---- Worker ----
+    def _take(self) -> tuple[str, list] | None:
+        """
+        Next batch as (kind, [(texts, future), ...]); waits up to max_wait
+        for it to fill. None once closed and drained.
+        """
+        with self._cond:
+            while not self._queries and not self._documents:
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                queued = sum(len(t) for t, _ in self._queries) + sum(len(t) for t, _ in self._documents)
+                remaining = deadline - time.monotonic()
+                if queued >= self.max_batch or remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+
+            # Queries first, but alternate with waiting documents so a steady
+            # stream of chat traffic cannot stall ingestion
+            if self._queries and not (self._documents and self._last_kind == "query"):
+                kind, queue = "query", self._queries
+            else:
+                kind, queue = "documents", self._documents
+            self._last_kind = kind
+            if kind == "query" and not self.batch_queries:
+                return kind, [queue.popleft()]
+
+            batch, n = [], 0
+            while queue and (not batch or n + len(queue[0][0]) <= self.max_batch):
+                item = queue.popleft()
+                batch.append(item)
+                n += len(item[0])
+            return kind, batch
+
+    def _embed(self, kind: str, texts: List[str]) -> List[List[float]]:
+        if kind == "query" and not self.batch_queries:
+            return [self.base.embed_query(texts[0])]
+        return self.base.embed_documents(texts)
+
+    def _run(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            kind, batch = taken
+            texts = [t for item_texts, _ in batch for t in item_texts]
+            try:
+                vectors = self._embed(kind, texts)
+            except BaseException as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(texts)
+            self.largest_batch = max(self.largest_batch, len(texts))
+            offset = 0
+            for item_texts, fut in batch:
+                fut.set_result(vectors[offset : offset + len(item_texts)])
+                offset += len(item_texts)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout=10)
+
+    def stats(self) -> dict:
+        with self._cond:
+            waiting = len(self._queries) + len(self._documents)
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch": round(self.texts / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "waiting": waiting,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+        }
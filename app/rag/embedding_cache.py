@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import List, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+_KEY_BYTES = 16
+
+
+def _slug(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+
+
+class DiskEmbeddingCache:
+    """
+    Content-addressed embedding cache backed by memory-mapped files.
+
+    Layout under `<path>/<model>/`:
+      meta.json    model name, dim, capacity
+      vectors.f32  float32 [capacity, dim]
+      keys.bin     uint8 [capacity, 16]   blake2b(model, text)
+      used.bin     int64 [capacity]       last-use tick, 0 = free slot
+
+    Lookups gather rows straight out of the page cache; nothing is parsed or
+    deserialized. When full, the least recently used tenth of the slots is
+    evicted.
+    """
+
+    def __init__(self, path: str, model_name: str, *, max_bytes: int = 512 * 1024 * 1024):
+        self.model_name = model_name
+        self.dir = os.path.join(path, _slug(model_name))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._dim: int | None = None
+        self._slots: dict[bytes, int] = {}
+        self._free: list[int] = []
+        self._tick = 0
+        self._open_existing()
+
+    # ---- Files ----
+    def _open_existing(self):
+        meta_path = os.path.join(self.dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("model") != self.model_name:
+                return
+            self._map(int(meta["dim"]), int(meta["capacity"]), mode="r+")
+        except Exception:
+            # A corrupt cache is just a cold cache
+            self._dim = None
+            self._slots, self._free = {}, []
+
+    def _create(self, dim: int):
+        os.makedirs(self.dir, exist_ok=True)
+        capacity = max(1, self.max_bytes // (dim * 4 + _KEY_BYTES + 8))
+        with open(os.path.join(self.dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"model": self.model_name, "dim": dim, "capacity": capacity}, f)
+        self._map(dim, capacity, mode="w+")
+
+    def _map(self, dim: int, capacity: int, *, mode: str):
+        self._vectors = np.memmap(os.path.join(self.dir, "vectors.f32"), dtype=np.float32, mode=mode, shape=(capacity, dim))
+        self._keys = np.memmap(os.path.join(self.dir, "keys.bin"), dtype=np.uint8, mode=mode, shape=(capacity, _KEY_BYTES))
+        self._used = np.memmap(os.path.join(self.dir, "used.bin"), dtype=np.int64, mode=mode, shape=(capacity,))
+        self._dim = dim
+
+        occupied = np.flatnonzero(self._used)
+        self._slots = {self._keys[i].tobytes(): int(i) for i in occupied}
+        self._free = np.flatnonzero(self._used == 0)[::-1].tolist()
+        self._tick = int(self._used.max()) if len(self._used) else 0
+
+    # ---- Cache API ----
+    def key(self, text: str) -> bytes:
+        h = hashlib.blake2b(digest_size=_KEY_BYTES)
+        h.update(self.model_name.encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        return h.digest()
+
+    def get_many(self, keys: Sequence[bytes]) -> list[np.ndarray | None]:
+        with self._lock:
+            slots = [self._slots.get(k) for k in keys]
+            hit_idx = [i for i, slot in enumerate(slots) if slot is not None]
+            self.hits += len(hit_idx)
+            self.misses += len(keys) - len(hit_idx)
+
+            out: list[np.ndarray | None] = [None] * len(keys)
+            if hit_idx:
+                hit_slots = np.fromiter((slots[i] for i in hit_idx), dtype=np.int64, count=len(hit_idx))
+                self._tick += 1
+                self._used[hit_slots] = self._tick
+                # One gather from the mapping; rows are copied while locked so
+                # a concurrent eviction cannot overwrite them under the caller
+                rows = self._vectors[hit_slots]
+                for i, row in zip(hit_idx, rows):
+                    out[i] = row
+            return out
+
+    def put_many(self, keys: Sequence[bytes], vectors: Sequence[Sequence[float]]):
+        if not keys:
+            return
+        with self._lock:
+            if self._dim is None:
+                self._create(len(vectors[0]))
+            for k, v in zip(keys, vectors):
+                if k in self._slots or len(v) != self._dim:
+                    continue
+                if not self._free:
+                    self._evict()
+                slot = self._free.pop()
+                self._tick += 1
+                self._vectors[slot] = v
+                self._keys[slot] = np.frombuffer(k, dtype=np.uint8)
+                self._used[slot] = self._tick
+                self._slots[k] = slot
+            self._vectors.flush()
+            self._keys.flush()
+            self._used.flush()
+
+    def _evict(self):
+        capacity = len(self._used)
+        n = max(1, capacity // 10)
+        victims = np.argpartition(self._used, n - 1)[:n] if n < capacity else np.arange(capacity)
+        for slot in victims.tolist():
+            self._slots.pop(self._keys[slot].tobytes(), None)
+            self._used[slot] = 0
+            self._free.append(slot)
+        self.evictions += len(victims)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._slots),
+                "capacity": len(self._used) if self._dim is not None else 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model so document embeddings are served from a
+    DiskEmbeddingCache; only misses reach the underlying model.
+    """
+
+    def __init__(self, base: Embeddings, cache: DiskEmbeddingCache):
+        self.base = base
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.cache.key(t) for t in texts]
+        cached = [v.tolist() if v is not None else None for v in self.cache.get_many(keys)]
+
+        miss_idx = [i for i, v in enumerate(cached) if v is None]
+        if miss_idx:
+            # Identical texts in one batch are embedded once
+            unique: dict[bytes, str] = {}
+            for i in miss_idx:
+                unique.setdefault(keys[i], texts[i])
+            fresh = self.base.embed_documents(list(unique.values()))
+            by_key = dict(zip(unique.keys(), fresh))
+            self.cache.put_many(list(by_key.keys()), list(by_key.values()))
+            for i in miss_idx:
+                cached[i] = by_key[keys[i]]
+
+        return [list(v) for v in cached]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.base.embed_query(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        # Queries skip the disk cache, as in embed_query
+        batch = getattr(self.base, "embed_queries", None)
+        return batch(texts) if batch is not None else [self.base.embed_query(t) for t in texts]
+
+    def stats(self) -> dict:
+        return self.cache.stats()
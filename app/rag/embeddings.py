@@ -1,4 +1,31 @@
 from langchain_huggingface import HuggingFaceEmbeddings
 
-def get_embedding_model(model_name: str):
-    return HuggingFaceEmbeddings(model_name=model_name)
\ No newline at end of file
+from app.rag.embedding_batcher import BatchingEmbeddings
+from app.rag.embedding_cache import CachedEmbeddings, DiskEmbeddingCache
+
+def get_embedding_model(
+    model_name: str,
+    cache_dir: str | None = None,
+    cache_max_mb: int = 512,
+    *,
+    batch_max_size: int = 64,
+    batch_max_wait_ms: float = 5.0,
+):
+    """
+    HuggingFace embeddings behind a micro-batching worker (unless
+    `batch_max_size` <= 1), wrapped in a persistent chunk-embedding cache
+    when `cache_dir` is set, so only cache misses are batched.
+    """
+    model = HuggingFaceEmbeddings(model_name=model_name)
+    if batch_max_size > 1:
+        model = BatchingEmbeddings(
+            model,
+            max_batch=batch_max_size,
+            max_wait_ms=batch_max_wait_ms,
+            # Same encode settings for both: queries can share a batch
+            batch_queries=getattr(model, "query_encode_kwargs", None) == getattr(model, "encode_kwargs", None),
+        )
+    if not cache_dir:
+        return model
+    cache = DiskEmbeddingCache(cache_dir, model_name, max_bytes=cache_max_mb * 1024 * 1024)
+    return CachedEmbeddings(model, cache)
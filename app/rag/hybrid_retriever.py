@@ -1,73 +1,310 @@
-from typing import Callable, List
-from langchain_community.retrievers import BM25Retriever
+import asyncio
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Mapping, Sequence
+
+import numpy as np
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import ConfigurableField
+
+from app.core.metrics import bind, stage
+from app.rag.corpus_index import BM25CorpusRetriever, VectorCorpusRetriever, content_hash
+from app.rag.query_cache import LRUCache, normalize_query
+
+# Retrieval modes and the legs each one runs
+RETRIEVAL_MODES: dict[str, tuple[str, ...]] = {
+    "hybrid": ("bm25", "vector"),
+    "vector": ("vector",),
+    "bm25": ("bm25",),
+}
+
+def chunk_key(doc: Document) -> str:
+    """
+    Stable chunk id assigned at ingestion; falls back to a hash of the full
+    text for documents that did not come through the corpus index.
+    """
+    return doc.metadata.get("chunk_id") or content_hash(doc.page_content)
 
 def reciprocal_rank_fusion(
-    bm25_docs: List[Document],
-    vector_docs: List[Document],
+    results: Mapping[str, List[Document]],
     *,
     k: int = 60,
     top_k: int = 6,
+    weights: Mapping[str, float] | None = None,
 ) -> List[Document]:
     """
-    Fuse BM25 + Vector results with Reciprocal Rank Fusion.
-    Score(doc) = sum(1 / (k + rank)) over retrievers.
+    Fuse any number of ranked lists with weighted Reciprocal Rank Fusion.
+    Score(doc) = sum(weight[r] / (k + rank_r(doc))) over retrievers r.
+
+    Returned documents are copies carrying `rrf_score` and `retrieval_ranks`
+    ({retriever: 1-based rank}) in their metadata, so callers can show why
+    each passage was picked.
     """
-    rrf_scores: dict[str, float] = {}
+    slots: dict[str, int] = {}
+    docs: list[Document] = []
+    ranks: list[dict[str, int]] = []
+    slot_idx: list[np.ndarray] = []
+    contrib: list[np.ndarray] = []
 
-    def doc_key(doc: Document) -> str:
-        # Same approach as your notebook. Works for demo, but may collide.
-        return doc.page_content[:50]
+    for name, ranked in results.items():
+        if not ranked:
+            continue
+        idx = np.empty(len(ranked), dtype=np.int64)
+        for pos, doc in enumerate(ranked):
+            key = chunk_key(doc)
+            slot = slots.get(key)
+            if slot is None:
+                slot = slots[key] = len(docs)
+                docs.append(doc)
+                ranks.append({})
+            elif doc.metadata is not docs[slot].metadata:
+                # Keep per-leg scores (bm25_score, vector_distance) from every leg
+                docs[slot] = docs[slot].model_copy(update={"metadata": {**docs[slot].metadata, **doc.metadata}})
+            ranks[slot].setdefault(name, pos + 1)
+            idx[pos] = slot
+        w = 1.0 if weights is None else float(weights.get(name, 1.0))
+        slot_idx.append(idx)
+        contrib.append(w / (k + np.arange(1, len(ranked) + 1, dtype=np.float64)))
 
-    for rank, doc in enumerate(bm25_docs, 1):
-        key = doc_key(doc)
-        rrf_scores[key] = rrf_scores.get(key, 0.0) + (1 / (k + rank))
+    if not docs:
+        return []
 
-    for rank, doc in enumerate(vector_docs, 1):
-        key = doc_key(doc)
-        rrf_scores[key] = rrf_scores.get(key, 0.0) + (1 / (k + rank))
+    scores = np.zeros(len(docs), dtype=np.float64)
+    # A chunk can appear twice in one list only if a leg returns duplicates;
+    # add.at accumulates those correctly where fancy-index += would not
+    np.add.at(scores, np.concatenate(slot_idx), np.concatenate(contrib))
 
-    all_docs = {doc_key(d): d for d in (bm25_docs + vector_docs)}
+    if len(docs) > top_k:
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        top = np.arange(len(docs))
+    top = top[np.argsort(-scores[top], kind="stable")]
+
+    return [
+        docs[i].model_copy(
+            update={
+                "metadata": {
+                    **docs[i].metadata,
+                    "rrf_score": float(scores[i]),
+                    "retrieval_ranks": ranks[i],
+                }
+            }
+        )
+        for i in top
+    ]
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_retrieval_executor(max_workers: int = 8) -> ThreadPoolExecutor:
+    """
+    Process-wide pool for CPU-bound retrieval legs (query embedding, FAISS,
+    BM25 scoring), shared by every HybridRetriever.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval")
+        return _executor
+
+
+def _leg_results(futures: Mapping[str, Any], done) -> Dict[str, List[Document]]:
+    """
+    Results of the finished legs that succeeded. If none did, raises the
+    first leg error: fusing nothing would let the LLM answer without context.
+    """
+    results = {name: f.result() for name, f in futures.items() if f in done and f.exception() is None}
+    errors = [f.exception() for f in futures.values() if f in done and f.exception() is not None]
+    if not results and errors:
+        raise errors[0]
+    return results
+
+
+def _search_many(leg: BaseRetriever, queries: Sequence[str]) -> List[List[Document]]:
+    many = getattr(leg, "search_many", None)
+    return many(queries) if many is not None else leg.batch(list(queries))
 
-    sorted_docs = sorted(
-        all_docs.values(),
-        key=lambda d: rrf_scores.get(doc_key(d), 0.0),
-        reverse=True,
-    )
-    return sorted_docs[:top_k]
 
 class HybridRetriever(BaseRetriever):
     """
-    Custom retriever: BM25 + Vector, then fuse with RRF.
+    Custom retriever: runs the legs selected by `mode` concurrently, then
+    fuses with RRF. A leg that misses `leg_timeout` seconds or fails is dropped
+    and the remaining legs are fused; if every leg misses it, the first to
+    succeed wins, and if every leg fails, the first error is raised.
+    Single-leg modes call the leg inline and skip the executor.
+    `nprobe` / `ef_search`, when set, override the vector leg's ANN settings.
+
+    With a `cache`, fused results are stored under (corpus path and version,
+    normalized query, mode, ANN settings); a repeated question skips both
+    legs, and any change to the corpus moves to fresh keys. Results missing
+    a timed-out leg are not cached.
     """
-    bm25_retriever: BaseRetriever | None = None
-    vector_retriever: BaseRetriever
-    rrf_func: Callable[..., List[Document]]
+    retrievers: Dict[str, BaseRetriever]
+    rrf_func: Callable[[Dict[str, List[Document]]], List[Document]]
+    mode: str = "hybrid"
+    leg_timeout: float | None = None
+    executor: Any = None
+    nprobe: int | None = None
+    ef_search: int | None = None
+    corpus: Any = None
+    cache: Any = None
+
+    def _active_legs(self) -> Dict[str, BaseRetriever]:
+        names = RETRIEVAL_MODES.get(self.mode)
+        if names is None:
+            raise ValueError(f"Unknown retrieval mode '{self.mode}' (expected one of {', '.join(RETRIEVAL_MODES)})")
+        legs = {name: self.retrievers[name] for name in names if name in self.retrievers}
+        if "vector" in legs and (self.nprobe or self.ef_search):
+            overrides = {"nprobe": self.nprobe, "ef_search": self.ef_search}
+            legs["vector"] = legs["vector"].model_copy(update={k: v for k, v in overrides.items() if v})
+        return legs
+
+    def _cache_key(self, query: str):
+        if self.cache is None or self.corpus is None:
+            return None
+        # The path keeps different users' corpora apart; their versions overlap
+        return (self.corpus.path, self.corpus.version, normalize_query(query), self.mode, self.nprobe, self.ef_search)
+
+    def _fuse(self, key, legs, results: Dict[str, List[Document]]) -> List[Document]:
+        with stage("rrf"):
+            fused = self.rrf_func(results)
+        if key is not None and len(results) == len(legs):
+            self.cache.put(key, fused)
+        return fused
+
+    def retrieve_many(self, queries: Sequence[str]) -> List[List[Document]]:
+        """
+        Results for many queries. Cached ones are reused; for the rest each
+        leg searches all queries in one call (for the vector leg, one
+        embedding batch and one FAISS search), the legs running concurrently.
+        There is no leg timeout here: a failing leg fails the batch.
+        """
+        with stage("retrieve_batch"):
+            keys = [self._cache_key(q) for q in queries]
+            out: List[List[Document]] = [[] for _ in queries]
+            todo = []
+            for i, key in enumerate(keys):
+                cached = self.cache.get(key) if key is not None else None
+                if cached is not None:
+                    out[i] = list(cached)
+                else:
+                    todo.append(i)
+            if not todo:
+                return out
+
+            legs = self._active_legs()
+            pending = [queries[i] for i in todo]
+            if len(legs) == 1:
+                rows = {name: _search_many(leg, pending) for name, leg in legs.items()}
+            else:
+                executor = self.executor or get_retrieval_executor()
+                futures = {name: executor.submit(bind(_search_many), leg, pending) for name, leg in legs.items()}
+                rows = {name: fut.result() for name, fut in futures.items()}
+            for j, i in enumerate(todo):
+                out[i] = self._fuse(keys[i], legs, {name: r[j] for name, r in rows.items()})
+            return out
 
     def _get_relevant_documents(self, query: str) -> List[Document]:
-        bm25_results = self.bm25_retriever.invoke(query) if self.bm25_retriever else []
-        vector_results = self.vector_retriever.invoke(query)
-        return self.rrf_func(bm25_results, vector_results)
+        with stage("retrieve"):
+            return self._retrieve(query)
+
+    async def _aget_relevant_documents(self, query: str) -> List[Document]:
+        with stage("retrieve"):
+            return await self._aretrieve(query)
+
+    def _retrieve(self, query: str) -> List[Document]:
+        key = self._cache_key(query)
+        if key is not None and (cached := self.cache.get(key)) is not None:
+            return list(cached)
+
+        legs = self._active_legs()
+        if len(legs) == 1:
+            (name, leg), = legs.items()
+            return self._fuse(key, legs, {name: leg.invoke(query)})
+
+        executor = self.executor or get_retrieval_executor()
+        futures = {name: executor.submit(bind(leg.invoke), query) for name, leg in legs.items()}
+        done, pending = wait(futures.values(), timeout=self.leg_timeout)
+        # Past the timeout, keep waiting until some leg has succeeded
+        while pending and not any(fut.exception() is None for fut in done):
+            more, pending = wait(pending, return_when=FIRST_COMPLETED)
+            done |= more
+        return self._fuse(key, legs, _leg_results(futures, done))
+
+    async def _aretrieve(self, query: str) -> List[Document]:
+        key = self._cache_key(query)
+        if key is not None and (cached := self.cache.get(key)) is not None:
+            return list(cached)
+
+        legs = self._active_legs()
+        loop = asyncio.get_running_loop()
+        executor = self.executor or get_retrieval_executor()
+        tasks = {
+            name: asyncio.ensure_future(loop.run_in_executor(executor, bind(leg.invoke), query))
+            for name, leg in legs.items()
+        }
+        if not tasks:
+            return self.rrf_func({})
+        done, pending = await asyncio.wait(tasks.values(), timeout=self.leg_timeout)
+        # Past the timeout, keep waiting until some leg has succeeded
+        while pending and not any(task.exception() is None for task in done):
+            more, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            done |= more
+        return self._fuse(key, legs, _leg_results(tasks, done))
+
+def retrieve_many(
+    retriever, queries: Sequence[str], *, mode: str | None = None, nprobe: int | None = None, ef_search: int | None = None
+) -> List[List[Document]]:
+    """
+    Batch retrieval through a retriever from `build_hybrid_retriever`, with
+    the per-request settings its configurable fields would otherwise take.
+    """
+    base = getattr(retriever, "default", retriever)
+    overrides = {"mode": mode, "nprobe": nprobe, "ef_search": ef_search}
+    return base.model_copy(update={k: v for k, v in overrides.items() if v is not None}).retrieve_many(queries)
+
 
 def build_hybrid_retriever(
-    chunks,
-    vector_store,
+    corpus,
     *,
     bm25_k: int,
     vector_k: int,
     rrf_k: int,
     fused_top_k: int,
+    weights: Mapping[str, float] | None = None,
+    mode: str = "hybrid",
+    leg_timeout_ms: int | None = None,
+    cache: LRUCache | None = None,
 ):
-    try:
-        bm25 = BM25Retriever.from_documents(chunks)
-        bm25.k = bm25_k
-    except Exception:
-        bm25 = None
+    """
+    Retrievers read the live CorpusIndex, so documents added or removed
+    later are picked up without rebuilding the retriever or chain.
 
-    vector = vector_store.as_retriever(search_kwargs={"k": vector_k})
+    The mode can be switched per call with
+    config={"configurable": {"retrieval_mode": "vector" | "bm25" | "hybrid"}};
+    every mode shares the same loaded indexes. "nprobe" and "ef_search" can
+    be set the same way to trade vector recall for latency per request.
+    """
+    retrievers: Dict[str, BaseRetriever] = {
+        "bm25": BM25CorpusRetriever(corpus=corpus, k=bm25_k),
+        "vector": VectorCorpusRetriever(corpus=corpus, k=vector_k),
+    }
 
-    def rrf(bm25_docs, vector_docs):
-        return reciprocal_rank_fusion(bm25_docs, vector_docs, k=rrf_k, top_k=fused_top_k)
+    def rrf(results):
+        return reciprocal_rank_fusion(results, k=rrf_k, top_k=fused_top_k, weights=weights)
 
-    return HybridRetriever(bm25_retriever=bm25, vector_retriever=vector, rrf_func=rrf)
\ No newline at end of file
+    retriever = HybridRetriever(
+        retrievers=retrievers,
+        rrf_func=rrf,
+        mode=mode,
+        leg_timeout=leg_timeout_ms / 1000 if leg_timeout_ms else None,
+        corpus=corpus,
+        cache=cache,
+    )
+    return retriever.configurable_fields(
+        mode=ConfigurableField(id="retrieval_mode", name="Retrieval mode"),
+        nprobe=ConfigurableField(id="nprobe", name="IVF lists probed per query"),
+        ef_search=ConfigurableField(id="ef_search", name="HNSW search breadth"),
+    )
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from app.core.metrics import REGISTRY
+
+STAGES = ("parse", "chunk", "embed", "index")
+
+# Stages overlap (parsing streams into chunking and embedding), so their
+# times are wall-clock spans that can add up to more than the job
+INGEST_STAGE_SECONDS = REGISTRY.histogram(
+    "rag_ingest_stage_seconds",
+    "Wall-clock time of each ingestion stage.",
+    ("stage",),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+INGEST_JOBS = REGISTRY.counter("rag_ingest_jobs_total", "Finished ingestion jobs, by outcome.", ("status",))
+
+
+class IngestionQueueFull(RuntimeError):
+    pass
+
+
+@dataclass
+class StageProgress:
+    status: str = "pending"  # pending | running | done | failed
+    done: int = 0
+    total: int | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    def to_dict(self) -> dict[str, Any]:
+        seconds = None
+        if self.started_at is not None:
+            seconds = round((self.finished_at or time.time()) - self.started_at, 3)
+        return {"status": self.status, "done": self.done, "total": self.total, "seconds": seconds}
+
+
+@dataclass
+class IngestionJob:
+    """
+    Progress record for one PDF ingestion. `_rebuild_from_pdf` reports into it
+    stage by stage; the status endpoint serializes it with `to_dict`.
+    `source`, when set, is the path the document is recorded under, and
+    `pdf_path` a staged copy that is moved there once the job finishes.
+    """
+    pdf_path: str
+    filename: str | None = None
+    user_id: str | None = None
+    source: str | None = None
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = "queued"  # queued | running | succeeded | failed
+    stages: dict[str, StageProgress] = field(default_factory=lambda: {s: StageProgress() for s in STAGES})
+    result: dict | None = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @contextmanager
+    def stage(self, name: str, total: int | None = None):
+        st = self.stages[name]
+        st.status, st.total, st.started_at = "running", total, time.time()
+        try:
+            yield st
+        except BaseException:
+            st.status, st.finished_at = "failed", time.time()
+            raise
+        st.status, st.finished_at = "done", time.time()
+        INGEST_STAGE_SECONDS.observe(st.finished_at - st.started_at, name)
+        if st.total is None:
+            st.total = st.done
+
+    def advance(self, name: str, n: int = 1):
+        self.stages[name].done += n
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "stages": {name: st.to_dict() for name, st in self.stages.items()},
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionJobManager:
+    """
+    Runs ingestion jobs on a bounded worker pool so uploads return immediately.
+    `run(pdf_path, job)` does the actual work and returns the result dict.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[str, IngestionJob], dict],
+        *,
+        max_workers: int = 1,
+        max_pending: int = 8,
+        keep_finished: int = 100,
+    ):
+        self._run = run
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._max_pending = max_pending
+        self._keep_finished = keep_finished
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(
+        self, pdf_path: str, *, filename: str | None = None, user_id: str | None = None, source: str | None = None
+    ) -> IngestionJob:
+        job = IngestionJob(pdf_path=pdf_path, filename=filename, user_id=user_id, source=source)
+        with self._lock:
+            pending = sum(1 for j in self._jobs.values() if j.status in ("queued", "running"))
+            if pending >= self._max_pending:
+                raise IngestionQueueFull(f"Too many ingestion jobs in progress ({pending})")
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._execute, job)
+        return job
+
+    def get(self, job_id: str) -> IngestionJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _execute(self, job: IngestionJob):
+        job.status, job.started_at = "running", time.time()
+        try:
+            job.result = self._run(job.pdf_path, job)
+            job.status = "succeeded"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            INGEST_JOBS.inc(job.status)
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [j.status for j in self._jobs.values()]
+        return {s: statuses.count(s) for s in ("queued", "running", "succeeded", "failed")}
+
+    def _prune(self):
+        finished = [jid for jid, j in self._jobs.items() if j.status in ("succeeded", "failed")]
+        for jid in finished[: max(0, len(finished) - self._keep_finished)]:
+            del self._jobs[jid]
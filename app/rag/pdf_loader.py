@@ -1,29 +1,106 @@
+import multiprocessing
 import os
-from langchain_community.document_loaders import PyPDFLoader
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator
+
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
 
-def load_and_chunk_pdf(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200):
+def _splitter(chunk_size: int, chunk_overlap: int):
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=["\n\n", "\n", " ", ""],
+    )
+
+def chunk_documents(raw_documents, chunk_size: int = 1000, chunk_overlap: int = 200):
     """
-    Load PDF and split into chunks, preserving page metadata as `source_page`.
+    Split page documents into chunks, keeping each page's metadata.
     """
+    chunks = _splitter(chunk_size, chunk_overlap).split_documents(raw_documents)
+
+    for c in chunks:
+        c.metadata.setdefault("source_page", 1)
+
+    return chunks
+
+def count_pdf_pages(file_path: str) -> int:
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File '{file_path}' not found.")
+    return len(PdfReader(file_path).pages)
+
+def _chunk_page_range(file_path: str, start: int, end: int, chunk_size: int, chunk_overlap: int):
+    """
+    Worker task: extract pages [start, end) and split them. Runs in a child
+    process, so it opens its own reader and returns plain tuples.
+    """
+    reader = PdfReader(file_path)
+    pages = [
+        Document(
+            page_content=reader.pages[i].extract_text() or "",
+            metadata={"source": file_path, "page": i, "source_page": i + 1},
+        )
+        for i in range(start, end)
+    ]
+    chunks = chunk_documents(pages, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return end - start, [(c.page_content, c.metadata) for c in chunks]
 
-    loader = PyPDFLoader(file_path)
-    raw_documents = loader.load()
+def _pool_context():
+    # Forking a threaded server process is unsafe; forkserver/spawn are not
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
 
-    for doc in raw_documents:
-        page_num = doc.metadata.get("page", 0) + 1
-        doc.metadata["source_page"] = page_num
+def iter_pdf_chunks(
+    file_path: str,
+    *,
+    chunk_size: int = 1000,
+    chunk_overlap: int = 200,
+    pages_per_task: int = 16,
+    max_workers: int | None = None,
+    on_pages: Callable[[int], None] | None = None,
+) -> Iterator[Document]:
+    """
+    Yield chunks in page order while later page ranges are still being parsed.
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        separators=["\n\n", "\n", " ", ""],
-    )
-    chunks = splitter.split_documents(raw_documents)
+    Page ranges are extracted and split in a process pool; at most
+    2 * max_workers ranges are in flight, so peak memory depends on
+    `pages_per_task`, not on the page count. `on_pages(n)` is called as
+    each range completes. Small PDFs are parsed in-process.
+    """
+    n_pages = count_pdf_pages(file_path)
+    ranges = [(s, min(s + pages_per_task, n_pages)) for s in range(0, n_pages, pages_per_task)]
+    max_workers = max(1, min(max_workers or (os.cpu_count() or 1), len(ranges)))
 
-    for c in chunks:
-        c.metadata.setdefault("source_page", 1)
+    def emit(result):
+        n_done, items = result
+        if on_pages is not None:
+            on_pages(n_done)
+        for text, metadata in items:
+            yield Document(page_content=text, metadata=metadata)
+
+    if len(ranges) <= 1 or max_workers == 1:
+        for start, end in ranges:
+            yield from emit(_chunk_page_range(file_path, start, end, chunk_size, chunk_overlap))
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=_pool_context()) as pool:
+        pending = iter(ranges)
+        in_flight: deque = deque()
+
+        def submit_next() -> bool:
+            nxt = next(pending, None)
+            if nxt is None:
+                return False
+            in_flight.append(pool.submit(_chunk_page_range, file_path, nxt[0], nxt[1], chunk_size, chunk_overlap))
+            return True
+
+        for _ in range(2 * max_workers):
+            if not submit_next():
+                break
 
-    return chunks, raw_documents
\ No newline at end of file
+        while in_flight:
+            result = in_flight.popleft().result()
+            submit_next()
+            yield from emit(result)
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Sequence
+
+from langchain_core.runnables import RunnableLambda
+
+from app.core.metrics import bind, stage
+from app.rag.query_cache import LRUCache, normalize_query
+
+# "always": condense every follow-up (one LLM call per turn)
+# "auto": skip self-contained questions and reuse cached rewrites
+# "parallel": like auto, and retrieve with the raw question while the rewrite
+#             runs; the raw results are used if the rewrite misses its budget,
+#             and a late rewrite is cached for the next time
+REWRITE_POLICIES = ("always", "auto", "parallel")
+
+_WORD_RE = re.compile(r"\w+")
+# Words that usually point back into the conversation
+_REFERENCE_WORDS = frozenset(
+    """it its itself they them their theirs this that these those he him his she her hers
+    there former latter above previous earlier same such one ones else more another other again also""".split()
+)
+_FOLLOW_UP_OPENERS = ("and ", "but ", "so ", "also ", "what about", "how about", "why not", "then ", "ok", "okay")
+
+
+def is_self_contained(question: str, *, min_words: int = 4) -> bool:
+    """
+    Cheap check for questions that read the same without the chat history:
+    long enough, not opening like a follow-up, and free of pronouns or other
+    words that refer back. Errs towards False (rewrite).
+    """
+    words = _WORD_RE.findall(question.lower())
+    if len(words) < min_words:
+        return False
+    if question.lower().lstrip().startswith(_FOLLOW_UP_OPENERS):
+        return False
+    return not any(w in _REFERENCE_WORDS for w in words)
+
+
+def same_question(a: str, b: str) -> bool:
+    return normalize_query(a) == normalize_query(b)
+
+
+def history_key(history: Sequence[Any], turns: int) -> str:
+    """
+    Hash of the last `turns` messages; rewrites only depend on recent context.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for m in list(history)[-turns:]:
+        h.update(f"{getattr(m, 'type', '')}\x1f{getattr(m, 'content', m)}\x1e".encode("utf-8"))
+    return h.hexdigest()
+
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Separate from the retrieval pool: raw retrieval submitted here fans out
+    # its legs to that pool, and nesting in one pool could starve it
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rewrite")
+        return _executor
+
+
+class QuestionRewriter:
+    """
+    Decides how the standalone question for retrieval is produced.
+
+    Produces {"question", "standalone", "docs"?}: `standalone` is True when
+    the input needed no rewriting (so answers to it don't depend on the
+    history), and `docs` is set when raw-question retrieval won the race in
+    "parallel" mode.
+    """
+
+    def __init__(
+        self,
+        *,
+        policy: str = "always",
+        cache: LRUCache | None = None,
+        budget_ms: int | None = None,
+        history_turns: int = 6,
+    ):
+        if policy not in REWRITE_POLICIES:
+            raise ValueError(f"Unknown rewrite policy '{policy}' (expected one of {', '.join(REWRITE_POLICIES)})")
+        self.policy = policy
+        self.cache = cache
+        self.budget = budget_ms / 1000 if budget_ms else None
+        self.history_turns = history_turns
+        self._counts = {"no_history": 0, "skipped": 0, "cached": 0, "condensed": 0, "raw_fallback": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _result(self, question: str, original: str) -> dict:
+        return {"question": question, "standalone": same_question(question, original)}
+
+    def _shortcut(self, x: dict) -> tuple[dict | None, Any]:
+        """
+        (result, cache key): a result when no LLM call is needed, else the
+        key to store the rewrite under (None when not caching).
+        """
+        question = x["input"]
+        history = x.get("chat_history") or []
+        if not history:
+            self._count("no_history")
+            return {"question": question, "standalone": True}, None
+
+        key = None
+        if self.policy != "always":
+            if is_self_contained(question):
+                self._count("skipped")
+                return {"question": question, "standalone": True}, None
+            if self.cache is not None:
+                key = (history_key(history, self.history_turns), normalize_query(question))
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self._count("cached")
+                    return self._result(cached, question), None
+        return None, key
+
+    def _remember(self, key, rewritten: str):
+        if key is not None:
+            self.cache.put(key, rewritten)
+
+    def resolve(self, x: dict, config, *, condense, retriever) -> dict:
+        result, key = self._shortcut(x)
+        if result is not None:
+            return result
+        question = x["input"]
+
+        if self.policy == "parallel" and self.budget is not None:
+            executor = _get_executor()
+            raw = executor.submit(bind(retriever.invoke), question, config)
+            condensing = executor.submit(bind(condense.invoke), x, config)
+            done, _ = wait([condensing], timeout=self.budget)
+            if condensing in done and condensing.exception() is None:
+                raw.cancel()
+                rewritten = condensing.result()
+                self._remember(key, rewritten)
+                self._count("condensed")
+                return self._result(rewritten, question)
+            # A thread already calling the LLM can't be stopped; keep its
+            # late rewrite for the next time this turn comes up
+            if not condensing.cancel():
+                condensing.add_done_callback(lambda f: f.exception() is None and self._remember(key, f.result()))
+            self._count("raw_fallback")
+            return {"question": question, "standalone": False, "docs": raw.result()}
+
+        rewritten = condense.invoke(x, config)
+        self._remember(key, rewritten)
+        self._count("condensed")
+        return self._result(rewritten, question)
+
+    async def aresolve(self, x: dict, config, *, condense, retriever) -> dict:
+        result, key = self._shortcut(x)
+        if result is not None:
+            return result
+        question = x["input"]
+
+        if self.policy == "parallel" and self.budget is not None:
+            raw = asyncio.ensure_future(retriever.ainvoke(question, config))
+            condensing = asyncio.ensure_future(condense.ainvoke(x, config))
+            done, _ = await asyncio.wait([condensing], timeout=self.budget)
+            if condensing in done and condensing.exception() is None:
+                raw.cancel()
+                rewritten = condensing.result()
+                self._remember(key, rewritten)
+                self._count("condensed")
+                return self._result(rewritten, question)
+            # As in `resolve`: keep the late rewrite for the next time this
+            # turn comes up, and retrieve a failure so it isn't logged as lost
+            condensing.add_done_callback(
+                lambda f: not f.cancelled() and f.exception() is None and self._remember(key, f.result())
+            )
+            self._count("raw_fallback")
+            return {"question": question, "standalone": False, "docs": await raw}
+
+        rewritten = await condense.ainvoke(x, config)
+        self._remember(key, rewritten)
+        self._count("condensed")
+        return self._result(rewritten, question)
+
+    def as_runnable(self, condense, retriever) -> RunnableLambda:
+        def resolve(x, config):
+            with stage("rewrite"):
+                return self.resolve(x, config, condense=condense, retriever=retriever)
+
+        async def aresolve(x, config):
+            with stage("rewrite"):
+                return await self.aresolve(x, config, condense=condense, retriever=retriever)
+
+        return RunnableLambda(
+            resolve,
+            afunc=aresolve,
+            name="rewrite_question",
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats: dict[str, Any] = {"policy": self.policy, **self._counts}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
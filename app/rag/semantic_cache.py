@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Callable, List
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+class SemanticAnswerCache:
+    """
+    Answers to recent standalone questions, looked up by embedding similarity.
+
+    Question vectors are L2-normalized rows of one preallocated matrix, so a
+    lookup is a single matrix-vector product (cosine similarity). A lookup at
+    or above `threshold` returns the stored answer and source documents.
+    Entries belong to the corpus version current when they were looked up; a
+    new version empties the cache. An optional `scope` (e.g. the retrieval
+    mode) only matches entries stored under the same scope. When full, the
+    least recently used entry is replaced.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[str], List[float]],
+        version: Callable[[], int],
+        *,
+        max_entries: int = 1000,
+        threshold: float = 0.92,
+        ttl: float | None = None,
+    ):
+        self.embed = embed
+        self.version = version
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._vectors: np.ndarray | None = None
+        self._entries: list[dict[str, Any]] = []
+        self._used = np.zeros(max_entries, dtype=np.float64)
+        self._version: int | None = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _reset(self, version: int):
+        self._entries = []
+        self._version = version
+
+    def lookup(self, question: str, scope: Any = None) -> dict:
+        """
+        Returns {"hit": {"answer", "docs", "similarity"} | None, ...}; pass the
+        whole result to `store()` after answering a miss.
+        """
+        v = np.asarray(self.embed(question), dtype=np.float32)
+        v = v / (np.linalg.norm(v) or 1.0)
+        version = self.version()
+        now = time.monotonic()
+        with self._lock:
+            if version != self._version:
+                self._reset(version)
+            hit = None
+            n = len(self._entries)
+            if n:
+                sims = self._vectors[:n] @ v
+                sims[[i for i, e in enumerate(self._entries) if e["scope"] != scope]] = -1.0
+                if self.ttl is not None:
+                    created = np.fromiter((e["created"] for e in self._entries), dtype=np.float64, count=n)
+                    sims[now - created >= self.ttl] = -1.0
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    self._used[best] = now
+                    entry = self._entries[best]
+                    hit = {"answer": entry["answer"], "docs": entry["docs"], "similarity": float(sims[best])}
+            if hit is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return {"hit": hit, "vector": v, "version": version, "scope": scope}
+
+    def store(self, lookup: dict, answer: str, docs: List[Document]):
+        v = lookup["vector"]
+        now = time.monotonic()
+        with self._lock:
+            if lookup["version"] != self._version or self.max_entries <= 0:
+                return  # the corpus changed while this answer was generated
+            if self._vectors is None or self._vectors.shape[1] != len(v):
+                self._vectors = np.zeros((self.max_entries, len(v)), dtype=np.float32)
+                self._entries = []
+            if len(self._entries) < self.max_entries:
+                slot = len(self._entries)
+                self._entries.append({})
+            else:
+                slot = int(np.argmin(self._used))
+                self.evictions += 1
+            self._vectors[slot] = v
+            self._entries[slot] = {"answer": answer, "docs": list(docs), "scope": lookup["scope"], "created": now}
+            self._used[slot] = now
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "capacity": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+            }
@@ -1,16 +1,382 @@
+import json
+import math
 import os
-from langchain_community.vectorstores import FAISS
+import shutil
+import uuid
+from typing import Iterable, List
 
-def save_vector_store(vector_store, path: str):
-    vector_store.save_local(path)
+import faiss
+import numpy as np
+from langchain_core.documents import Document
 
-def load_vector_store(embedding_model, path: str):
-    return FAISS.load_local(path, embedding_model, allow_dangerous_deserialization=True)
+from app.rag.chunk_store import ChunkStore, link_or_copy
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+
+# Corpus sizes (vectors) at which the "auto" policy switches index type
+AUTO_HNSW_MIN = 20_000
+AUTO_IVFPQ_MIN = 1_000_000
+
+def choose_index_type(n_vectors: int, requested: str = "auto") -> str:
+    """
+    Flat (exact) while brute force is cheap, HNSW for mid-sized corpora,
+    IVF-PQ once raw float vectors stop fitting comfortably in memory.
+    """
+    if requested != "auto":
+        if requested not in INDEX_TYPES:
+            raise ValueError(f"Unknown FAISS index type '{requested}' (expected auto or one of {', '.join(INDEX_TYPES)})")
+        return requested
+    if n_vectors >= AUTO_IVFPQ_MIN:
+        return "ivfpq"
+    if n_vectors >= AUTO_HNSW_MIN:
+        return "hnsw"
+    return "flat"
+
+def _nlist_for(n_vectors: int) -> int:
+    # ~4*sqrt(N) lists, but keep >= 39 training points per centroid
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+def _pq_m_for(dim: int) -> int:
+    for m in (64, 48, 32, 24, 16, 8, 4, 2, 1):
+        if m <= dim // 4 and dim % m == 0:
+            return m
+    return 1
+
+def _segment_name(prefix: str, suffix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:12]}{suffix}"
+
+def build_faiss_index(index_type: str, train: np.ndarray, *, hnsw_m: int = 32):
+    """
+    An empty, trained index that accepts add_with_ids, plus the type actually
+    built. Flat and HNSW are wrapped in IndexIDMap2; IVF variants store ids
+    natively. IVF types fall back when there are too few training points.
+    """
+    n, dim = train.shape
+    if index_type == "ivfpq" and n < 256 * 39:
+        # Too few points to train 8-bit PQ codebooks; IVF-Flat is the closest fit
+        index_type = "ivf"
+    if index_type in ("ivf", "ivfpq") and _nlist_for(n) < 2:
+        index_type = "flat"
+
+    if index_type == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dim)), index_type
+    if index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dim, hnsw_m)
+        hnsw.hnsw.efConstruction = max(40, 2 * hnsw_m)
+        return faiss.IndexIDMap2(hnsw), index_type
+
+    nlist = _nlist_for(n)
+    quantizer = faiss.IndexFlatL2(dim)
+    if index_type == "ivf":
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+    else:
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m_for(dim), 8)
+    index.train(train)
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index, index_type
+
+class ChunkVectorStore:
+    """
+    FAISS index over chunks keyed by `chunk_id`.
+
+    Each chunk gets a sequential int64 FAISS id. Vectors live in a base index
+    (the type `choose_index_type` picks) that is never modified once built,
+    plus a flat index of the vectors added since; a search queries both and
+    merges the hits. Deletes are tombstones hidden from search through an
+    IDSelector. `compaction_plan` / `build_compaction` / `install_compaction`
+    rebuild the base from the live vectors, only taking the write lock to
+    swap it in. `nprobe` / `ef_search` can be overridden per search.
+
+    Saving writes the base once and the vectors added since the previous
+    save as a delta file; files an earlier save wrote are hard-linked. A
+    loaded base is memory-mapped read-only. Chunk text and metadata live in
+    a ChunkStore.
+    """
+
+    def __init__(self, embedding_model, index, index_type: str, *, nprobe: int = 8, ef_search: int = 64, hnsw_m: int = 32):
+        self.embedding_model = embedding_model
+        self.index = index
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.hnsw_m = hnsw_m
+        self.trained_size = 0
+        self.chunks = ChunkStore()
+        self.tombstones: set[int] = set()
+        # Vectors added since the base was built, FAISS ids recent_from and up
+        self.recent = faiss.IndexIDMap2(faiss.IndexFlatL2(index.d))
+        self.recent_from = 0
+        self._next_id = 0
+        self._selector = None
+        self._base_name = _segment_name("base", ".faiss")
+        self._base_file: str | None = None  # saved copy of the base
+        self._mapped = False
+        # Saved delta files (name, rows), covering the first rows of `recent`
+        self._deltas: list[tuple[str, int]] = []
+        self._delta_dir: str | None = None
+
+    # ---- Construction ----
+    @classmethod
+    def create(cls, embedding_model, chunks: List[Document], vectors, *, index_type: str = "auto", **kwargs):
+        x = np.asarray(vectors, dtype=np.float32)
+        index, resolved = build_faiss_index(
+            choose_index_type(len(x), index_type), x, hnsw_m=kwargs.get("hnsw_m", 32)
+        )
+        store = cls(embedding_model, index, resolved, **kwargs)
+        fids = np.arange(len(x), dtype=np.int64)
+        index.add_with_ids(x, fids)
+        store.chunks.add(chunks, fids.tolist())
+        store.trained_size = store._next_id = store.recent_from = len(x)
+        return store
+
+    def needs_rebuild(self, index_type: str = "auto") -> bool:
+        n = len(self)
+        if n == 0:
+            # Release the vectors of a corpus that was emptied
+            return self.index.ntotal + self.recent.ntotal > 0
+        # Most lists (IVF) or graph neighbours (HNSW) would be empty or hidden
+        shrunk = 4 * n < self.trained_size
+        if self.index_type in ("ivf", "ivfpq") and (n > 4 * max(self.trained_size, 1) or shrunk):
+            return True  # centroids were trained on a much larger or smaller corpus
+        if len(self.tombstones) > n // 10:
+            return True
+        if self.recent.ntotal > max(AUTO_HNSW_MIN, self.trained_size // 4):
+            return True  # the brute-force part stopped being cheap
+        wanted = choose_index_type(n, index_type)
+        if wanted == self.index_type:
+            return False
+        # Don't rebuild over and over when an IVF type fell back for lack of
+        # training data and the corpus has not grown since
+        return n > self.trained_size or shrunk
+
+    def compaction_plan(self) -> dict:
+        """
+        A snapshot for `build_compaction`, taken under the caller's read lock.
+        """
+        return {
+            "base": self.index,
+            "fids": self.chunks.live_fids(),
+            "recent_from": self.recent_from,
+            "recent": self.recent.index.reconstruct_n(0, self.recent.ntotal),
+            "tombstones": set(self.tombstones),
+            "next_id": self._next_id,
+        }
+
+    def build_compaction(self, plan: dict, index_type: str, path: str) -> dict:
+        """
+        A new base over the planned live vectors, with the type the policy
+        picks for that size, saved under `path`. Retrains IVF centroids.
+        Base vectors come from reconstruct(), which is exact except for
+        IVF-PQ. Needs no lock: the planned base is never modified.
+        """
+        fids = np.sort(plan["fids"])
+        x = np.zeros((len(fids), plan["base"].d), dtype=np.float32)
+        in_recent = fids >= plan["recent_from"]
+        x[in_recent] = plan["recent"][fids[in_recent] - plan["recent_from"]]
+        for row in np.flatnonzero(~in_recent).tolist():
+            x[row] = plan["base"].reconstruct(int(fids[row]))
+        index, resolved = build_faiss_index(choose_index_type(len(x), index_type), x, hnsw_m=self.hnsw_m)
+        index.add_with_ids(x, fids)
+        name = _segment_name("base", ".faiss")
+        faiss.write_index(index, os.path.join(path, name))
+        return {"index": index, "index_type": resolved, "name": name, "file": os.path.join(path, name)}
+
+    def install_compaction(self, plan: dict, built: dict):
+        """
+        Swap the new base in (caller holds the write lock). Vectors added
+        since the plan move to a fresh flat index; deletes since the plan
+        stay tombstoned.
+        """
+        start = plan["next_id"] - self.recent_from
+        recent = faiss.IndexIDMap2(faiss.IndexFlatL2(self.index.d))
+        if self.recent.ntotal > start:
+            x = self.recent.index.reconstruct_n(start, self.recent.ntotal - start)
+            recent.add_with_ids(x, np.arange(plan["next_id"], plan["next_id"] + len(x), dtype=np.int64))
+        self.index, self.index_type, self.trained_size = built["index"], built["index_type"], len(plan["fids"])
+        self._base_name, self._base_file, self._mapped = built["name"], built["file"], False
+        self.recent, self.recent_from, self._deltas = recent, plan["next_id"], []
+        self.tombstones -= plan["tombstones"]
+        self._selector = None
+
+    # ---- Updates ----
+    def add(self, chunks: List[Document], vectors):
+        x = np.asarray(vectors, dtype=np.float32)
+        fids = np.arange(self._next_id, self._next_id + len(chunks), dtype=np.int64)
+        self._next_id += len(chunks)
+        self.recent.add_with_ids(x, fids)
+        self.chunks.add(chunks, fids.tolist())
+
+    def delete(self, chunk_ids: Iterable[str]):
+        fids = self.chunks.remove(chunk_ids)
+        if fids:
+            # Hidden from search until the next rebuild leaves them out
+            self.tombstones.update(fids)
+            self._selector = None
+
+    def get(self, chunk_id: str) -> Document | None:
+        return self.chunks.get(chunk_id)
+
+    def vector(self, fid: int) -> np.ndarray:
+        """
+        The stored vector (approximate for an IVF-PQ base).
+        """
+        return (self.recent if fid >= self.recent_from else self.index).reconstruct(int(fid))
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    # ---- Search ----
+    def _search_params(self, nprobe: int | None, ef_search: int | None):
+        if self.index_type in ("ivf", "ivfpq"):
+            params = faiss.SearchParametersIVF(nprobe=nprobe or self.nprobe)
+        elif self.index_type == "hnsw":
+            params = faiss.SearchParametersHNSW(efSearch=ef_search or self.ef_search)
+        else:
+            params = faiss.SearchParameters()
+        recent = faiss.SearchParameters()
+
+        if self.tombstones:
+            if self._selector is None:
+                batch = faiss.IDSelectorBatch(np.fromiter(self.tombstones, dtype=np.int64))
+                # Keep `batch` referenced: IDSelectorNot does not own it
+                self._selector = (batch, faiss.IDSelectorNot(batch))
+            params.sel = recent.sel = self._selector[1]
+        return params, recent
+
+    def similarity_search_with_score_by_vector(self, vector, k: int = 4, *, nprobe: int | None = None, ef_search: int | None = None):
+        return self.similarity_search_with_score_by_vectors([vector], k, nprobe=nprobe, ef_search=ef_search)[0]
+
+    def similarity_search_with_score_by_vectors(self, vectors, k: int = 4, *, nprobe: int | None = None, ef_search: int | None = None):
+        """
+        One FAISS search for many query vectors; a list of hits per vector.
+        """
+        if len(self) == 0 or len(vectors) == 0:
+            return [[] for _ in vectors]
+        x = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        params, recent_params = self._search_params(nprobe, ef_search)
+        parts = []
+        for index, p in ((self.index, params), (self.recent, recent_params)):
+            if index.ntotal:
+                parts.append(index.search(x, min(k, index.ntotal), params=p))
+        dists = np.hstack([d for d, _ in parts])
+        fids = np.hstack([f for _, f in parts])
+        if len(parts) > 1:
+            # Missing hits come back as id -1 at the largest distance
+            order = np.argsort(dists, axis=1, kind="stable")[:, :k]
+            dists, fids = np.take_along_axis(dists, order, 1), np.take_along_axis(fids, order, 1)
+        out = []
+        for row_dists, row_fids in zip(dists.tolist(), fids.tolist()):
+            hits = []
+            for dist, fid in zip(row_dists, row_fids):
+                doc = self.chunks.get_by_fid(fid) if fid >= 0 else None
+                if doc is not None:
+                    hits.append((doc, dist))
+            out.append(hits)
+        return out
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **params):
+        return self.similarity_search_with_score_by_vector(self.embedding_model.embed_query(query), k, **params)
+
+    # ---- Persistence ----
+    def save_local(self, path: str) -> dict:
+        """
+        Write under `path`; returns what was written, for `saved()`.
+        """
+        vector_dir = os.path.join(path, "vectors")
+        os.makedirs(vector_dir, exist_ok=True)
+        base = os.path.join(vector_dir, self._base_name)
+        if self._base_file is not None and os.path.exists(self._base_file):
+            link_or_copy(self._base_file, base)
+        else:
+            faiss.write_index(self.index, base)
+
+        deltas = list(self._deltas)
+        for name, _ in deltas:
+            link_or_copy(os.path.join(self._delta_dir, name), os.path.join(vector_dir, name))
+        saved_rows = sum(rows for _, rows in deltas)
+        if self.recent.ntotal > saved_rows:
+            name = _segment_name("delta", ".npy")
+            np.save(os.path.join(vector_dir, name), self.recent.index.reconstruct_n(saved_rows, self.recent.ntotal - saved_rows))
+            deltas.append((name, self.recent.ntotal - saved_rows))
+
+        np.save(os.path.join(vector_dir, "tombstones.npy"), np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones)))
+        state = {
+            "index_type": self.index_type,
+            "trained_size": self.trained_size,
+            "next_id": self._next_id,
+            "recent_from": self.recent_from,
+            "base": self._base_name,
+            "deltas": deltas,
+        }
+        with open(os.path.join(path, "store.json"), "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        self.chunks.save(os.path.join(path, "chunks"))
+        return state
+
+    def saved(self, path: str, state: dict):
+        """
+        Note the copy `save_local` wrote, now at `path`, so the next save
+        links its files instead of writing them again.
+        """
+        self._base_file = os.path.join(path, "vectors", state["base"])
+        self._deltas = [tuple(d) for d in state["deltas"]]
+        self._delta_dir = os.path.join(path, "vectors")
+        self.chunks.saved(os.path.join(path, "chunks"))
+
+    def attach(self, path: str):
+        """
+        Serve chunk text, and a base built in memory, from a saved copy.
+        """
+        self.chunks = ChunkStore.load(os.path.join(path, "chunks"))
+        if not self._mapped:
+            self.index = faiss.read_index(self._base_file, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+            self._mapped = True
+
+    @classmethod
+    def load_local(cls, path: str, embedding_model, *, mmap: bool = True, **kwargs):
+        with open(os.path.join(path, "store.json"), "r", encoding="utf-8") as f:
+            state = json.load(f)
+        vector_dir = os.path.join(path, "vectors")
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        index = faiss.read_index(os.path.join(vector_dir, state["base"]), flags)
+        store = cls(embedding_model, index, state["index_type"], **kwargs)
+        store.trained_size = state["trained_size"]
+        store._next_id = state["next_id"]
+        store.recent_from = state["recent_from"]
+        for name, _ in state["deltas"]:
+            x = np.load(os.path.join(vector_dir, name))
+            start = store.recent_from + store.recent.ntotal
+            store.recent.add_with_ids(x, np.arange(start, start + len(x), dtype=np.int64))
+        store.tombstones = set(np.load(os.path.join(vector_dir, "tombstones.npy")).tolist())
+        store.chunks = ChunkStore.load(os.path.join(path, "chunks"))
+        store._base_name = state["base"]
+        store._mapped = mmap
+        store.saved(path, state)
+        return store
+
+def save_vector_store(vector_store, path: str, manifest: dict | None = None, write_extra=None):
+    """
+    Write to a sibling temp dir and swap it in, so a crash mid-save never
+    leaves a half-written index at `path`. `write_extra(tmp_path)` can add
+    companion files (e.g. the BM25 index) before the swap. Files unchanged
+    since the previous save are hard-linked into the temp dir.
+    """
+    tmp_path = f"{path}.tmp"
+    old_path = f"{path}.old"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    state = vector_store.save_local(tmp_path)
+    if manifest is not None:
+        with open(os.path.join(tmp_path, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+    if write_extra is not None:
+        write_extra(tmp_path)
 
-def create_or_load_vector_store(chunks, embedding_model, path: str):
     if os.path.exists(path):
-        return load_vector_store(embedding_model, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    vector_store.saved(path, state)
 
-    vector_store = FAISS.from_documents(chunks, embedding_model)
-    save_vector_store(vector_store, path)
-    return vector_store
\ No newline at end of file
+def load_vector_store(embedding_model, path: str, **kwargs):
+    return ChunkVectorStore.load_local(path, embedding_model, **kwargs)
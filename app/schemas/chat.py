@@ -1,14 +1,36 @@
+from typing import Annotated, Literal
+
 from pydantic import BaseModel, Field
 
+RetrievalMode = Literal["hybrid", "vector", "bm25"]
+
 class ChatRequest(BaseModel):
     conversation_id: str = Field(..., description="Conversation/session id for persistent memory")
     message: str = Field(..., min_length=1)
     hybrid: bool = Field(True, description="If true, use hybrid search; if false, vector-only (UI toggle)")
+    mode: RetrievalMode | None = Field(None, description="Retrieval mode; takes precedence over `hybrid` when set")
+    nprobe: int | None = Field(None, ge=1, le=4096, description="IVF lists probed (IVF / IVF-PQ indexes only)")
+    ef_search: int | None = Field(None, ge=1, le=4096, description="HNSW search breadth (HNSW index only)")
 
 class Source(BaseModel):
     page: int | None = None
     preview: str
+    chunk_id: str | None = None
+    score: float | None = Field(None, description="Fused RRF score")
+    ranks: dict[str, int] = Field(default_factory=dict, description="1-based rank from each retriever that returned this passage")
 
 class ChatResponse(BaseModel):
     answer: str
-    sources: list[Source]
\ No newline at end of file
+    sources: list[Source]
+
+class BatchOptions(BaseModel):
+    hybrid: bool = Field(True, description="If true, use hybrid search; if false, vector-only")
+    mode: RetrievalMode | None = Field(None, description="Retrieval mode; takes precedence over `hybrid` when set")
+    nprobe: int | None = Field(None, ge=1, le=4096, description="IVF lists probed (IVF / IVF-PQ indexes only)")
+    ef_search: int | None = Field(None, ge=1, le=4096, description="HNSW search breadth (HNSW index only)")
+
+class BatchRetrieveRequest(BatchOptions):
+    queries: list[Annotated[str, Field(min_length=1)]] = Field(..., min_length=1)
+
+class BatchChatRequest(BatchOptions):
+    questions: list[Annotated[str, Field(min_length=1)]] = Field(..., min_length=1, description="Answered independently, without chat history")
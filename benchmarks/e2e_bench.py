@@ -0,0 +1,396 @@
+"""
+End-to-end benchmark that needs no Groq key, MongoDB or network access.
+
+    python -m benchmarks.e2e_bench --pages 200 --out before.json
+    python -m benchmarks.e2e_bench --pages 200 --compare before.json
+
+Generates synthetic PDFs, ingests them through _rebuild_from_pdf, times the
+HybridRetriever per retrieval mode, then drives /api/chat and
+/api/chat/stream in-process over ASGI. ChatGroq is replaced by a fake model
+with a fixed time to first token and token rate, chat history uses the
+in-memory store, and --embeddings hash swaps the embedding model for a
+hashing one (use it to leave model inference out of the numbers).
+
+All state is written to a temporary directory. Results are JSON; --compare
+prints the change per metric against an earlier run and exits with status 1
+when any metric is worse by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import numpy as np
+
+from benchmarks.fakes import FakeChatModel, HashingEmbeddings
+from benchmarks.synthetic_pdf import synthetic_pages, write_pdf
+
+BENCH_USER = "bench-user"
+
+
+def percentiles(ms) -> dict:
+    ms = np.asarray(ms, dtype=np.float64)
+    if not len(ms):
+        return {"n": 0}
+    return {
+        "n": int(len(ms)),
+        "mean": round(float(ms.mean()), 3),
+        "p50": round(float(np.percentile(ms, 50)), 3),
+        "p95": round(float(np.percentile(ms, 95)), 3),
+        "p99": round(float(np.percentile(ms, 99)), 3),
+    }
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# ---- App under test ----
+def load_app(args):
+    """
+    Import app.main with the fakes in place, then move into a scratch
+    directory so indexes, uploads and caches land there.
+    """
+    os.environ.setdefault("GROQ_API_KEY", "offline-benchmark")
+    os.environ.pop("MONGO_URI", None)
+    os.environ["SEMANTIC_CACHE"] = "1" if args.semantic_cache else "0"
+
+    import app.rag.chain as chain_module
+
+    def fake_groq(**kwargs):
+        return FakeChatModel(
+            first_token_ms=args.llm_first_token_ms,
+            tokens_per_s=args.llm_tokens_per_s,
+            answer_tokens=args.llm_answer_tokens,
+        )
+
+    chain_module.ChatGroq = fake_groq
+    if args.embeddings == "hash":
+        import app.rag.embeddings as embeddings_module
+
+        embeddings_module.HuggingFaceEmbeddings = lambda model_name, **kwargs: HashingEmbeddings()
+
+    import app.main as main  # resolves static/ relative to the repo root
+
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    os.chdir(workdir)
+    return main, workdir
+
+
+class AsgiClient:
+    """
+    Minimal ASGI driver: runs the app's lifespan and HTTP requests in this
+    event loop and timestamps response chunks as the app sends them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lifespan: asyncio.Queue = asyncio.Queue()
+        self._lifespan_task = None
+
+    async def startup(self):
+        started = asyncio.Event()
+
+        async def send(message):
+            if message["type"] in ("lifespan.startup.complete", "lifespan.startup.failed"):
+                started.set()
+
+        await self._lifespan.put({"type": "lifespan.startup"})
+        self._lifespan_task = asyncio.create_task(
+            self.app({"type": "lifespan", "asgi": {"version": "3.0"}}, self._lifespan.get, send)
+        )
+        await started.wait()
+
+    async def shutdown(self):
+        await self._lifespan.put({"type": "lifespan.shutdown"})
+        await asyncio.wait_for(self._lifespan_task, timeout=30)
+
+    async def request(self, method: str, path: str, *, query: str = "", body: Any = None, headers=None) -> dict:
+        payload = json.dumps(body).encode() if body is not None else b""
+        raw_headers = [(b"host", b"bench")] + [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+        if body is not None:
+            raw_headers.append((b"content-type", b"application/json"))
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": raw_headers,
+            "client": ("127.0.0.1", 50000),
+            "server": ("bench", 80),
+        }
+        finished = asyncio.Event()
+        sent_body = False
+
+        async def receive():
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {"type": "http.request", "body": payload, "more_body": False}
+            # The client stays connected until the response is complete
+            await finished.wait()
+            return {"type": "http.disconnect"}
+
+        result = {"status": None, "body": bytearray(), "first_token_s": None}
+        t0 = time.perf_counter()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                result["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                if result["first_token_s"] is None and b"event: token" in chunk:
+                    result["first_token_s"] = time.perf_counter() - t0
+                result["body"] += chunk
+                if not message.get("more_body", False):
+                    finished.set()
+
+        await self.app(scope, receive, send)
+        finished.set()
+        result["total_s"] = time.perf_counter() - t0
+        return result
+
+
+# ---- Stages ----
+def bench_ingest(main, args) -> dict:
+    from app.rag.ingestion import IngestionJob
+
+    pages_total, chunks_total, seconds = 0, 0, 0.0
+    stage_seconds: dict[str, float] = {}
+    queries: list[str] = []
+    for d in range(args.docs):
+        pages, doc_queries = synthetic_pages(args.pages, words_per_page=args.words_per_page, seed=args.seed + d)
+        queries.extend(doc_queries)
+        path = os.path.abspath(f"synthetic-{d}.pdf")
+        write_pdf(path, pages)
+
+        job = IngestionJob(pdf_path=path, filename=os.path.basename(path), user_id=BENCH_USER)
+        t0 = time.perf_counter()
+        main._rebuild_from_pdf(path, job)
+        seconds += time.perf_counter() - t0
+        pages_total += job.stages["parse"].done
+        chunks_total += job.stages["chunk"].done
+        for name, stage in job.to_dict()["stages"].items():
+            stage_seconds[name] = round(stage_seconds.get(name, 0.0) + (stage["seconds"] or 0.0), 3)
+
+    return {
+        "results": {
+            "docs": args.docs,
+            "pages": pages_total,
+            "chunks": chunks_total,
+            "seconds": round(seconds, 3),
+            "pages_per_s": round(pages_total / seconds, 2) if seconds else None,
+            "chunks_per_s": round(chunks_total / seconds, 2) if seconds else None,
+            "stage_seconds": stage_seconds,
+        },
+        "queries": queries,
+    }
+
+
+def bench_retrieval(main, queries: list[str], args) -> dict:
+    tenant = main._catalog.get(BENCH_USER)
+    out = {}
+    for mode in args.modes.split(","):
+        # Cold caches per mode, so modes do not reuse each other's work
+        main._query_vectors.clear()
+        main._retrieval_cache.clear()
+        ms = []
+        for q in queries[: args.queries]:
+            t0 = time.perf_counter()
+            tenant.retriever.invoke(q, config={"configurable": {"retrieval_mode": mode}})
+            ms.append((time.perf_counter() - t0) * 1000)
+        out[mode] = percentiles(ms)
+    return out
+
+
+async def bench_chat(client: AsgiClient, queries: list[str], args, headers: dict) -> dict:
+    """
+    `--concurrency` simulated users, each holding one conversation and
+    sending its share of the queries one after another (so follow-ups go
+    through history and question rewriting).
+    """
+    per_user = max(1, args.chat_requests // args.concurrency)
+
+    async def user(u: int, stream: bool):
+        latencies, ttft, errors = [], [], 0
+        for i in range(per_user):
+            q = queries[(u * per_user + i) % len(queries)]
+            if stream:
+                r = await client.request(
+                    "GET",
+                    "/api/chat/stream",
+                    query=f"conversation_id=stream-{u}&message={_quote(q)}",
+                    headers=headers,
+                )
+                ok = r["status"] == 200 and b"event: error" not in r["body"]
+                if r["first_token_s"] is not None:
+                    ttft.append(r["first_token_s"] * 1000)
+            else:
+                r = await client.request(
+                    "POST", "/api/chat", body={"conversation_id": f"chat-{u}", "message": q}, headers=headers
+                )
+                ok = r["status"] == 200
+            latencies.append(r["total_s"] * 1000)
+            errors += 0 if ok else 1
+        return latencies, ttft, errors
+
+    out = {}
+    for stream in (False, True):
+        t0 = time.perf_counter()
+        runs = await asyncio.gather(*(user(u, stream) for u in range(args.concurrency)))
+        elapsed = time.perf_counter() - t0
+        latencies = [ms for r in runs for ms in r[0]]
+        name = "stream" if stream else "chat"
+        out[name] = {
+            "total_ms": percentiles(latencies),
+            "requests_per_s": round(len(latencies) / elapsed, 2) if elapsed else None,
+            "errors": sum(r[2] for r in runs),
+        }
+        if stream:
+            out[name]["ttft_ms"] = percentiles([ms for r in runs for ms in r[1]])
+    return out
+
+
+def _quote(text: str) -> str:
+    from urllib.parse import quote
+
+    return quote(text, safe="")
+
+
+# ---- Comparing runs ----
+def _flatten(d: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            flat.update(_flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[key] = float(v)
+    return flat
+
+
+def _direction(key: str) -> int:
+    """
+    +1 when higher is better, -1 when lower is better, 0 for counts.
+    """
+    if key.endswith("per_s"):
+        return 1
+    if key.endswith((".mean", ".p50", ".p95", ".p99", "seconds", "_mb", "errors")):
+        return -1
+    return 0
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    ignored = ("out", "compare", "tolerance")
+    differs = sorted(
+        k for k in baseline.get("config", {}).keys() | current["config"].keys()
+        if k not in ignored and baseline.get("config", {}).get(k) != current["config"].get(k)
+    )
+    if differs:
+        print(f"\nwarning: runs used different settings: {', '.join(differs)}")
+
+    base, cur = _flatten(baseline["results"]), _flatten(current["results"])
+    regressions = []
+    print(f"\n{'metric':<44}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key in sorted(base.keys() & cur.keys()):
+        direction = _direction(key)
+        if direction == 0:
+            continue
+        b, c = base[key], cur[key]
+        change = (c - b) / b if b else (0.0 if c == b else float("inf"))
+        worse = -direction * change > tolerance
+        flag = "  REGRESSION" if worse else ""
+        print(f"{key:<44}{b:>12.3f}{c:>12.3f}{change:>+9.1%}{flag}")
+        if worse:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=1, help="number of synthetic PDFs to ingest")
+    parser.add_argument("--pages", type=int, default=100, help="pages per PDF")
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embeddings", choices=("model", "hash"), default="model")
+    parser.add_argument("--queries", type=int, default=200, help="retrieval queries per mode (at most one per page)")
+    parser.add_argument("--modes", default="bm25,vector,hybrid")
+    parser.add_argument("--chat-requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-first-token-ms", type=float, default=300.0)
+    parser.add_argument("--llm-tokens-per-s", type=float, default=150.0)
+    parser.add_argument("--llm-answer-tokens", type=int, default=60)
+    parser.add_argument("--semantic-cache", action="store_true")
+    parser.add_argument("--out", help="write results JSON here")
+    parser.add_argument("--compare", help="results JSON of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative change before flagging")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    main_module, workdir = load_app(args)
+    from jose import jwt
+    from app.api.routes_chat import JWT_ALG, JWT_SECRET
+
+    headers = {"Authorization": f"Bearer {jwt.encode({'sub': BENCH_USER}, JWT_SECRET, algorithm=JWT_ALG)}"}
+
+    async def run() -> dict:
+        client = AsgiClient(main_module.app)
+        await client.startup()
+        try:
+            ingest = await asyncio.to_thread(bench_ingest, main_module, args)
+            retrieval = await asyncio.to_thread(bench_retrieval, main_module, ingest["queries"], args)
+            chat = await bench_chat(client, ingest["queries"], args, headers)
+        finally:
+            await client.shutdown()
+        return {"ingest": ingest["results"], "retrieval_ms": retrieval, **chat, "peak_rss_mb": peak_rss_mb()}
+
+    report = {
+        "meta": {
+            "commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "workdir": workdir,
+        },
+        "config": vars(args),
+        "results": asyncio.run(run()),
+    }
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Recall vs latency for each FAISS index type, measured against exact (flat) search.
+
+    python -m benchmarks.faiss_index_bench --n 100000 --dim 384
+
+Vectors are synthetic (Gaussian clusters, roughly like sentence embeddings);
+pass --vectors path.npy to run on real embeddings instead. Use the output to
+pick FAISS_INDEX_TYPE and the nprobe / ef_search defaults in Settings.
+"""
+import argparse
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+
+from app.rag.vectorstore_faiss import INDEX_TYPES, ChunkVectorStore, choose_index_type
+
+def synthetic_vectors(n: int, dim: int, *, clusters: int = 256, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    x = centers[rng.integers(0, clusters, n)] + 0.35 * rng.standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+def build_store(index_type: str, x: np.ndarray) -> ChunkVectorStore:
+    chunks = [Document(page_content="", metadata={"chunk_id": str(i)}) for i in range(len(x))]
+    return ChunkVectorStore.create(None, chunks, x, index_type=index_type)
+
+def run_queries(store: ChunkVectorStore, queries: np.ndarray, k: int, **params):
+    ids, latencies = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        hits = store.similarity_search_with_score_by_vector(q, k, **params)
+        latencies.append(time.perf_counter() - t0)
+        ids.append({d.metadata["chunk_id"] for d, _ in hits})
+    return ids, np.asarray(latencies) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--types", default=",".join(INDEX_TYPES))
+    parser.add_argument("--nprobe", default="1,4,8,16,32,64")
+    parser.add_argument("--ef-search", default="16,32,64,128,256")
+    parser.add_argument("--vectors", help=".npy file of float32 embeddings to use instead of synthetic data")
+    args = parser.parse_args()
+
+    x = np.load(args.vectors).astype(np.float32) if args.vectors else synthetic_vectors(args.n, args.dim)
+    rng = np.random.default_rng(1)
+    queries = x[rng.choice(len(x), args.queries, replace=False)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    print(f"{len(x)} vectors, dim {x.shape[1]}, {len(queries)} queries, k={args.k}; auto -> {choose_index_type(len(x))}")
+
+    flat = build_store("flat", x)
+    truth, flat_ms = run_queries(flat, queries, args.k)
+    print(f"{'index':<8}{'param':<16}{'build s':>9}{'recall@k':>10}{'p50 ms':>9}{'p95 ms':>9}")
+    print(f"{'flat':<8}{'-':<16}{'':>9}{1.0:>10.3f}{np.percentile(flat_ms, 50):>9.3f}{np.percentile(flat_ms, 95):>9.3f}")
+
+    sweeps = {
+        "ivf": ("nprobe", args.nprobe),
+        "ivfpq": ("nprobe", args.nprobe),
+        "hnsw": ("ef_search", args.ef_search),
+    }
+    for index_type in args.types.split(","):
+        if index_type not in sweeps:
+            continue
+        t0 = time.perf_counter()
+        store = build_store(index_type, x)
+        build_s = time.perf_counter() - t0
+        param, values = sweeps[index_type]
+        label = store.index_type if store.index_type == index_type else f"{index_type}>{store.index_type}"
+        for value in (int(v) for v in values.split(",")):
+            found, ms = run_queries(store, queries, args.k, **{param: value})
+            recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+            print(
+                f"{label:<8}{f'{param}={value}':<16}{build_s:>9.2f}{recall:>10.3f}"
+                f"{np.percentile(ms, 50):>9.3f}{np.percentile(ms, 95):>9.3f}"
+            )
+
+if __name__ == "__main__":
+    main()
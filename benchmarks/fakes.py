@@ -0,0 +1,87 @@
+"""
+Offline stand-ins for the external services the app calls: a chat model with
+configurable latency and token rate, and a hashing embedding model.
+"""
+import asyncio
+import hashlib
+import time
+from typing import Any, AsyncIterator, Iterator, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+_WORDS = (
+    "the document states that this section describes results methods data and the "
+    "authors report findings on page with several figures tables values compared"
+).split()
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic chat model: waits `first_token_ms`, then emits
+    `answer_tokens` words at `tokens_per_s`. The words depend only on the
+    prompt, so runs are repeatable.
+    """
+
+    first_token_ms: float = 300.0
+    tokens_per_s: float = 150.0
+    answer_tokens: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        seed = hashlib.blake2b(str(messages[-1].content).encode("utf-8"), digest_size=8).digest()
+        rng = np.random.default_rng(int.from_bytes(seed, "little"))
+        return [_WORDS[i] + " " for i in rng.integers(0, len(_WORDS), self.answer_tokens)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self.first_token_ms / 1000 + len(tokens) / self.tokens_per_s)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens).strip()))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.first_token_ms / 1000 + len(tokens) / self.tokens_per_s)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens).strip()))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_ms / 1000)
+        for token in self._tokens(messages):
+            time.sleep(1 / self.tokens_per_s)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.first_token_ms / 1000)
+        for token in self._tokens(messages):
+            await asyncio.sleep(1 / self.tokens_per_s)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Feature-hashed bag of words, L2-normalized. Texts sharing words get
+    similar vectors, so retrieval behaves sensibly; costs almost nothing, so
+    use it to measure everything except the embedding model itself.
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def _vector(self, text: str) -> List[float]:
+        v = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            v[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = np.linalg.norm(v)
+        return (v / norm if norm else v).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text)
@@ -0,0 +1,74 @@
+"""
+Synthetic PDFs for benchmarks: plain-text pages built from a fixed vocabulary
+so every run with the same seed produces the same corpus and queries.
+"""
+import random
+from typing import List, Tuple
+
+_VOCAB_SIZE = 5000
+
+
+def _vocabulary(rng: random.Random) -> List[str]:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < _VOCAB_SIZE:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def synthetic_pages(n_pages: int, *, words_per_page: int = 400, seed: int = 0) -> Tuple[List[str], List[str]]:
+    """
+    (pages, queries): each page mixes common words with a few page-specific
+    topic words; queries pick topic words from random pages, so retrieval
+    has something to find.
+    """
+    rng = random.Random(seed)
+    vocab = _vocabulary(rng)
+    common = vocab[:500]
+    pages, queries = [], []
+    for p in range(n_pages):
+        topic = rng.sample(vocab[500:], 8)
+        words = [rng.choice(topic) if rng.random() < 0.1 else rng.choice(common) for _ in range(words_per_page)]
+        sentences = [" ".join(words[i : i + 12]).capitalize() + "." for i in range(0, len(words), 12)]
+        pages.append(" ".join(sentences))
+        queries.append(f"What does page {p + 1} say about {' '.join(rng.sample(topic, 3))}?")
+    rng.shuffle(queries)
+    return pages, queries
+
+
+def write_pdf(path: str, pages: List[str], *, line_chars: int = 90):
+    """
+    Minimal PDF writer (Helvetica text, one content stream per page); enough
+    for pypdf to extract the text back.
+    """
+    objects: dict[int, bytes] = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    kids = []
+    for k, text in enumerate(pages):
+        page_id, content_id = 4 + 2 * k, 5 + 2 * k
+        kids.append(f"{page_id} 0 R")
+        text = text.replace("\\", "").replace("(", "").replace(")", "")
+        lines = [text[i : i + line_chars] for i in range(0, len(text), line_chars)]
+        stream = ("BT /F1 9 Tf 36 806 Td 11 TL " + " ".join(f"({line}) '" for line in lines) + " ET").encode("latin-1")
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode()
+        objects[content_id] = b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>".encode()
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for i in sorted(objects):
+        offsets[i] = len(data)
+        data += f"{i} 0 obj\n".encode() + objects[i] + b"\nendobj\n"
+    xref = len(data)
+    size = max(objects) + 1
+    data += f"xref\n0 {size}\n0000000000 65535 f \n".encode()
+    for i in range(1, size):
+        data += f"{offsets[i]:010d} 00000 n \n".encode()
+    data += f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(bytes(data))
@@ -264,13 +264,28 @@ async function handleFileSelect(event) {
     body: fd,
   });
 
-  const data = await res.json().catch(() => ({}));
+  const queued = await res.json().catch(() => ({}));
   if (!res.ok) {
     uploadProgress.style.display = "none";
-    alert(data.detail || "Upload failed");
+    alert(queued.detail || "Upload failed");
+    return;
+  }
+
+  // Indexing runs as a background job; poll until it finishes
+  const job = await waitForIngestionJob(queued.job_id, (pct, label) => {
+    progressFill.style.width = `${pct}%`;
+    progressPercent.textContent = `${pct}%`;
+    progressText.textContent = label;
+  });
+
+  if (!job || job.status !== "succeeded") {
+    uploadProgress.style.display = "none";
+    alert((job && job.error) || "Indexing failed");
     return;
   }
 
+  const data = { filename: queued.filename, ...job.result };
+
   progressFill.style.width = "100%";
   progressPercent.textContent = "100%";
   progressText.textContent = "Document ready for querying!";
@@ -286,6 +301,7 @@ async function handleFileSelect(event) {
     appState.currentFile = {
       name: data.filename || file.name,
       size: file.size,
+      docId: data.doc_id || null,
       processed: true,
     };
 
@@ -300,7 +316,59 @@ async function handleFileSelect(event) {
   }, 350);
 }
 
-function removeFile() {
+const INGEST_STAGE_LABELS = {
+  parse: "Reading PDF pages...",
+  chunk: "Splitting into chunks...",
+  embed: "Embedding chunks...",
+  index: "Building search index...",
+};
+
+async function waitForIngestionJob(jobId, onProgress) {
+  const stages = Object.keys(INGEST_STAGE_LABELS);
+
+  while (true) {
+    const res = await apiFetch(`/api/upload_jobs/${encodeURIComponent(jobId)}`);
+    const job = await res.json().catch(() => null);
+    if (!res.ok || !job) return null;
+    if (job.status === "succeeded" || job.status === "failed") return job;
+
+    // 20% for the upload itself, the remaining 80% split across stages
+    let pct = 20;
+    let label = "Queued for indexing...";
+    stages.forEach((name, idx) => {
+      const st = job.stages[name];
+      if (!st) return;
+      const span = 80 / stages.length;
+      if (st.status === "done") {
+        pct = 20 + span * (idx + 1);
+      } else if (st.status === "running") {
+        const frac = st.total ? Math.min(st.done / st.total, 1) : 0;
+        pct = 20 + span * (idx + frac);
+        label = INGEST_STAGE_LABELS[name];
+      }
+    });
+    onProgress(Math.round(pct), label);
+
+    await new Promise((r) => setTimeout(r, 750));
+  }
+}
+
+async function removeFile() {
+  const file = appState.currentFile;
+  const docId = file?.docId;
+  if (docId) {
+    if (!confirm(`Remove "${file.name}" from your documents? It will no longer be searchable.`)) return;
+
+    // Deletes the document from your index; chunks other documents share stay
+    const res = await apiFetch(`/api/documents/${encodeURIComponent(docId)}`, { method: "DELETE" }).catch(() => null);
+    // 404: already gone, so the panel can be cleared anyway
+    if (!res || (!res.ok && res.status !== 404)) {
+      const err = res ? await res.json().catch(() => ({})) : {};
+      alert(err.detail || "Could not remove the document. Please try again.");
+      return;
+    }
+  }
+
   appState.currentFile = null;
   uploadedFile.style.display = "none";
   document.getElementById("fileInput").value = "";
@@ -527,22 +595,28 @@ async function streamChatFetch({ conversationId, message, hybrid, aiMsgId }) {
           } catch {
             sources = null;
           }
-        } else if (eventName === "done") {
+          // Sources arrive before the answer; show them while it streams
           if (sources) showSources(sources);
+        } else if (eventName === "done") {
           return true;
         } else if (eventName === "error") {
+          let detail = "Streaming failed";
+          let partial = false;
           try {
             const payload = JSON.parse(dataLine);
-            updateAIPlaceholder(aiMsgId, `Error: ${payload.detail || "Streaming failed"}`);
-          } catch {
-            updateAIPlaceholder(aiMsgId, "Error: Streaming failed");
-          }
+            detail = payload.detail || detail;
+            partial = Boolean(payload.partial);
+          } catch {}
+          // Keep the part of the answer that already arrived
+          updateAIPlaceholder(
+            aiMsgId,
+            partial && answerText ? `${answerText}\n\n[Answer interrupted: ${detail}]` : `Error: ${detail}`
+          );
           return true; // handled
         }
       }
     }
 
-    if (sources) showSources(sources);
     return answerText.length > 0;
   } catch (e) {
     return false;
@@ -562,6 +636,10 @@ function showSources(sources) {
   sources.forEach((source, idx) => {
     const page = source.page ?? "Unknown";
     const text = source.preview ?? source.content ?? "";
+    // Why this passage was cited: its rank in each retriever that found it
+    const ranks = Object.entries(source.ranks || {})
+      .map(([name, rank]) => `${name === "bm25" ? "BM25" : "Vector"} #${rank}`)
+      .join(" · ");
 
     const sourceCard = document.createElement("div");
     sourceCard.className =
@@ -578,7 +656,7 @@ function showSources(sources) {
             <div class="text-xs text-gray-500">Source #${idx + 1}</div>
           </div>
         </div>
-        <div class="text-xs px-2 py-1 rounded-full bg-blue-100 text-blue-800">Context</div>
+        <div class="text-xs px-2 py-1 rounded-full bg-blue-100 text-blue-800"></div>
       </div>
       <p class="text-gray-700 text-sm"></p>
       <div class="mt-3 pt-3 border-t border-gray-200 text-xs text-gray-500 flex justify-between">
@@ -590,6 +668,9 @@ function showSources(sources) {
     `;
 
     sourceCard.querySelector("p").textContent = text;
+    const badge = sourceCard.querySelector(".rounded-full.bg-blue-100");
+    badge.textContent = ranks || "Context";
+    if (typeof source.score === "number") badge.title = `Fused score ${source.score.toFixed(4)}`;
 
     sourceCard.querySelector("button").addEventListener("click", (e) => {
       e.stopPropagation();
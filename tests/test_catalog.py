@@ -0,0 +1,23 @@
+import pytest
+
+from app.rag.catalog import IndexCatalog
+
+
+def _catalog(tmp_path, open_corpus) -> IndexCatalog:
+    return IndexCatalog(str(tmp_path), open_corpus=open_corpus, serve=lambda corpus: {})
+
+
+def test_failed_lookups_leave_no_loading_lock(tmp_path):
+    catalog = _catalog(tmp_path, open_corpus=lambda path: None)
+    assert catalog.get("nobody") is None
+    assert catalog._loading == {}
+
+
+def test_failed_load_leaves_no_loading_lock(tmp_path):
+    def broken(path):
+        raise ValueError("corrupt index")
+
+    catalog = _catalog(tmp_path, open_corpus=broken)
+    with pytest.raises(ValueError):
+        catalog.get("someone", create=True)
+    assert catalog._loading == {}
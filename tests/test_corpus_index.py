@@ -0,0 +1,199 @@
+import glob
+import os
+
+import pytest
+from langchain_core.documents import Document
+
+from app.rag.chunk_store import ChunkStore
+from app.rag.corpus_index import MAX_DOC_SEGMENTS, ChunksNotIndexed, CorpusIndex, content_hash
+from benchmarks.fakes import HashingEmbeddings
+
+V1 = ["alpha shared one", "bravo shared two", "charlie shared three", "delta old four", "echo old five"]
+V2 = ["alpha shared one", "bravo shared two", "charlie shared three", "foxtrot new four", "golf new five"]
+
+
+def _chunks(texts, source):
+    return [
+        Document(page_content=t, metadata={"source": source, "page": i, "source_page": i + 1})
+        for i, t in enumerate(texts)
+    ]
+
+
+def _ingest(corpus, emb, doc_id, texts, source):
+    """
+    The steps `_rebuild_from_pdf` takes: tag, embed what is missing, apply.
+    """
+    chunks = _chunks(texts, source)
+    chunk_ids = [CorpusIndex.tag_chunk(c, doc_id) for c in chunks]
+    fresh = corpus.missing(chunks)
+    vectors = emb.embed_documents([c.page_content for c in fresh])
+    return corpus.add_document(
+        doc_id,
+        chunk_ids,
+        fresh,
+        vectors,
+        pages=len(texts),
+        source=source,
+        replaces=corpus.find_documents(source=source),
+        chunk_pages=[c.metadata["source_page"] for c in chunks],
+    )
+
+
+def _cited(corpus, text):
+    d = corpus.vector_store.get(content_hash(text))
+    return d.metadata["doc_id"], d.metadata["source"], d.metadata["source_page"]
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    return CorpusIndex(HashingEmbeddings(dim=32), str(tmp_path / "index"))
+
+
+def test_reingest_modified_pdf_keeps_shared_chunks(corpus):
+    emb = corpus.embedding_model
+    _ingest(corpus, emb, "a" * 32, V1, "u_doc.pdf")
+    info = _ingest(corpus, emb, "b" * 32, V2, "u_doc.pdf")
+
+    assert info["duplicates"] == 3
+    assert list(corpus.documents) == ["b" * 32]
+    assert [content_hash(t) in corpus.vector_store.chunks for t in V2] == [True] * 5
+    assert not any(content_hash(t) in corpus.vector_store.chunks for t in V1[3:])
+    assert [d.page_content for d in corpus.bm25_search("charlie", 5)] == ["charlie shared three"]
+    assert "bravo shared two" in [d.page_content for d in corpus.vector_search("bravo shared two", 5)]
+
+    corpus.save()
+    restored = CorpusIndex.load(emb, corpus.path)
+    assert [d.page_content for d in restored.bm25_search("alpha", 5)] == ["alpha shared one"]
+    assert len(restored.vector_store) == 5
+
+
+def test_removal_between_missing_and_apply_is_reported(corpus):
+    emb = corpus.embedding_model
+    _ingest(corpus, emb, "a" * 32, V1, "u_one.pdf")
+
+    chunks = _chunks(V2, "u_two.pdf")
+    chunk_ids = [CorpusIndex.tag_chunk(c, "b" * 32) for c in chunks]
+    fresh = corpus.missing(chunks)
+    corpus.remove_document("a" * 32)
+    corpus.compact()
+
+    version = corpus.version
+    with pytest.raises(ChunksNotIndexed) as e:
+        corpus.add_document("b" * 32, chunk_ids, fresh, emb.embed_documents([c.page_content for c in fresh]), pages=1)
+    assert sorted(e.value.chunk_ids) == sorted(content_hash(t) for t in V2[:3])
+    assert corpus.version == version and "b" * 32 not in corpus.documents
+
+
+def test_incref_unknown_chunk_raises():
+    with pytest.raises(KeyError):
+        ChunkStore().incref(["0" * 32])
+
+
+@pytest.mark.parametrize("index_type", ["hnsw", "ivf"])
+def test_search_recovers_after_large_removal(tmp_path, index_type):
+    emb = HashingEmbeddings(dim=32)
+    corpus = CorpusIndex(emb, str(tmp_path / "index"), index_type=index_type)
+    kept = [f"kept passage number {i}" for i in range(100)]
+    _ingest(corpus, emb, "a" * 32, [f"bulk passage number {i}" for i in range(3000)], "u_bulk.pdf")
+    _ingest(corpus, emb, "b" * 32, kept, "u_kept.pdf")
+
+    corpus.remove_document("a" * 32)
+    corpus.compact()
+    assert corpus.vector_store.trained_size == 100
+    assert not corpus.vector_store.tombstones
+    assert len(corpus.vector_search("kept passage number 7", 3)) == 3
+
+    corpus.remove_document("b" * 32)
+    corpus.compact()
+    assert corpus.vector_store.index.ntotal == 0 and corpus.vector_search("kept", 3) == []
+
+
+def test_shared_chunk_is_cited_from_a_remaining_document(corpus):
+    emb = corpus.embedding_model
+    _ingest(corpus, emb, "a" * 32, V1, "u_a.pdf")
+    _ingest(corpus, emb, "b" * 32, ["intro"] + V2, "u_b.pdf")
+    assert _cited(corpus, "bravo shared two") == ("a" * 32, "u_a.pdf", 2)
+
+    corpus.save()
+    corpus.remove_document("a" * 32)
+    assert _cited(corpus, "bravo shared two") == ("b" * 32, "u_b.pdf", 3)
+    assert [d.metadata["source"] for d in corpus.bm25_search("bravo", 5)] == ["u_b.pdf"]
+
+    corpus.save()
+    restored = CorpusIndex.load(emb, corpus.path)
+    assert _cited(restored, "bravo shared two") == ("b" * 32, "u_b.pdf", 3)
+
+
+def test_renamed_upload_is_cited_under_its_new_name(corpus):
+    emb = corpus.embedding_model
+    _ingest(corpus, emb, "a" * 32, V1, "u_old.pdf")
+    corpus.save()
+    _ingest(corpus, emb, "a" * 32, V1, "u_new.pdf")
+    assert {_cited(corpus, t)[1] for t in V1} == {"u_new.pdf"}
+
+
+def _files(path):
+    return sorted(glob.glob(os.path.join(path, "vectors", "*"))) + sorted(glob.glob(os.path.join(path, "*", "*_*", "*")))
+
+
+def test_save_links_what_it_wrote_before(corpus, tmp_path):
+    emb = corpus.embedding_model
+    _ingest(corpus, emb, "a" * 32, [f"passage {i}" for i in range(30)], "u_a.pdf")
+    _ingest(corpus, emb, "c" * 32, ["india small one"], "u_c.pdf")
+    corpus.save()
+    # Keep a second name for every immutable file, so it can be recognised
+    # after the swap (deletion masks are rewritten when they change)
+    first = {}
+    for i, f in enumerate(p for p in _files(corpus.path) if not p.endswith(("tombstones.npy", "alive.npy"))):
+        first[os.path.relpath(f, corpus.path)] = str(tmp_path / f"keep_{i}")
+        os.link(f, first[os.path.relpath(f, corpus.path)])
+
+    _ingest(corpus, emb, "b" * 32, ["hotel extra six"], "u_b.pdf")
+    corpus.remove_document("c" * 32)
+    corpus.save()
+    assert not corpus.compacting
+    for rel, kept in first.items():
+        assert os.path.samefile(os.path.join(corpus.path, rel), kept), rel
+    assert len(_files(corpus.path)) > len(first)
+
+    restored = CorpusIndex.load(emb, corpus.path)
+    assert len(restored.vector_store) == 31 and list(restored.documents) == ["a" * 32, "b" * 32]
+    assert restored.vector_search("hotel extra six", 1)[0].page_content == "hotel extra six"
+    assert "india small one" not in [d.page_content for d in restored.vector_search("india small one", 31)]
+
+
+def test_many_saves_are_merged(corpus):
+    emb = corpus.embedding_model
+    for i in range(12):
+        _ingest(corpus, emb, f"{i:032x}", [f"passage {i} line {j}" for j in range(3)], f"u_{i}.pdf")
+        corpus.save()
+    corpus.remove_document(f"{0:032x}")
+    corpus.compact()
+    chunk_segments = len(corpus.vector_store.chunks.segments)
+    assert chunk_segments <= corpus.vector_store.chunks.max_segments
+    assert len({d["segment"] for d in corpus.documents.values()}) <= MAX_DOC_SEGMENTS
+
+    restored = CorpusIndex.load(emb, corpus.path)
+    assert len(restored.vector_store.chunks.segments) == chunk_segments
+    assert [d.page_content for d in restored.bm25_search("passage 11 line 2", 1)] == ["passage 11 line 2"]
+    assert _cited(restored, "passage 7 line 1") == (f"{7:032x}", "u_7.pdf", 2)
+    assert restored.vector_store.get(content_hash("passage 0 line 0")) is None
+
+
+def test_changes_made_during_compaction_are_kept(corpus, tmp_path):
+    emb = corpus.embedding_model
+    _ingest(corpus, emb, "a" * 32, V1, "u_a.pdf")
+    vs = corpus.vector_store
+    with corpus._compact_lock:
+        plan = vs.compaction_plan()
+        _ingest(corpus, emb, "b" * 32, ["hotel extra six"], "u_b.pdf")
+        corpus.remove_document("a" * 32)
+        built = vs.build_compaction(plan, corpus.index_type, str(tmp_path))
+        with corpus._lock.write():
+            vs.install_compaction(plan, built)
+
+    assert len(vs) == 1 and vs.index.ntotal == len(V1) and vs.recent.ntotal == 1
+    assert [d.page_content for d in corpus.vector_search("alpha shared one", 10)] == ["hotel extra six"]
+    corpus.save()
+    restored = CorpusIndex.load(emb, corpus.path)
+    assert [d.page_content for d in restored.vector_search("alpha shared one", 10)] == ["hotel extra six"]
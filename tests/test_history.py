@@ -0,0 +1,83 @@
+from langchain_core.messages import HumanMessage
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from app.memory.history import HistoryWindow, MemoryChatStore, MongoChatStore, WindowedChatHistory
+
+
+class _Collection:
+    """
+    insert_many with Mongo's ordered-bulk failure modes: duplicate ids, a
+    rejected document, or the server being unreachable.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.down = 0
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def insert_many(self, batch, ordered=True):
+        if self.down:
+            self.down -= 1
+            raise AutoReconnect("unreachable")
+        for i, d in enumerate(batch):
+            if d["_id"] in self.docs:
+                raise BulkWriteError({"nInserted": i, "writeErrors": [{"index": i, "code": 11000}]})
+            if "rejected" in d["History"]:
+                raise BulkWriteError({"nInserted": i, "writeErrors": [{"index": i, "code": 121, "errmsg": "invalid"}]})
+            self.docs[d["_id"]] = d
+
+
+class _Db(dict):
+    def __missing__(self, name):
+        coll = self[name] = _Collection()
+        return coll
+
+
+class _Client(dict):
+    def __missing__(self, name):
+        db = self[name] = _Db()
+        return db
+
+
+def _store(**kwargs) -> MongoChatStore:
+    return MongoChatStore(_Client(), "db", "history", flush_interval=60, **kwargs)
+
+
+def test_rejected_message_is_dropped_not_retried():
+    store = _store()
+    store.append("s", [HumanMessage("one"), HumanMessage("rejected"), HumanMessage("three")])
+    store.flush()
+    store.flush()
+    assert len(store.messages.docs) == 2
+    assert store.stats()["pending_writes"] == 0
+    assert store.dropped == 1
+
+
+def test_retries_are_capped_per_message():
+    store = _store(max_attempts=3)
+    store.messages.down = 10
+    store.append("s", [HumanMessage("one")])
+    for _ in range(3):
+        store.flush()
+    assert store.stats()["pending_writes"] == 0
+    assert store.dropped == 1
+
+    store.messages.down = 1
+    store.append("s", [HumanMessage("two")])
+    store.flush()
+    store.flush()
+    assert len(store.messages.docs) == 1 and store.dropped == 1
+
+
+def test_failed_fold_is_logged_and_counted(caplog):
+    def summarizer(text, messages):
+        raise RuntimeError("llm down")
+
+    store = MemoryChatStore()
+    history = WindowedChatHistory("s", store, window=HistoryWindow(max_messages=2, fold_batch=1), summarizer=summarizer)
+    store.append("s", [HumanMessage(str(i)) for i in range(4)])
+    history._fold()
+    assert store.stats()["fold_errors"] == 1
+    assert "llm down" in caplog.text
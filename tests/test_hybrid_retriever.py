@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from app.rag.hybrid_retriever import HybridRetriever, reciprocal_rank_fusion
+
+
+class _Leg(BaseRetriever):
+    delay: float = 0.0
+    fail: bool = False
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("leg failed")
+        return [Document(page_content=f"hit {self.delay}", metadata={"chunk_id": f"c{self.delay}"})]
+
+
+def _hybrid(bm25: _Leg, vector: _Leg) -> HybridRetriever:
+    return HybridRetriever(
+        retrievers={"bm25": bm25, "vector": vector}, rrf_func=reciprocal_rank_fusion, leg_timeout=0.05
+    )
+
+
+def test_every_leg_failing_raises():
+    retriever = _hybrid(_Leg(fail=True), _Leg(fail=True, delay=0.01))
+    with pytest.raises(RuntimeError):
+        retriever.invoke("q")
+    with pytest.raises(RuntimeError):
+        asyncio.run(retriever.ainvoke("q"))
+
+
+def test_failed_leg_waits_for_a_slow_one():
+    retriever = _hybrid(_Leg(fail=True), _Leg(delay=0.2))
+    assert [d.page_content for d in retriever.invoke("q")] == ["hit 0.2"]
+    assert [d.page_content for d in asyncio.run(retriever.ainvoke("q"))] == ["hit 0.2"]